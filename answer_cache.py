@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class AnswerCache:
+    """
+    Semantic cache of /ask responses, consulted after retrieval and before the LLM.
+
+    An entry matches a new question when both ran the same retrieval mode,
+    retrieved the same chunk ids in the same order, and the question
+    embeddings have cosine similarity of at least `threshold`. Requiring
+    identical chunks means a cached answer is only reused for the exact
+    context the LLM saw.
+
+    Entries expire after `ttl` seconds and the least recently used entry
+    is evicted beyond `capacity`. `invalidate()` drops everything and
+    bumps the generation, so answers computed against the previous
+    corpus by in-flight requests are not stored.
+
+    Args:
+        capacity: Maximum number of cached responses
+        ttl: Seconds an entry stays valid
+        threshold: Minimum cosine similarity between question embeddings
+    """
+
+    def __init__(self, capacity=1000, ttl=3600.0, threshold=0.95):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self.generation = 0
+        self.entries = OrderedDict()  # entry id -> entry, least recently used first
+        self.by_context = {}  # (method, chunk ids) -> set of entry ids
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        group = self.by_context[entry["context"]]
+        group.discard(entry_id)
+        if not group:
+            del self.by_context[entry["context"]]
+
+    def get(self, q_emb, chunk_ids, method):
+        """
+        Cached response for this question and retrieval, or None.
+
+        Returns:
+            (response or None, generation to pass to `put` on a miss)
+        """
+        context = (method, tuple(chunk_ids))
+        q_emb = np.asarray(q_emb, dtype="float32").reshape(-1)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self.by_context.get(context, ())):
+                entry = self.entries[entry_id]
+                if now - entry["created"] > self.ttl:
+                    self._drop(entry_id)
+                    self.expirations += 1
+                    continue
+                score = float(np.dot(entry["vector"], q_emb))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None, self.generation
+            self.entries.move_to_end(best_id)
+            self.hits += 1
+            return self.entries[best_id]["response"], self.generation
+
+    def put(self, q_emb, chunk_ids, method, response, generation):
+        """Store a response unless the corpus changed since `get` returned `generation`."""
+        context = (method, tuple(chunk_ids))
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self.entries[entry_id] = {
+                "vector": np.asarray(q_emb, dtype="float32").reshape(-1).copy(),
+                "context": context,
+                "response": response,
+                "created": time.monotonic()
+            }
+            self.by_context.setdefault(context, set()).add(entry_id)
+            while len(self.entries) > self.capacity:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self):
+        """Forget every cached answer (the corpus changed)."""
+        with self._lock:
+            self.entries.clear()
+            self.by_context.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "llm_calls_saved": self.hits,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations
+            }
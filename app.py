@@ -1,16 +1,39 @@
 import os
-import pickle
+import asyncio
+import json
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import faiss
 import numpy as np
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from PyPDF2 import PdfReader
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
 import time
-from rank_bm25 import BM25Okapi
 import logging
-import io
+from typing import List, Literal, Optional
+from embeddings import estimate_tokens
+from embedding_backends import create_embedder, embedding_mismatch
+from embedding_cache import EmbeddingCache, cache_key, claim_cache_dir
+from metrics import Registry, current_trace, span, start_trace, timed
+from micro_batcher import MicroBatcher
+from answer_cache import AnswerCache
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from context_packing import pack_context
+from fusion import FUSION_MODES
+from metadata_index import make_filter
+from pdf_pipeline import rss_mb
+from sharding import SHARD_MODES, ShardClient
+from snapshot import (Snapshot, current_version, load_documents, load_snapshot, publish_lock, read_index_mmap,
+                      write_snapshot)
+from vector_index import build_index, describe, index_spec, normalize
+import ingestion
+import retrieval
 
 # Configure logging
 logging.basicConfig(
@@ -31,70 +54,465 @@ REFUSAL = "This information is not available in the provided document(s)."
 VECTOR_DIR = "vectorstore"
 os.makedirs(VECTOR_DIR, exist_ok=True)
 
-client = AzureOpenAI(
+# Request handlers use the async clients; both share one connection pool
+http_client = DefaultAsyncHttpxClient()
+
+client = AsyncAzureOpenAI(
     api_key=os.getenv("AZURE_OPENAI_KEY"),
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_version="2024-02-15-preview"
+    api_version="2024-02-15-preview",
+    http_client=http_client
 )
 
 DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
-embedding_client = AzureOpenAI(
-    api_key=os.getenv("AZURE_EMBEDDING_KEY") or os.getenv("AZURE_OPENAI_KEY"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_version="2024-02-15-preview"
-)
+# EMBEDDING_BACKEND=azure (default) or onnx; snapshots embedded with another model are not served
+embedder = create_embedder(http_client=http_client)
+
+# Content-addressed embedding cache, one directory per worker process (EMBED_CACHE_SIZE=0 = off)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "200000"))
+embedding_cache_dir, embedding_cache_lock = claim_cache_dir(
+    os.path.join(os.getenv("EMBED_CACHE_DIR", f"{VECTOR_DIR}/embedding_cache"), embedder.name)
+) if EMBED_CACHE_SIZE > 0 else (None, None)
+embedding_cache = EmbeddingCache(
+    embedding_cache_dir,
+    capacity=EMBED_CACHE_SIZE,
+    dtype=os.getenv("EMBED_CACHE_DTYPE", "float16")
+) if embedding_cache_dir is not None else None
+
+# Semantic cache of /ask answers by question embedding and retrieved chunks (ANSWER_CACHE_SIZE=0 = off)
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+answer_cache = AnswerCache(
+    capacity=ANSWER_CACHE_SIZE,
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+) if ANSWER_CACHE_SIZE > 0 else None
+
+# Prometheus metrics on /metrics, per worker process (series carry its pid)
+metrics = Registry(const_labels={"pid": os.getpid()})
+stage_seconds = metrics.histogram("rag_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+request_seconds = metrics.histogram("rag_request_seconds", "End-to-end request latency", ["endpoint"])
+llm_calls = metrics.counter("rag_llm_calls_total", "Chat completion calls by outcome", ["outcome"])
+llm_tokens = metrics.counter("rag_llm_tokens_total", "Chat completion tokens (estimated for streams)", ["kind"])
+refusals = metrics.counter("rag_refusals_total", "Questions answered with the refusal sentence", ["reason"])
+ingest_outcomes = metrics.counter("rag_ingest_jobs_total", "Finished ingestion jobs by state", ["state"])
+
+# Vector index built by /ingest: flat (exact), ivf, ivfpq or hnsw (see vector_index.index_spec)
+FAISS_INDEX = os.getenv("FAISS_INDEX", "flat")
+FAISS_NLIST = int(os.getenv("FAISS_NLIST", "0"))  # 0 = ~4*sqrt(vectors)
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "0"))  # 0 = 16 dims per sub-quantizer
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_EF_CONSTRUCTION = int(os.getenv("FAISS_EF_CONSTRUCTION", "80"))
+FAISS_TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", "100000"))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+
+# Level 2 fusion of the vector and BM25 candidates, overridden by Ask.fusion (see retrieval.fuse_hits)
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "embed_rerank")
+if HYBRID_FUSION not in FUSION_MODES:
+    raise ValueError(f"HYBRID_FUSION must be one of {', '.join(FUSION_MODES)}")
+RRF_K = int(os.getenv("RRF_K", "60"))
+FUSION_VECTOR_WEIGHT = float(os.getenv("FUSION_VECTOR_WEIGHT", "0.5"))
+
+# Metadata filters matching up to FILTER_EXACT_ROWS chunks are searched exactly over those rows
+FILTER_EXACT_ROWS = int(os.getenv("FILTER_EXACT_ROWS", "20000"))
+
+# Sharded retrieval: one shard_server.py host:port per shard, in shard order (unset = search here)
+SHARD_ADDRESSES = [a for a in os.getenv("SHARD_ADDRESSES", "").split(",") if a.strip()]
+SHARD_BY = os.getenv("SHARD_BY", "hash")
+if SHARD_BY not in SHARD_MODES:
+    raise ValueError(f"SHARD_BY must be one of {', '.join(SHARD_MODES)}")
+SHARD_FALLBACK = os.getenv("SHARD_FALLBACK", "local")
+if SHARD_FALLBACK not in ("local", "none"):
+    raise ValueError("SHARD_FALLBACK must be local or none")
+if SHARD_ADDRESSES and not os.getenv("SHARD_AUTHKEY"):
+    raise ValueError("SHARD_ADDRESSES is set but SHARD_AUTHKEY is not; use the shard servers' secret")
+shard_client = ShardClient(
+    SHARD_ADDRESSES,
+    os.getenv("SHARD_AUTHKEY", "").encode(),
+    timeout=float(os.getenv("SHARD_TIMEOUT", "5")),
+    retry_seconds=float(os.getenv("SHARD_RETRY_SECONDS", "10"))
+) if SHARD_ADDRESSES else None
+
+
+def load_refusal_threshold():
+    """
+    Cosine score below which /ask refuses without calling the LLM.
+
+    REFUSAL_THRESHOLD wins, then the value fitted by calibrate_refusal.py,
+    then 0.25, which is where the old L2 guard (squared distance > 1.5)
+    sat for unit vectors.
+    """
+    if os.getenv("REFUSAL_THRESHOLD"):
+        return float(os.getenv("REFUSAL_THRESHOLD"))
+    path = f"{VECTOR_DIR}/refusal_threshold.json"
+    if os.path.exists(path):
+        with open(path) as f:
+            return float(json.load(f)["threshold"])
+    return 0.25
+
+
+REFUSAL_THRESHOLD = load_refusal_threshold()
+
+def cache_lookup(texts):
+    """Split texts into cache hits and the distinct texts still to embed"""
+    keys = [cache_key(embedder.name, t) for t in texts]
+    cached = embedding_cache.get_many(keys)
+
+    # Embed each distinct missing text once
+    missing = {}
+    for i, key in enumerate(keys):
+        if i not in cached and key not in missing:
+            missing[key] = i
+    return keys, cached, missing
+
+
+def cache_merge(keys, cached, missing, vectors):
+    fresh = {}
+    if missing:
+        embedding_cache.put_many(list(missing), vectors)
+        fresh = dict(zip(missing, vectors))
+    return np.array([cached[i] if i in cached else fresh[key] for i, key in enumerate(keys)], dtype="float32")
 
-EMBEDDING_DEPLOYMENT = "text-embedding-3-small"
 
 def get_embeddings(texts):
-    """Get embeddings from Azure OpenAI with batching and rate limiting"""
-    all_embeddings = []
-    batch_size = 10  # Process 10 chunks at a time
-    
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        try:
-            response = embedding_client.embeddings.create(
-                model=EMBEDDING_DEPLOYMENT,
-                input=batch
-            )
-            batch_embeddings = [item.embedding for item in response.data]
-            all_embeddings.extend(batch_embeddings)
-            
-            # Add delay to avoid rate limit
-            if i + batch_size < len(texts):
-                time.sleep(1)  # Wait 1 second between batches
-        except Exception as e:
-            print(f"Error in batch {i}: {e}")
-            # Retry with smaller batch or individual items
-            for text in batch:
-                time.sleep(0.5)
-                response = embedding_client.embeddings.create(
-                    model=EMBEDDING_DEPLOYMENT,
-                    input=[text]
-                )
-                all_embeddings.append(response.data[0].embedding)
-    
-    return np.array(all_embeddings)
+    """
+    Unit-length embeddings from the cache, sending only unseen texts to the embedding backend.
+
+    Chunks and questions are both normalized here, so inner product in
+    the FAISS index and in the reranker is cosine similarity.
+    """
+    if embedding_cache is None:
+        with span(stage_seconds, "embed_api"):
+            return normalize(embedder.embed(texts))
+
+    with span(stage_seconds, "embed_cache"):
+        keys, cached, missing = cache_lookup(texts)
+    vectors = None
+    if missing:
+        with span(stage_seconds, "embed_api"):
+            vectors = embedder.embed([texts[i] for i in missing.values()])
+    return normalize(cache_merge(keys, cached, missing, vectors))
+
+
+async def aget_embeddings(texts):
+    """Event-loop friendly get_embeddings for request handlers"""
+    if embedding_cache is None:
+        with span(stage_seconds, "embed_api"):
+            return normalize(await embedder.aembed(texts))
+
+    with span(stage_seconds, "embed_cache"):
+        keys, cached, missing = cache_lookup(texts)
+    vectors = None
+    if missing:
+        with span(stage_seconds, "embed_api"):
+            vectors = await embedder.aembed([texts[i] for i in missing.values()])
+    return normalize(cache_merge(keys, cached, missing, vectors))
 
 app = FastAPI()
 
-index = None
-chunks = []
-meta = []
-bm25 = None  # BM25 index for Level 2
+# The live Snapshot; /ingest swaps in the next one and readers take it once per request
+snapshot = None
+startup_seconds = None
+snapshot_error = None  # why the snapshot on disk is not served
+snapshot_generation = None  # last CURRENT version loaded or rejected
+snapshot_watcher = None
+
+# Seconds between checks for a snapshot published by another worker process (0 = no polling)
+SNAPSHOT_POLL_SECONDS = float(os.getenv("SNAPSHOT_POLL_SECONDS", "1"))
+
+# Chunking parameters, recorded in every snapshot manifest
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 100
+
+# Estimated tokens of packed LLM context per question (0 = no limit)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_MIN_TOKENS = int(os.getenv("CONTEXT_MIN_TOKENS", "64"))
+
+# Snapshots kept on disk; SNAPSHOT_VERIFY=1 checksums every file at startup
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+SNAPSHOT_VERIFY = os.getenv("SNAPSHOT_VERIFY", "0") == "1"
+
+# Share of removed rows at which a publish compacts the store (1 = never compact)
+COMPACT_TOMBSTONE_RATIO = float(os.getenv("COMPACT_TOMBSTONE_RATIO", "0.25"))
+
+# /ask/batch size limit and concurrent LLM calls
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "10000"))
+
+# Micro-batching of concurrent /ask and /ask/stream questions (QUESTION_BATCH_MAX=0 = off)
+QUESTION_BATCH_MAX = int(os.getenv("QUESTION_BATCH_MAX", "32"))
+QUESTION_BATCH_WAIT_MS = float(os.getenv("QUESTION_BATCH_WAIT_MS", "2"))
+
+# PDF parsing processes, pages per task and chunks per embedding request while parsing continues
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "512"))
+
+# Background ingest jobs: slots shared by every worker process, upload spooling and job status files
+MAX_CONCURRENT_INGESTS = int(os.getenv("MAX_CONCURRENT_INGESTS", "2"))
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None  # None = system temp dir
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1 << 20)))
+ingest_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_INGESTS, thread_name_prefix="ingest")
+ingest_publish_lock = threading.Lock()
+ingest_jobs = {}  # job_id -> job status, newest last
+MAX_TRACKED_JOBS = 100
+INGEST_JOBS_DIR = f"{VECTOR_DIR}/jobs"  # job status files, readable by every worker
 
 
 class Ask(BaseModel):
     question: str
     debug: bool = False
     use_hybrid: bool = False  # Level 2: Enable hybrid retrieval
+    fusion: Optional[Literal["embed_rerank", "rrf", "weighted"]] = None  # Level 2 fusion (HYBRID_FUSION if omitted)
+    stream: bool = False  # Respond with Server-Sent Events (same as /ask/stream)
+    nprobe: Optional[int] = None  # IVF lists to probe (index default if omitted)
+    ef_search: Optional[int] = None  # HNSW candidate list size (index default if omitted)
+    pack_context: bool = True  # Merge/dedupe retrieved chunks; False sends them verbatim
+    context_tokens: Optional[int] = None  # Context token budget (CONTEXT_TOKEN_BUDGET if omitted)
+    use_cache: bool = True  # False always calls the LLM (and caches nothing), e.g. to compare retrieval modes
+    doc_ids: Optional[List[str]] = None  # Only search these documents
+    sections: Optional[List[str]] = None  # Only chapters/sections whose outline title contains one of these
+    page_from: Optional[int] = None  # Only search pages >= page_from
+    page_to: Optional[int] = None  # Only search pages <= page_to
+
+
+class AskBatch(BaseModel):
+    questions: List[str]
+    debug: bool = False
+    use_hybrid: bool = False
+    fusion: Optional[Literal["embed_rerank", "rrf", "weighted"]] = None
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    pack_context: bool = True
+    context_tokens: Optional[int] = None
+    use_cache: bool = True
+    doc_ids: Optional[List[str]] = None
+    sections: Optional[List[str]] = None
+    page_from: Optional[int] = None
+    page_to: Optional[int] = None
+
+
+def request_filter(data):
+    """RowFilter of an Ask or AskBatch request, or None."""
+    return make_filter(data.doc_ids, data.sections, data.page_from, data.page_to)
+
+
+# ---------------- SNAPSHOTS ----------------
+
+def load_chunk_embeddings(faiss_index, n_rows=None):
+    """
+    Load the row-aligned chunk embedding matrix of a pre-snapshot store.
+
+    Prefers the flat embeddings.npy written by older versions and falls
+    back to reconstructing the vectors from the FAISS index itself.
+
+    Args:
+        faiss_index: FAISS index holding one vector per live chunk
+        n_rows: Expected number of rows (defaults to the highest id + 1)
+
+    Returns:
+        float32 array of shape (n_rows, dim)
+    """
+    path = f"{VECTOR_DIR}/embeddings.npy"
+    if os.path.exists(path):
+        stored = np.load(path, mmap_mode="r")
+        if len(stored) >= max(n_rows or 0, faiss_index.ntotal):
+            return stored
+        logger.warning(f"{path} has {len(stored)} rows but index has {faiss_index.ntotal}, reconstructing")
+
+    if not isinstance(faiss_index, faiss.IndexIDMap):
+        return faiss_index.reconstruct_n(0, faiss_index.ntotal)
+
+    # IDMap storage order differs from id order, so scatter rows by id
+    ids = faiss.vector_to_array(faiss_index.id_map)
+    inner = faiss.downcast_index(faiss_index.index)
+    if isinstance(inner, faiss.IndexIVF):
+        # IVF needs a direct map to reconstruct; IVF-PQ vectors come back approximate
+        inner.make_direct_map()
+    vectors = inner.reconstruct_n(0, faiss_index.ntotal)
+    n_rows = max(n_rows or 0, int(ids.max()) + 1 if len(ids) else 0)
+    matrix = np.zeros((n_rows, faiss_index.d), dtype="float32")
+    matrix[ids] = vectors
+    return matrix
+
+
+def snapshot_info(faiss_index, bm25_index):
+    """Manifest fields describing how a snapshot was built."""
+    return {
+        "embedding": dict(embedder.info(), dim=int(faiss_index.d), normalized=True),
+        "chunking": {"size": CHUNK_SIZE, "overlap": CHUNK_OVERLAP, "unit": "words"},
+        "index": describe(faiss_index),
+        "bm25": {"k1": bm25_index.k1, "b": bm25_index.b, "epsilon": bm25_index.epsilon, "tokenizer": "lowercase-whitespace"}
+    }
+
+
+def migrate_to_cosine(l2_index, embeddings):
+    """
+    Rebuild a pre-cosine (L2, unnormalized) index as a cosine index in memory.
+
+    Returns:
+        (index, normalized row-aligned embeddings)
+    """
+    if isinstance(l2_index, faiss.IndexIDMap):
+        ids = faiss.vector_to_array(l2_index.id_map).astype("int64")
+    else:
+        ids = np.arange(l2_index.ntotal, dtype="int64")
+    embeddings = normalize(embeddings)
+    spec = next_index_spec(len(ids), embeddings.shape[1])
+    logger.warning(f"Vectorstore has an L2 index, rebuilding it as a cosine {spec} index in memory")
+    return build_vector_index(embeddings[ids], ids, spec), embeddings
+
+
+def import_flat_store():
+    """
+    Turn a pre-snapshot vectorstore (index.faiss, embeddings.npy, chunks/,
+    documents.json and bm25/ directly under VECTOR_DIR) into the first
+    snapshot. The flat files are left in place and can be deleted.
+    """
+    logger.warning("Importing flat vectorstore files as the first snapshot")
+    faiss_index = read_index_mmap(f"{VECTOR_DIR}/index.faiss")
+    store = ChunkStore.load(f"{VECTOR_DIR}/chunks")
+    embeddings = load_chunk_embeddings(faiss_index, len(store))
+    if faiss_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        faiss_index, embeddings = migrate_to_cosine(faiss_index, embeddings)
+    documents = load_documents(f"{VECTOR_DIR}/documents.json") if os.path.exists(f"{VECTOR_DIR}/documents.json") else {}
+
+    if os.path.exists(f"{VECTOR_DIR}/bm25/bm25.json"):
+        bm25_index = BM25Index.load(f"{VECTOR_DIR}/bm25")
+    else:
+        # Stores written before the CSR index only have a pickled
+        # BM25Okapi; rebuild from the chunk text instead of unpickling it
+        logger.info("No BM25 index on disk, rebuilding it from chunks")
+        bm25_index = BM25Index()
+        bm25_index.add_documents((chunk or "").lower().split() for chunk in store)
+        bm25_index.remove_documents(np.flatnonzero(store.doc < 0))
+
+    snap = Snapshot(faiss_index, store, bm25_index, np.asarray(embeddings[:len(store)], dtype="float32"), documents)
+    write_snapshot(VECTOR_DIR, snap, snapshot_info(faiss_index, bm25_index), keep=SNAPSHOT_KEEP)
+    return snap
+
+
+def serve_snapshot(snap):
+    """
+    Make a loaded snapshot the live one, unless it was embedded with another model.
+
+    Returns:
+        True if it is served
+    """
+    global snapshot, snapshot_error, snapshot_generation
+
+    snapshot_generation = snap.version
+    mismatch = embedding_mismatch(snap.manifest.get("embedding", {}), embedder, snap.index.d)
+    if mismatch:
+        # Questions would be compared with vectors from another model
+        snapshot_error = f"Snapshot {snap.version} {mismatch}; re-ingest with mode=replace or set EMBEDDING_BACKEND to match"
+        logger.error(snapshot_error)
+        return False
+    snapshot = snap
+    snapshot_error = None
+    return True
+
+
+@app.on_event("startup")
+def load_vectorstore():
+    """
+    Warm-start from the current snapshot left behind by a previous /ingest.
+
+    Runs in every worker. The index, embeddings, chunk store and BM25
+    arrays are memory-mapped (see snapshot.load_snapshot), so workers
+    share one page-cache copy and startup does not grow with the corpus;
+    only documents.json, the BM25 vocabulary, the document list and the
+    FAISS id map are read into the worker's own memory.
+    """
+    global startup_seconds
+
+    start = time.perf_counter()
+    try:
+        snap = load_snapshot(VECTOR_DIR, checksums=SNAPSHOT_VERIFY)
+        if snap is None and os.path.exists(f"{VECTOR_DIR}/index.faiss") and os.path.exists(f"{VECTOR_DIR}/chunks/docs.json"):
+            with publish_lock(VECTOR_DIR):
+                # Another worker may have imported it while this one waited
+                snap = load_snapshot(VECTOR_DIR) or import_flat_store()
+    except Exception as e:
+        logger.error(f"Failed to load persisted vectorstore: {str(e)}")
+        return
+
+    if snap is None:
+        if os.path.exists(f"{VECTOR_DIR}/chunks.pkl"):
+            logger.error("Found a pickled chunks.pkl store; run `python migrate_chunks_pickle.py` once to convert it")
+        logger.info("No persisted vectorstore found, waiting for /ingest")
+        return
+
+    if serve_snapshot(snap):
+        startup_seconds = time.perf_counter() - start
+        logger.info(f"Loaded snapshot {snap.version} in {startup_seconds:.3f}s ({snap.index.ntotal} vectors)")
+
+
+def load_published_snapshot():
+    """
+    Load the current snapshot if another process published it since this one last looked.
+
+    The caller holds ingest_publish_lock, so a publish by this process
+    cannot be overtaken by an older snapshot.
+
+    Returns:
+        True if a newer snapshot was loaded
+    """
+    version = current_version(VECTOR_DIR)
+    if version is None or version == snapshot_generation:
+        return False
+    start = time.perf_counter()
+    snap = load_snapshot(VECTOR_DIR)
+    if snap is None or snap.version == snapshot_generation or not serve_snapshot(snap):
+        return False
+    if answer_cache is not None:
+        answer_cache.invalidate()
+    logger.info(f"Loaded snapshot {snap.version} published by another process in "
+                f"{time.perf_counter() - start:.3f}s ({snap.index.ntotal} vectors)")
+    return True
+
+
+def poll_snapshot():
+    # A publish running in this process brings the snapshot up to date itself
+    if not ingest_publish_lock.acquire(blocking=False):
+        return False
+    try:
+        return load_published_snapshot()
+    finally:
+        ingest_publish_lock.release()
+
+
+async def watch_snapshot():
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_SECONDS)
+        try:
+            await run_in_threadpool(poll_snapshot)
+        except Exception as e:
+            # e.g. a snapshot removed by SNAPSHOT_KEEP while being read; retried next poll
+            logger.error(f"Failed to load published snapshot: {str(e)}")
+
+
+@app.on_event("startup")
+async def start_snapshot_watcher():
+    global snapshot_watcher
+    if SNAPSHOT_POLL_SECONDS > 0:
+        snapshot_watcher = asyncio.create_task(watch_snapshot())
+
+
+@app.on_event("shutdown")
+def flush_embedding_cache():
+    if embedding_cache is not None:
+        embedding_cache.flush()
+    if snapshot_watcher is not None:
+        snapshot_watcher.cancel()
+    if shard_client is not None:
+        shard_client.close()
 
 
 # ---------------- CHUNKING ----------------
 
-def chunk_text(text, size=400, overlap=100):
+def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     words = text.split()
     out = []
     for i in range(0, len(words), size - overlap):
@@ -104,77 +522,230 @@ def chunk_text(text, size=400, overlap=100):
 
 # ---------------- INGEST ----------------
 
+def next_index_spec(n_vectors, dim):
+    return index_spec(FAISS_INDEX, n_vectors, dim, nlist=FAISS_NLIST, pq_m=FAISS_PQ_M, hnsw_m=FAISS_HNSW_M)
+
+
+def build_vector_index(vectors, ids, spec):
+    return build_index(
+        vectors,
+        ids,
+        spec,
+        train_sample=FAISS_TRAIN_SAMPLE,
+        nprobe=FAISS_NPROBE,
+        ef_construction=FAISS_EF_CONSTRUCTION,
+        ef_search=FAISS_EF_SEARCH
+    )
+
+
+def ingest_pdf(path, filename, doc_id, mode):
+    """
+    Parse, diff, embed and index one PDF, then swap it into the live store.
+
+    Runs on an ingest worker thread. Up to MAX_CONCURRENT_INGESTS PDFs are
+    parsed and embedded in parallel; publishing is serialized. The next
+    snapshot is built from copies, so concurrent /ask calls keep reading
+    the previous one until the swap.
+
+    Returns:
+        Ingestion summary (the /ingest response body)
+    """
+    def current_doc():
+        snap = snapshot
+        return None if mode == "replace" or snap is None else snap.documents.get(doc_id)
+
+    def parse(stored_doc):
+        with span(stage_seconds, "ingest_parse"):
+            return ingestion.parse_pdf(path, filename, stored_doc or {"pages": {}}, chunk_text, get_embeddings,
+                                       stage_seconds, workers=PDF_WORKERS, pages_per_task=PDF_PAGES_PER_TASK,
+                                       embed_batch=INGEST_EMBED_BATCH)
+
+    stored_doc = current_doc()
+    parsed = parse(stored_doc)
+
+    wait_start = time.perf_counter()
+    with ingest_publish_lock, publish_lock(VECTOR_DIR):
+        timed(stage_seconds, "ingest_publish_wait", time.perf_counter() - wait_start)
+        # Build on the latest snapshot, which another worker may have published
+        load_published_snapshot()
+        if current_doc() != stored_doc:
+            # Another job changed or dropped this document meanwhile: diff
+            # again against the current store (unchanged text hits the
+            # embedding cache)
+            logger.info(f"Document {doc_id} changed during ingestion, re-diffing")
+            stored_doc = current_doc()
+            parsed = parse(stored_doc)
+        with span(stage_seconds, "ingest_publish"):
+            return publish_ingest(parsed, filename, doc_id, mode)
+
+
+def publish_ingest(parsed, filename, doc_id, mode):
+    """Write the next snapshot with a parsed PDF merged in (see ingestion.publish_ingest) and swap it in."""
+    global snapshot, snapshot_error, snapshot_generation
+
+    next_snapshot, result = ingestion.publish_ingest(
+        VECTOR_DIR,
+        None if mode == "replace" else snapshot,
+        parsed,
+        filename,
+        doc_id,
+        stage_seconds,
+        next_index_spec,
+        build_vector_index,
+        snapshot_info,
+        compact_ratio=COMPACT_TOMBSTONE_RATIO,
+        keep=SNAPSHOT_KEEP,
+        n_shards=len(SHARD_ADDRESSES),
+        shard_by=SHARD_BY,
+        train_sample=FAISS_TRAIN_SAMPLE
+    )
+    if next_snapshot is not None:
+        # One reference swap: in-flight queries finish on the snapshot they took
+        snapshot = next_snapshot
+        snapshot_error = None
+        snapshot_generation = next_snapshot.version
+        if answer_cache is not None:
+            answer_cache.invalidate()
+    return result
+
+
+def run_ingest_job(job, path, filename, doc_id, mode):
+    result = ingestion.run_ingest_job(
+        job, path, lambda: ingest_pdf(path, filename, doc_id, mode),
+        VECTOR_DIR, MAX_CONCURRENT_INGESTS, INGEST_JOBS_DIR, MAX_TRACKED_JOBS
+    )
+    request_seconds.observe(job["seconds"], endpoint="ingest")
+    ingest_outcomes.inc(state=job["state"])
+    return result
+
+
 @app.post("/ingest")
-async def ingest_documents(file: UploadFile = File(...)):
+async def ingest_documents(
+    file: UploadFile = File(...),
+    doc_id: str = Form(None),
+    mode: str = Form("upsert"),
+    wait: bool = Form(False)
+):
     """
-    Upload and ingest a PDF document.
+    Upload a PDF and queue it for ingestion.
+
+    In "upsert" mode (default) the document is merged into the existing
+    corpus: pages whose content hash is unchanged are skipped, changed or
+    deleted pages have their chunks removed, and only new text is embedded.
+    "replace" mode drops the whole corpus first.
+
+    Parsing, embedding and indexing run as a background job so /ask and
+    /health stay responsive; poll GET /ingest/{job_id} for the outcome.
     
     Args:
         file: PDF file to process
+        doc_id: Stable document identifier (defaults to the filename)
+        mode: "upsert" or "replace"
+        wait: Respond with the ingestion summary once the job finishes
     
     Returns:
-        Status with processing details
+        Job id and status URL, or the ingestion summary when wait is set
     """
     logger.info(f"Starting document ingestion for file: {file.filename}")
-    global index, chunks, meta, bm25
 
     # Validate file type
     if not file.filename.endswith('.pdf'):
         logger.error(f"Invalid file type: {file.filename}")
         return {"status": "error", "message": "Only PDF files are supported"}
 
+    if mode not in ("upsert", "replace"):
+        logger.error(f"Invalid ingest mode: {mode}")
+        return {"status": "error", "message": "mode must be 'upsert' or 'replace'"}
+
+    if mode == "upsert" and snapshot_error:
+        # Merging into an unreadable corpus would silently drop it
+        logger.error(f"Upsert refused: {snapshot_error}")
+        return {"status": "error", "message": snapshot_error}
+
+    doc_id = doc_id or file.filename
+
+    # Spool the upload to disk in fixed-size pieces; the PDF is parsed
+    # from this file (memory-mapped), never held in memory whole
+    spool = tempfile.NamedTemporaryFile(prefix="ingest-", suffix=".pdf", dir=UPLOAD_SPOOL_DIR, delete=False)
+    spool_start = time.perf_counter()
+    size = 0
     try:
-        # Read uploaded file content
-        contents = await file.read()
-        pdf_file = io.BytesIO(contents)
-        
-        # Read PDF
-        reader = PdfReader(pdf_file)
-        logger.info(f"Reading PDF: {file.filename} ({len(reader.pages)} pages)")
-
-        pages = []
-        for i, p in enumerate(reader.pages):
-            t = p.extract_text()
-            if t:
-                pages.append({"page": i + 1, "text": t})
-
-        chunks = []
-        meta = []
-
-        for p in pages:
-            for c in chunk_text(p["text"]):
-                chunks.append(c)
-                meta.append({"page": p["page"]})
-
-        embeddings = get_embeddings(chunks)
-
-        index = faiss.IndexFlatL2(embeddings.shape[1])
-        index.add(np.array(embeddings))
-
-        faiss.write_index(index, f"{VECTOR_DIR}/index.faiss")
-
-        # Level 2: Create BM25 index
-        tokenized_chunks = [chunk.lower().split() for chunk in chunks]
-        bm25 = BM25Okapi(tokenized_chunks)
-        
-        with open(f"{VECTOR_DIR}/chunks.pkl", "wb") as f:
-            pickle.dump({"chunks": chunks, "meta": meta}, f)
-        
-        with open(f"{VECTOR_DIR}/bm25.pkl", "wb") as f:
-            pickle.dump(bm25, f)
-
-        logger.info(f"Ingestion completed: {len(pages)} pages, {len(chunks)} chunks")
-        return {
-            "status": "success", 
-            "filename": file.filename,
-            "pages": len(pages), 
-            "chunks": len(chunks), 
-            "bm25_created": True
-        }
-    
-    except Exception as e:
-        logger.error(f"Error during ingestion: {str(e)}")
-        return {"status": "error", "message": str(e)}
+        with spool:
+            while True:
+                piece = await file.read(UPLOAD_CHUNK_BYTES)
+                if not piece:
+                    break
+                await run_in_threadpool(spool.write, piece)
+                size += len(piece)
+    except Exception:
+        os.remove(spool.name)
+        raise
+    if not size:
+        os.remove(spool.name)
+        logger.error(f"Empty upload: {file.filename}")
+        return {"status": "error", "message": "Uploaded file is empty"}
+    timed(stage_seconds, "ingest_spool", time.perf_counter() - spool_start)
+    logger.info(f"Spooled {file.filename} ({size / 2 ** 20:.1f} MB) to {spool.name}")
+
+    job_id = uuid.uuid4().hex
+    job = ingest_jobs[job_id] = {
+        "job_id": job_id,
+        "state": "queued",
+        "filename": file.filename,
+        "doc_id": doc_id,
+        "mode": mode,
+        "bytes": size,
+        "pid": os.getpid(),
+        "submitted_at": time.time()
+    }
+    while len(ingest_jobs) > MAX_TRACKED_JOBS:
+        ingest_jobs.pop(next(iter(ingest_jobs)))
+    ingestion.save_job(job, INGEST_JOBS_DIR, MAX_TRACKED_JOBS)
+
+    # The job dict, not its id: it may leave ingest_jobs before it runs
+    future = ingest_executor.submit(run_ingest_job, job, spool.name, file.filename, doc_id, mode)
+    if wait:
+        return await asyncio.wrap_future(future)
+
+    return {"status": "accepted", "job_id": job_id, "status_url": f"/ingest/{job_id}"}
+
+
+@app.get("/ingest/{job_id}")
+def ingest_status(job_id: str):
+    """Return the state (queued/running/done/failed) and result of an ingestion job."""
+    job = ingest_jobs.get(job_id)
+    if job is None and all(c in "0123456789abcdef" for c in job_id):
+        # Submitted to another worker process
+        try:
+            with open(os.path.join(INGEST_JOBS_DIR, f"{job_id}.json")) as f:
+                job = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+    if job is None:
+        return {"status": "error", "message": f"Unknown job id: {job_id}"}
+    return job
+
+
+@app.get("/documents")
+def list_documents():
+    """Ingested documents with their page counts and outline sections (the values /ask can filter on)."""
+    snap = snapshot
+    if snap is None:
+        return {"documents": []}
+    documents = []
+    for doc_id, doc in snap.documents.items():
+        documents.append({
+            "doc_id": doc_id,
+            "source": doc.get("source"),
+            "page_count": doc.get("page_count"),
+            "pages_with_text": len(doc["pages"]),
+            "chunks": len(snap.metadata.doc_rows.get(doc_id, [])),
+            "sections": [
+                {"chapter": s["chapter"], "section": s["section"], "pages": s["pages"]}
+                for s in snap.metadata.outline(doc_id)
+            ]
+        })
+    return {"snapshot": snap.version, "documents": documents}
 
 
 # ---------------- HEALTH ----------------
@@ -182,100 +753,277 @@ async def ingest_documents(file: UploadFile = File(...)):
 @app.get("/health")
 def health():
     logger.debug("Health check requested")
-    return {"status": "ok"}
+    rss = rss_mb()
+    snap = snapshot
+    jobs = list(ingest_jobs.values())  # /ingest changes the dict on the event loop
+    return {
+        "status": "ok",
+        "pid": os.getpid(),
+        "store_ready": snap is not None,
+        "vectors": snap.index.ntotal if snap is not None else 0,
+        "index": describe(snap.index) if snap is not None else None,
+        "snapshot": {
+            "version": snap.version,
+            "created_at": snap.manifest.get("created_at"),
+            "embedding": snap.manifest.get("embedding"),
+            "chunking": snap.manifest.get("chunking")
+        } if snap is not None else None,
+        "snapshot_error": snapshot_error,
+        "embedder": embedder.info(),
+        "startup_seconds": startup_seconds,
+        "embedding_cache": embedding_cache.stats() if embedding_cache is not None else None,
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "question_batching": question_batcher.stats() if question_batcher is not None else None,
+        "shards": shard_client.stats() if shard_client is not None else None,
+        "ingest": {
+            "running": sum(job["state"] == "running" for job in jobs),
+            "queued": sum(job["state"] == "queued" for job in jobs),
+            "max_concurrent": MAX_CONCURRENT_INGESTS,
+            "rss_mb": round(rss, 1) if rss is not None else None
+        }
+    }
+
+
+# ---------------- METRICS ----------------
+
+@metrics.collector
+def component_metrics():
+    """Counters kept by the embedding client, the caches and the live snapshot."""
+    embedding = embedder.throughput()
+    out = [
+        ("rag_embedding_requests_total", "counter", "Embedding API requests (including retries)", [({}, embedding["requests"])]),
+        ("rag_embedding_retries_total", "counter", "Embedding API requests retried after 429/5xx", [({}, embedding["retries"])]),
+        ("rag_embedding_texts_total", "counter", "Texts sent to the embedding API", [({}, embedding["texts"])]),
+        ("rag_embedding_tokens_total", "counter", "Estimated tokens sent to the embedding API", [({}, embedding["tokens"])])
+    ]
+    for name, cache in (("embedding", embedding_cache), ("answer", answer_cache)):
+        if cache is None:
+            continue
+        stats = cache.stats()
+        out.append((f"rag_{name}_cache_lookups_total", "counter", f"{name.capitalize()} cache lookups by result",
+                    [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])]))
+        out.append((f"rag_{name}_cache_entries", "gauge", f"Entries in the {name} cache", [({}, stats["entries"])]))
+    if question_batcher is not None:
+        stats = question_batcher.stats()
+        out.append(("rag_question_batches_total", "counter", "Retrieval micro-batches run", [({}, stats["batches"])]))
+        out.append(("rag_question_batch_items_total", "counter", "Questions retrieved in micro-batches",
+                    [({}, stats["items"])]))
+        out.append(("rag_question_batch_deduplicated_total", "counter",
+                    "Questions answered by an identical question already in flight", [({}, stats["deduplicated"])]))
+    if shard_client is not None:
+        stats = shard_client.stats()
+        out.append(("rag_shard_searches_total", "counter", "Sharded searches by outcome (fallbacks search locally)", [
+            ({"outcome": "merged"}, stats["searches"]),
+            ({"outcome": "version_mismatch"}, stats["version_mismatches"]),
+            ({"outcome": "error"}, stats["errors"]),
+            ({"outcome": "shard_down"}, stats["skipped"])
+        ]))
+        out.append(("rag_shards_down", "gauge", "Shards skipped after a failed search", [({}, len(stats["down"]))]))
+    snap = snapshot
+    out.append(("rag_index_vectors", "gauge", "Vectors in the live index", [({}, snap.index.ntotal if snap is not None else 0)]))
+    # /ingest adds and drops jobs on the event loop while this runs in the
+    # threadpool: count a copy (list() of a dict is atomic under the GIL)
+    jobs = list(ingest_jobs.values())
+    out.append(("rag_ingest_jobs", "gauge", "Ingestion jobs by state", [
+        ({"state": state}, sum(job["state"] == state for job in jobs)) for state in ("queued", "running")
+    ]))
+    return out
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Prometheus scrape endpoint: stage and request latency histograms plus counters."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ---------------- SEARCH ----------------
+
+def search_snapshot(snap, questions, q_embs, k, nprobe=None, ef_search=None, bm25_k=0, filters=None):
+    """retrieval.search_snapshot with this process's shards (SHARD_ADDRESSES) and filter settings."""
+    return retrieval.search_snapshot(snap, questions, q_embs, k, stage_seconds, nprobe, ef_search, bm25_k, filters,
+                                     shard_client=shard_client, shard_fallback=SHARD_FALLBACK,
+                                     filter_exact_rows=FILTER_EXACT_ROWS)
 
 
 # ---------------- LEVEL 2: HYBRID RETRIEVAL ----------------
 
-def hybrid_retrieve(question, top_k=20, final_k=8):
+def hybrid_retrieve_batch(questions, q_embs, top_k=20, final_k=8, nprobe=None, ef_search=None, snap=None,
+                          fusion=None, filters=None):
     """
-    Level 2: Hybrid Retrieval with BM25 + Vector + Azure Embedding Reranker
-    
+    Level 2: Hybrid Retrieval with BM25 + Vector, fused locally
+
+    Runs one matrix FAISS search for all question vectors and scores BM25
+    for all questions as one sparse product, then merges each question's
+    two candidate lists (see retrieval.fuse_hits).
+
     Args:
-        question: User query
+        questions: User queries
+        q_embs: Their unit-length embeddings, shape (len(questions), dim)
         top_k: Number of candidates to retrieve from each method
-        final_k: Number of chunks to return after reranking
-    
+        final_k: Number of chunks to return after fusion
+        nprobe: IVF lists to probe (index default if None)
+        ef_search: HNSW candidate list size (index default if None)
+        snap: Snapshot to search (the live one if None)
+        fusion: "embed_rerank", "rrf" or "weighted" (HYBRID_FUSION if None)
+
     Returns:
-        List of chunk indices
+        One (chunk indices, cosine scores) pair per question, best first
     """
-    global index, chunks, meta, bm25
-    
-    # 1. Vector Search (LEVEL 1 baseline)
-    q_emb = get_embeddings([question])
-    D, I = index.search(q_emb, top_k)
-    vector_results = set(I[0].tolist())
-    
-    # 2. BM25 Keyword Search (LEVEL 2)
-    tokenized_query = question.lower().split()
-    bm25_scores = bm25.get_scores(tokenized_query)
-    bm25_top_indices = np.argsort(bm25_scores)[-top_k:][::-1]
-    bm25_results = set(bm25_top_indices.tolist())
-    
-    # 3. Combine candidates (union of both methods)
-    combined_indices = list(vector_results.union(bm25_results))
-    
-    # 4. Rerank using Azure Embeddings (LEVEL 2)
-    # Get embeddings for candidate chunks
-    candidate_chunks = [chunks[idx] for idx in combined_indices]
-    
-    # Compute embeddings for candidates (in batches to handle rate limits)
-    candidate_embeddings = get_embeddings(candidate_chunks)
-    
-    # Compute cosine similarity between query and each candidate
-    q_emb_normalized = q_emb / np.linalg.norm(q_emb)
-    candidate_embeddings_normalized = candidate_embeddings / np.linalg.norm(candidate_embeddings, axis=1, keepdims=True)
-    
-    # Cosine similarity scores
-    rerank_scores = np.dot(candidate_embeddings_normalized, q_emb_normalized.T).flatten()
-    
-    # Sort by reranking score
-    ranked = sorted(
-        zip(combined_indices, rerank_scores),
-        key=lambda x: x[1],
-        reverse=True
-    )
-    
-    # Return top final_k
-    return [idx for idx, score in ranked[:final_k]]
+    snap = snap or snapshot
+    fusion = fusion or HYBRID_FUSION
+
+    # 1. Vector Search (LEVEL 1 baseline) and 2. BM25 Keyword Search (LEVEL 2),
+    # on the shards when the index is sharded
+    D, I, bm25_hits = search_snapshot(snap, questions, q_embs, top_k, nprobe, ef_search, bm25_k=top_k, filters=filters)
+    with span(stage_seconds, "rerank" if fusion == "embed_rerank" else "fusion"):
+        return retrieval.fuse_hits(snap, q_embs, D, I, bm25_hits, final_k, fusion, rrf_k=RRF_K,
+                                   vector_weight=FUSION_VECTOR_WEIGHT)
+
+
+def hybrid_retrieve(question, top_k=20, final_k=8, q_emb=None, nprobe=None, ef_search=None, fusion=None):
+    """
+    Hybrid retrieval for a single question (see hybrid_retrieve_batch).
+
+    Returns:
+        (chunk indices, cosine scores), best first
+    """
+    if q_emb is None:
+        q_emb = get_embeddings([question])
+    return hybrid_retrieve_batch([question], q_emb, top_k, final_k, nprobe, ef_search, fusion=fusion)[0]
+
+
+def vector_retrieve_batch(q_embs, k=8, nprobe=None, ef_search=None, snap=None, filters=None):
+    """
+    Level 1: one matrix FAISS search for all question vectors.
+
+    Returns:
+        One (chunk indices, cosine scores) pair per question, best first
+    """
+    snap = snap or snapshot
+    D, I, _ = search_snapshot(snap, None, q_embs, k, nprobe, ef_search, filters=filters)
+    return retrieval.live_vector_hits(snap, D, I)
 
 
 # ---------------- ASK ----------------
 
-@app.post("/ask")
-def ask(data: Ask):
-    logger.info(f"Question received: {data.question[:50]}... (hybrid={data.use_hybrid})")
-    global index, chunks, meta, bm25
+def store_has_vectors():
+    snap = snapshot
+    return snap is not None and snap.index.ntotal > 0
 
-    if index is None:
-        logger.warning("Documents not ingested - cannot answer")
-        return {"answer": "Documents not ingested yet."}
+
+async def retrieve_batch(questions, use_hybrid=False, nprobe=None, ef_search=None, threshold=None, fusion=None,
+                         filters=None):
+    """
+    Run Level 1 or Level 2 retrieval for a list of questions.
+
+    All questions are embedded together and searched as one matrix. Both
+    modes score chunks by cosine similarity, and both refuse when the
+    best score is below the threshold, before any LLM call.
+
+    Args:
+        questions: User questions
+        use_hybrid: Level 2 hybrid retrieval instead of vector-only
+        nprobe: IVF lists to probe (index default if None)
+        ef_search: HNSW candidate list size (index default if None)
+        threshold: Refusal threshold (REFUSAL_THRESHOLD if None)
+        fusion: Level 2 fusion mode (HYBRID_FUSION if None)
+        filters: Metadata RowFilter (see make_filter); None searches everything
+
+    Returns:
+        One entry per question: a dict with the retrieved "chunks", their
+        "meta" (with chapter and section) and row "ids", the retrieval "method", the best cosine
+        "score" and the question embedding "q_emb"; or None when the
+        score guard refuses the question
+    """
+    threshold = REFUSAL_THRESHOLD if threshold is None else threshold
+    # Every step of this request reads the same snapshot
+    snap = snapshot
+
+    with span(stage_seconds, "embed_question"):
+        q_embs = await aget_embeddings(questions)
 
     # LEVEL 2: Use hybrid retrieval if enabled
-    if data.use_hybrid and bm25 is not None:
-        logger.info("Using Level 2 hybrid retrieval")
-        retrieved_indices = hybrid_retrieve(data.question, top_k=20, final_k=8)
-        retrieved = [chunks[i] for i in retrieved_indices]
-        retrieved_meta = [meta[i] for i in retrieved_indices]
-        retrieval_method = "hybrid"
+    if use_hybrid:
+        fusion = fusion or HYBRID_FUSION
+        logger.info(f"Using Level 2 hybrid retrieval, {fusion} ({len(questions)} questions)")
+        hits = await run_in_threadpool(hybrid_retrieve_batch, questions, q_embs, 20, 8, nprobe, ef_search, snap, fusion,
+                                       filters)
+        method = "hybrid" if fusion == "embed_rerank" else f"hybrid-{fusion}"
     else:
-        logger.info("Using Level 1 vector-only retrieval")
         # LEVEL 1: Vector-only retrieval (baseline)
-        q_emb = get_embeddings([data.question])
-        D, I = index.search(q_emb, 8)
-        
-        # FAISS distance guard
-        if D[0][0] > 1.5:
-            logger.info(f"Distance threshold exceeded: {D[0][0]} > 1.5, refusing answer")
-            return {"answer": REFUSAL}
-        
-        retrieved = [chunks[i] for i in I[0]]
-        retrieved_meta = [meta[i] for i in I[0]]
-        retrieval_method = "vector-only"
+        logger.info(f"Using Level 1 vector-only retrieval ({len(questions)} questions)")
+        hits = await run_in_threadpool(vector_retrieve_batch, q_embs, 8, nprobe, ef_search, snap, filters)
+        method = "vector-only"
+
+    fetch_start = time.perf_counter()
+    results = []
+    for q_emb, (ids, scores) in zip(q_embs, hits):
+        # Cosine score guard, shared by both modes (fused results are not
+        # sorted by cosine, so take the best one)
+        score = max(scores) if scores else -1.0
+        if score < threshold:
+            logger.info(f"Best cosine score {score:.3f} below threshold {threshold:.3f}, refusing answer")
+            refusals.inc(reason="score_guard")
+            results.append(None)
+            continue
+        results.append({
+            "chunks": [snap.chunks[i] for i in ids],
+            "meta": [snap.metadata.meta(i) for i in ids],
+            "ids": ids,
+            "method": method,
+            "score": score,
+            "q_emb": q_emb[None, :]
+        })
+    timed(stage_seconds, "fetch_chunks", time.perf_counter() - fetch_start)
+    return results
+
+
+async def run_question_batch(group, questions):
+    """
+    Retrieval for one micro-batch of questions sharing `group` parameters.
+
+    Returns:
+        (result, batch trace) per question; the trace holds the batch's
+        stage timings, which each waiting request adds to its own
+    """
+    trace = start_trace()
+    results = await retrieve_batch(questions, *group)
+    return [(result, trace) for result in results]
+
+
+question_batcher = MicroBatcher(
+    run_question_batch, QUESTION_BATCH_MAX, QUESTION_BATCH_WAIT_MS / 1000
+) if QUESTION_BATCH_MAX > 0 else None
+
+
+async def retrieve(data, threshold=None):
+    """
+    Run Level 1 or Level 2 retrieval for one Ask request (see retrieve_batch).
+
+    With question micro-batching on, the question joins the questions of
+    concurrent requests with the same retrieval parameters; the time
+    spent waiting for the batch to start is the "batch_wait" stage.
+    """
+    if question_batcher is None:
+        results = await retrieve_batch([data.question], data.use_hybrid, data.nprobe, data.ef_search, threshold,
+                                       data.fusion, request_filter(data))
+        return results[0]
+
+    group = (data.use_hybrid, data.nprobe, data.ef_search, threshold, data.fusion, request_filter(data))
+    submitted = time.perf_counter()
+    result, batch_trace = await question_batcher.submit(group, data.question)
+    timed(stage_seconds, "batch_wait", max(0.0, batch_trace.started - submitted))
+    trace = current_trace()
+    if trace is not None:
+        trace.merge(batch_trace)
+    # Deduplicated questions share the batch's result; callers get their own copy
+    return dict(result) if result is not None else None
 
+
+def build_prompt(question, retrieved):
     context = "\n\n".join(retrieved)
 
-    prompt = f"""
+    return f"""
 You are a strict aviation document assistant.
 
 Use ONLY the context.
@@ -287,35 +1035,368 @@ Context:
 {context}
 
 Question:
-{data.question}
+{question}
 """
 
-    response = client.chat.completions.create(
-        model=DEPLOYMENT,
-        messages=[{"role": "user", "content": prompt}]
-    )
-
-    answer = response.choices[0].message.content.strip()
-
-    if REFUSAL in answer:
-        logger.info("LLM returned refusal message")
-        return {"answer": REFUSAL}
 
-    logger.info(f"Answer generated successfully using {retrieval_method}")
+def build_citations(retrieved, retrieved_meta):
     citations = []
-    for i in range(3):
-        citations.append({
+    for i in range(min(3, len(retrieved))):
+        citation = {
             "page": retrieved_meta[i]["page"],
+            "source": retrieved_meta[i].get("source"),
             "snippet": retrieved[i][:200]
-        })
+        }
+        if retrieved_meta[i].get("section"):
+            citation["chapter"] = retrieved_meta[i].get("chapter")
+            citation["section"] = retrieved_meta[i]["section"]
+        citations.append(citation)
+    return citations
 
-    result = {
-        "answer": answer, 
-        "citations": citations,
-        "retrieval_method": retrieval_method  # Level 1 vs Level 2 indicator
+
+def build_context(retrieval, pack=True, budget=None):
+    """
+    Texts sent to the LLM for a retrieval result.
+
+    Packed (default): see context_packing.pack_context. Unpacked: the
+    retrieved chunks verbatim, as before packing existed.
+
+    Returns:
+        {"texts", "meta" (one per text), "variant" (answer cache key),
+         "stats" (packing counters, None when unpacked)}
+    """
+    if not pack:
+        return {"texts": retrieval["chunks"], "meta": retrieval["meta"], "variant": "raw", "stats": None}
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    packed = pack_context(retrieval["chunks"], retrieval["meta"], retrieval["ids"], budget, CONTEXT_MIN_TOKENS)
+    return {
+        "texts": [p["text"] for p in packed["passages"]],
+        "meta": packed["passages"],
+        "variant": f"packed-{budget}",
+        "stats": packed["stats"]
     }
 
+
+def prompt_tokens(response, prompt):
+    """Prompt tokens billed for a completion, estimated when the API does not report usage."""
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.prompt_tokens:
+        return usage.prompt_tokens
+    return estimate_tokens(prompt)
+
+
+def count_llm_call(outcome, prompt_tokens, completion_tokens):
+    llm_calls.inc(outcome=outcome)
+    llm_tokens.inc(prompt_tokens, kind="prompt")
+    llm_tokens.inc(completion_tokens, kind="completion")
+    if outcome == "refused":
+        refusals.inc(reason="llm")
+
+
+def completion_tokens(response, answer):
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.completion_tokens:
+        return usage.completion_tokens
+    return estimate_tokens(answer)
+
+
+def cached_answer(retrieval, context, use_cache=True):
+    """
+    Look up the answer cache for a retrieval result and context variant.
+
+    Returns:
+        (cached response or None, generation to pass to store_answer;
+        None when the cache is off or bypassed)
+    """
+    if answer_cache is None or not use_cache:
+        return None, None
+    return answer_cache.get(retrieval["q_emb"], retrieval["ids"], f"{retrieval['method']}/{context['variant']}")
+
+
+def store_answer(retrieval, context, response, generation):
+    if answer_cache is not None and generation is not None:
+        method = f"{retrieval['method']}/{context['variant']}"
+        answer_cache.put(retrieval["q_emb"], retrieval["ids"], method, response, generation)
+
+
+@app.post("/ask")
+async def ask(data: Ask):
+    if data.stream:
+        return await ask_stream(data)
+
+    logger.info(f"Question received: {data.question[:50]}... (hybrid={data.use_hybrid})")
+
+    if not store_has_vectors():
+        logger.warning("Documents not ingested - cannot answer")
+        return {"answer": "Documents not ingested yet."}
+
+    trace = start_trace()
+    retrieval = await retrieve(data)
+    if retrieval is None:
+        result = {"answer": REFUSAL, "prompt_tokens": 0}
+    else:
+        result = await answer_question(data.question, retrieval, data.debug, data.pack_context, data.context_tokens,
+                                       data.use_cache)
+    timings = trace.report()
+    request_seconds.observe(timings["total_ms"] / 1000, endpoint="ask")
     if data.debug:
+        result["timings"] = timings
+    return result
+
+
+async def answer_question(question, retrieval, debug=False, pack=True, budget=None, use_cache=True):
+    """
+    /ask response for a question whose retrieval passed the score guard.
+
+    Packs the retrieved chunks into the context, serves the answer from
+    the semantic cache when possible, otherwise calls the LLM and caches
+    the result (unless `use_cache` is False). `prompt_tokens` is what
+    this request sent to the LLM (0 when served from cache).
+    """
+    retrieved = retrieval["chunks"]
+    with span(stage_seconds, "pack_context"):
+        context = build_context(retrieval, pack, budget)
+
+    with span(stage_seconds, "answer_cache"):
+        cached, generation = cached_answer(retrieval, context, use_cache)
+    if cached is not None:
+        logger.info(f"Answer served from cache ({retrieval['method']})")
+        if REFUSAL in cached["answer"]:
+            return {"answer": REFUSAL, "prompt_tokens": 0}
+        result = dict(cached, cached=True, prompt_tokens=0)
+    else:
+        prompt = build_prompt(question, context["texts"])
+        try:
+            with span(stage_seconds, "llm"):
+                response = await client.chat.completions.create(
+                    model=DEPLOYMENT,
+                    messages=[{"role": "user", "content": prompt}]
+                )
+        except Exception:
+            llm_calls.inc(outcome="error")
+            raise
+
+        answer = response.choices[0].message.content.strip()
+        tokens = prompt_tokens(response, prompt)
+        count_llm_call("refused" if REFUSAL in answer else "answered", tokens, completion_tokens(response, answer))
+
+        if REFUSAL in answer:
+            logger.info(f"LLM returned refusal message ({tokens} prompt tokens)")
+            store_answer(retrieval, context, {"answer": REFUSAL}, generation)
+            return {"answer": REFUSAL, "prompt_tokens": tokens}
+
+        logger.info(f"Answer generated successfully using {retrieval['method']} ({tokens} prompt tokens)")
+        result = {
+            "answer": answer,
+            "citations": build_citations(context["texts"], context["meta"]),
+            "retrieval_method": retrieval["method"]  # Level 1 vs Level 2 indicator
+        }
+        store_answer(retrieval, context, result, generation)
+        result = dict(result, prompt_tokens=tokens)
+
+    if debug:
         result["retrieved_chunks"] = retrieved[:3]
+        result["retrieval_score"] = retrieval["score"]
+        result["context"] = context["stats"]
+
+    return result
+
+
+@app.post("/ask/batch")
+async def ask_batch(data: AskBatch):
+    """
+    Answer many questions in one request.
+
+    Retrieval is vectorized: one embedding pass, one matrix FAISS search
+    and one batched BM25 product for all questions. LLM calls then run
+    with bounded concurrency; each distinct question is answered once.
+    Results are returned in input order.
+    """
+    if len(data.questions) > BATCH_MAX_QUESTIONS:
+        return {"status": "error", "message": f"At most {BATCH_MAX_QUESTIONS} questions per batch"}
 
+    logger.info(f"Batch of {len(data.questions)} questions received (hybrid={data.use_hybrid})")
+    start = time.perf_counter()
+    trace = start_trace()
+
+    if not store_has_vectors():
+        logger.warning("Documents not ingested - cannot answer")
+        return {"results": [{"question": q, "answer": "Documents not ingested yet."} for q in data.questions]}
+
+    # Duplicate questions get the same retrieval and answer
+    unique = list(dict.fromkeys(data.questions))
+    retrievals = await retrieve_batch(
+        unique, data.use_hybrid, data.nprobe, data.ef_search, fusion=data.fusion, filters=request_filter(data)
+    ) if unique else []
+    retrieval_seconds = time.perf_counter() - start
+
+    semaphore = asyncio.Semaphore(BATCH_LLM_CONCURRENCY)
+
+    async def answer_one(question, retrieval):
+        if retrieval is None:
+            return {"answer": REFUSAL, "prompt_tokens": 0}
+        async with semaphore:
+            try:
+                return await answer_question(question, retrieval, data.debug, data.pack_context,
+                                             data.context_tokens, data.use_cache)
+            except Exception as e:
+                # One failed LLM call should not fail the whole batch
+                logger.error(f"Batch answer failed: {e}")
+                return {"status": "error", "message": str(e)}
+
+    answers = await asyncio.gather(*(answer_one(q, r) for q, r in zip(unique, retrievals)))
+    by_question = dict(zip(unique, answers))
+
+    logger.info(f"Batch answered in {time.perf_counter() - start:.2f}s")
+    timings = trace.report()
+    request_seconds.observe(timings["total_ms"] / 1000, endpoint="ask_batch")
+    result = {
+        "results": [dict(by_question[q], question=q) for q in data.questions],
+        "questions": len(data.questions),
+        "refused": sum(r is None for r in retrievals),
+        "prompt_tokens": sum(a.get("prompt_tokens", 0) for a in answers),
+        "retrieval_seconds": round(retrieval_seconds, 3),
+        "total_seconds": round(time.perf_counter() - start, 3)
+    }
+    if data.debug:
+        # Stages of all questions together; LLM calls overlap, so their sum can exceed total_ms
+        result["timings"] = timings
     return result
+
+
+# ---------------- STREAMING ASK ----------------
+
+def refusal_prefix_length(text):
+    """Length of the longest suffix of text that is a prefix of REFUSAL."""
+    for k in range(min(len(text), len(REFUSAL) - 1), 0, -1):
+        if text.endswith(REFUSAL[:k]):
+            return k
+    return 0
+
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+async def stream_answer(data):
+    """
+    Server-Sent Events for one question.
+
+    Emits a `retrieval` event (method and citations) as soon as retrieval
+    finishes, `token` events as the LLM produces text, and a final `done`
+    event carrying the authoritative answer. Text that could still turn
+    into the refusal sentence is held back, so the refusal is never
+    streamed as tokens; when the LLM refuses, `done` has `refused: true`
+    and the client should discard any partial text. With `debug`, `done`
+    also carries the stage timings.
+    """
+    trace = start_trace()
+
+    def done(payload):
+        timings = trace.report()
+        request_seconds.observe(timings["total_ms"] / 1000, endpoint="ask_stream")
+        if data.debug:
+            payload["timings"] = timings
+        return sse("done", payload)
+
+    if not store_has_vectors():
+        logger.warning("Documents not ingested - cannot answer")
+        yield done({"answer": "Documents not ingested yet.", "refused": False})
+        return
+
+    retrieval = await retrieve(data)
+    if retrieval is None:
+        yield done({"answer": REFUSAL, "refused": True})
+        return
+    retrieved = retrieval["chunks"]
+    retrieval_method = retrieval["method"]
+    with span(stage_seconds, "pack_context"):
+        context = build_context(retrieval, data.pack_context, data.context_tokens)
+
+    with span(stage_seconds, "answer_cache"):
+        cached, generation = cached_answer(retrieval, context, data.use_cache)
+    if cached is not None and REFUSAL in cached["answer"]:
+        logger.info("Refusal served from cache")
+        yield done({"answer": REFUSAL, "refused": True, "prompt_tokens": 0})
+        return
+
+    metadata = {
+        "retrieval_method": retrieval_method,
+        "citations": cached["citations"] if cached is not None else build_citations(context["texts"], context["meta"])
+    }
+    if cached is not None:
+        metadata["cached"] = True
+    if data.debug:
+        metadata["retrieved_chunks"] = retrieved[:3]
+        metadata["retrieval_score"] = retrieval["score"]
+        metadata["context"] = context["stats"]
+    yield sse("retrieval", metadata)
+
+    if cached is not None:
+        logger.info(f"Answer served from cache ({retrieval_method})")
+        yield sse("token", {"text": cached["answer"]})
+        yield done({"answer": cached["answer"], "refused": False, "prompt_tokens": 0})
+        return
+
+    # Streamed responses carry no usage, so the prompt size is estimated
+    prompt = build_prompt(data.question, context["texts"])
+    tokens = estimate_tokens(prompt)
+    llm_start = time.perf_counter()
+    try:
+        response = await client.chat.completions.create(
+            model=DEPLOYMENT,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True
+        )
+    except Exception:
+        llm_calls.inc(outcome="error")
+        raise
+
+    answer = ""
+    sent = 0  # characters of `answer` already streamed
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not answer:
+            timed(stage_seconds, "llm_first_token", time.perf_counter() - llm_start)
+        answer += delta
+        if REFUSAL in answer:
+            break
+        # Hold back any tail that could be the start of the refusal sentence
+        safe = len(answer) - refusal_prefix_length(answer)
+        if safe > sent:
+            yield sse("token", {"text": answer[sent:safe]})
+            sent = safe
+
+    timed(stage_seconds, "llm", time.perf_counter() - llm_start)
+    count_llm_call("refused" if REFUSAL in answer else "answered", tokens, estimate_tokens(answer))
+
+    if REFUSAL in answer:
+        logger.info("LLM returned refusal message")
+        store_answer(retrieval, context, {"answer": REFUSAL}, generation)
+        yield done({"answer": REFUSAL, "refused": True, "prompt_tokens": tokens})
+        return
+
+    if sent < len(answer):
+        yield sse("token", {"text": answer[sent:]})
+    logger.info(f"Streamed answer using {retrieval_method}")
+    store_answer(retrieval, context, {
+        "answer": answer.strip(),
+        "citations": metadata["citations"],
+        "retrieval_method": retrieval_method
+    }, generation)
+    yield done({"answer": answer.strip(), "refused": False, "prompt_tokens": tokens})
+
+
+@app.post("/ask/stream")
+async def ask_stream(data: Ask):
+    """Streaming variant of /ask (text/event-stream)."""
+    logger.info(f"Streaming question received: {data.question[:50]}... (hybrid={data.use_hybrid})")
+    return StreamingResponse(
+        stream_answer(data),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
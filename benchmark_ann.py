@@ -0,0 +1,155 @@
+"""
+Recall vs latency of the FAISS index types (Flat, IVF-Flat, IVF-PQ, HNSW).
+
+Builds every index type over the same vectors, searches the questions in
+questions.json one at a time (as /ask does) and reports build time,
+index size, p50/p99 search latency and recall@8 against exact flat search
+for a sweep of nprobe / efSearch values.
+
+Vectors come from the ingested vectorstore (questions are embedded with
+the server's embedding client and cache), or from a synthetic clustered
+corpus when --synthetic is given:
+
+    python benchmark_ann.py
+    python benchmark_ann.py --synthetic 1000000 --dim 1536 --json ann.json
+"""
+import argparse
+import json
+import time
+
+import faiss
+import numpy as np
+
+from snapshot import load_snapshot
+from vector_index import build_index, index_spec, normalize
+
+
+def synthetic_vectors(n, dim, clusters=1000, seed=0):
+    """Gaussian clusters, a rough stand-in for embeddings of topical chunks."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim), dtype="float32")
+    vectors = np.empty((n, dim), dtype="float32")
+    for start in range(0, n, 100_000):
+        end = min(n, start + 100_000)
+        assign = rng.integers(0, clusters, end - start)
+        vectors[start:end] = centers[assign] + 0.5 * rng.standard_normal((end - start, dim), dtype="float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def load_corpus(args):
+    if args.synthetic:
+        vectors = synthetic_vectors(args.synthetic + args.queries, args.dim)
+        return vectors[:args.synthetic], vectors[args.synthetic:]
+
+    snapshot = load_snapshot(args.vectorstore)
+    if snapshot is None:
+        raise SystemExit(f"No snapshot in {args.vectorstore}, ingest documents first")
+    vectors = normalize(snapshot.embeddings[snapshot.chunks.live_rows()])
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)][:args.queries]
+    from app import get_embeddings
+    return vectors, np.ascontiguousarray(get_embeddings(questions), dtype="float32")
+
+
+def search_one_by_one(index, queries, k, params, repeat):
+    """Search each query separately; returns (ids, per-query latencies)."""
+    ids = np.empty((len(queries), k), dtype="int64")
+    latencies = []
+    for _ in range(repeat):
+        for i, q in enumerate(queries):
+            start = time.perf_counter()
+            _, I = index.search(q[None, :], k, params=params)
+            latencies.append(time.perf_counter() - start)
+            ids[i] = I[0]
+    return ids, np.array(latencies)
+
+
+def recall_at_k(found, truth):
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found.tolist(), truth.tolist())]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectorstore", default="vectorstore")
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--synthetic", type=int, default=0, help="Use N synthetic vectors instead of the vectorstore")
+    parser.add_argument("--dim", type=int, default=1536, help="Dimension of synthetic vectors")
+    parser.add_argument("--queries", type=int, default=50, help="Number of questions / synthetic queries")
+    parser.add_argument("--types", nargs="+", default=["ivf", "ivfpq", "hnsw"])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128])
+    parser.add_argument("--nlist", type=int, default=0, help="0 = ~4*sqrt(n)")
+    parser.add_argument("--pq-m", type=int, default=0, help="0 = 16 dims per sub-quantizer")
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=80)
+    parser.add_argument("--train-sample", type=int, default=100_000)
+    parser.add_argument("-k", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the queries for latency percentiles")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    vectors, queries = load_corpus(args)
+    n, dim = vectors.shape
+    ids = np.arange(n, dtype="int64")
+    print(f"{n} vectors x {dim} dims, {len(queries)} queries, k={args.k}\n")
+
+    results = []
+
+    def record(spec, param, value, index, build_s, truth):
+        params = None
+        if param == "nprobe":
+            params = faiss.SearchParametersIVF(nprobe=value)
+        elif param == "efSearch":
+            params = faiss.SearchParametersHNSW(efSearch=value)
+        found, latencies = search_one_by_one(index, queries, args.k, params, args.repeat)
+        row = {
+            "index": spec,
+            "param": f"{param}={value}" if param else "",
+            "build_s": round(build_s, 2),
+            "size_mb": round(len(faiss.serialize_index(index)) / 2 ** 20, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50) * 1000), 3),
+            "p99_ms": round(float(np.percentile(latencies, 99) * 1000), 3),
+            f"recall@{args.k}": round(recall_at_k(found, truth), 4) if truth is not None else 1.0
+        }
+        results.append(row)
+        print(
+            f"{row['index']:<18} {row['param']:<13} {row['build_s']:>8} {row['size_mb']:>8} "
+            f"{row['p50_ms']:>8} {row['p99_ms']:>8} {row[f'recall@{args.k}']:>9}",
+            flush=True
+        )
+        return found
+
+    print(f"{'index':<18} {'param':<13} {'build_s':>8} {'size_mb':>8} {'p50_ms':>8} {'p99_ms':>8} {'recall@' + str(args.k):>9}")
+    start = time.perf_counter()
+    flat = build_index(vectors, ids, "Flat")
+    truth = record("Flat", None, None, flat, time.perf_counter() - start, None)
+    del flat
+
+    for kind in args.types:
+        spec = index_spec(kind, n, dim, nlist=args.nlist, pq_m=args.pq_m, hnsw_m=args.hnsw_m)
+        if spec == "Flat":
+            print(f"{kind:<18} too few vectors to train, would fall back to Flat")
+            continue
+        start = time.perf_counter()
+        index = build_index(
+            vectors, ids, spec, train_sample=args.train_sample, ef_construction=args.ef_construction
+        )
+        build_s = time.perf_counter() - start
+        if kind == "hnsw":
+            for ef in args.ef_search:
+                record(spec, "efSearch", ef, index, build_s, truth)
+        else:
+            nlist = int(spec.split(",")[0][3:])
+            for nprobe in sorted(set(min(p, nlist) for p in args.nprobe)):
+                record(spec, "nprobe", nprobe, index, build_s, truth)
+        del index
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"vectors": n, "dim": dim, "queries": len(queries), "k": args.k, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+BM25Index (CSR) vs rank_bm25 BM25Okapi on synthetic corpora.
+
+For each corpus size: build time, query latency p50/p99 for top-k, size
+on disk and memory-mapped load time of BM25Index, and whether the top-k
+rankings match BM25Okapi's (exact order and set overlap).
+
+    python benchmark_bm25.py --sizes 10000 100000 1000000 --okapi-max 100000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25_index import BM25Index
+
+
+def zipf_vocab(vocab_size):
+    """Vocabulary with Zipf term probabilities, roughly like the word statistics of manual text."""
+    ranks = np.arange(1, vocab_size + 1)
+    probs = 1.0 / ranks
+    return np.array([f"w{i}" for i in range(vocab_size)]), probs / probs.sum()
+
+
+def synthetic_batches(n_docs, doc_len, vocab, probs, batch_size=100_000, seed=0):
+    """Yield tokenized documents in batches so 1M-chunk corpora fit in memory."""
+    rng = np.random.default_rng(seed)
+    for first in range(0, n_docs, batch_size):
+        lengths = rng.integers(doc_len // 2, doc_len * 3 // 2, min(batch_size, n_docs - first))
+        tokens = vocab[rng.choice(len(vocab), size=int(lengths.sum()), p=probs)]
+        yield [doc.tolist() for doc in np.split(tokens, np.cumsum(lengths)[:-1])]
+
+
+def synthetic_queries(n_queries, vocab, probs, seed=1):
+    """Short queries mixing common and rare terms."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        common = rng.choice(len(vocab), size=2, p=probs)
+        rare = rng.integers(50, len(vocab), size=3)
+        queries.append(vocab[np.concatenate([common, rare])].tolist())
+    return queries
+
+
+def okapi_top_k(okapi, query, k):
+    scores = okapi.get_scores(query)
+    top = np.argsort(scores)[::-1][:k]
+    return top[scores[top] > 0], scores
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def bench_size(n_docs, args):
+    vocab, probs = zipf_vocab(args.vocab)
+    queries = synthetic_queries(args.queries, vocab, probs)
+    result = {"docs": n_docs}
+    compare = args.okapi_max is None or n_docs <= args.okapi_max
+
+    index = BM25Index()
+    docs = []
+    result["build_s"] = 0.0
+    for batch in synthetic_batches(n_docs, args.doc_len, vocab, probs):
+        _, elapsed = timed(index.add_documents, batch)
+        result["build_s"] += elapsed
+        if compare:
+            docs.extend(batch)
+    latencies = []
+    ours = []
+    for q in queries:
+        (ids, _), elapsed = timed(index.top_k, q, args.k)
+        latencies.append(elapsed)
+        ours.append(ids)
+    result["p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+    result["p99_ms"] = float(np.percentile(latencies, 99) * 1000)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        index.save(tmp)
+        result["disk_mb"] = directory_size(tmp) / 2 ** 20
+        loaded, result["load_s"] = timed(BM25Index.load, tmp)
+        assert all(np.array_equal(loaded.top_k(q, args.k)[0], ids) for q, ids in zip(queries[:5], ours[:5]))
+    finally:
+        shutil.rmtree(tmp)
+
+    if compare:
+        okapi, result["okapi_build_s"] = timed(BM25Okapi, docs)
+        okapi_latencies = []
+        exact = 0
+        overlap = []
+        max_diff = 0.0
+        for q, ids in zip(queries, ours):
+            (ref, scores), elapsed = timed(okapi_top_k, okapi, q, args.k)
+            okapi_latencies.append(elapsed)
+            # float32 weights can swap near-ties, so compare scores as well as order
+            exact += int(np.array_equal(ref, ids) or np.allclose(scores[ref], scores[ids], rtol=1e-5))
+            overlap.append(len(set(ref.tolist()) & set(ids.tolist())) / max(1, len(ref)))
+            max_diff = max(max_diff, float(np.abs(index.get_scores(q) - scores).max()))
+        result["okapi_p50_ms"] = float(np.percentile(okapi_latencies, 50) * 1000)
+        result["okapi_p99_ms"] = float(np.percentile(okapi_latencies, 99) * 1000)
+        result["rank_match"] = exact / len(queries)
+        result["overlap"] = float(np.mean(overlap))
+        result["max_score_diff"] = max_diff
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--doc-len", type=int, default=80, help="Mean tokens per chunk")
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--okapi-max", type=int, default=None, help="Skip BM25Okapi above this many docs (RAM)")
+    args = parser.parse_args()
+
+    header = (
+        f"{'docs':>9} {'build_s':>8} {'p50_ms':>7} {'p99_ms':>7} {'disk_mb':>8} {'load_s':>7} | "
+        f"{'okapi_build_s':>13} {'okapi_p50_ms':>12} {'okapi_p99_ms':>12} {'rank_match':>10} {'overlap':>7} {'max_diff':>9}"
+    )
+    print(header)
+    for n_docs in args.sizes:
+        r = bench_size(n_docs, args)
+        line = (
+            f"{r['docs']:>9} {r['build_s']:>8.2f} {r['p50_ms']:>7.2f} {r['p99_ms']:>7.2f} "
+            f"{r['disk_mb']:>8.1f} {r['load_s']:>7.3f} | "
+        )
+        if "okapi_build_s" in r:
+            line += (
+                f"{r['okapi_build_s']:>13.2f} {r['okapi_p50_ms']:>12.2f} {r['okapi_p99_ms']:>12.2f} "
+                f"{r['rank_match']:>10.2f} {r['overlap']:>7.2f} {r['max_score_diff']:>9.1e}"
+            )
+        else:
+            line += "(BM25Okapi skipped)"
+        print(line, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Columnar ChunkStore vs the old chunks.pkl on a synthetic corpus.
+
+Writes the same chunks both ways, then loads each in a fresh process and
+reports load time, resident memory added by the load, size on disk, and
+the latency of fetching what one /ask needs (8 chunks with metadata).
+Store pages touched by reads count towards RSS but are file-backed page
+cache the kernel can drop; `anon_added_mb` is the memory that cannot.
+
+    python benchmark_chunk_store.py --chunks 1000000 --words 400
+"""
+import argparse
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from chunk_store import ChunkStore
+from pdf_pipeline import rss_mb
+
+
+def synthetic_chunks(n_chunks, words, vocab_size=20000, pages_per_doc=1000, seed=0):
+    """Chunk texts sliced from one random word stream, with page / document metadata."""
+    rng = np.random.default_rng(seed)
+    vocab = np.array([f"w{i}" for i in range(vocab_size)])
+    stream = " ".join(vocab[rng.integers(0, vocab_size, 2_000_000)])
+    approx = words * 6
+    starts = rng.integers(0, len(stream) - 2 * approx, n_chunks)
+    lengths = rng.integers(approx // 2, approx * 3 // 2, n_chunks)
+    texts = [stream[s:s + n] for s, n in zip(starts.tolist(), lengths.tolist())]
+    pages = [(i // 4) % pages_per_doc + 1 for i in range(n_chunks)]
+    docs = [f"manual-{i // (4 * pages_per_doc)}.pdf" for i in range(n_chunks)]
+    return texts, pages, docs
+
+
+def write_both(path, texts, pages, docs):
+    meta = [{"page": p, "doc_id": d, "source": d} for p, d in zip(pages, docs)]
+    start = time.perf_counter()
+    with open(os.path.join(path, "chunks.pkl"), "wb") as f:
+        pickle.dump({"chunks": texts, "meta": meta}, f)
+    pickle_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ChunkStore.from_lists(texts, meta).save(os.path.join(path, "chunks"))
+    store_s = time.perf_counter() - start
+    return pickle_s, store_s
+
+
+def anon_rss_mb():
+    """Resident memory not backed by files (mapped store pages are file-backed and reclaimable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            fields = f.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def measure(kind, path, n_rows, trials=1000, k=8):
+    """Run in a fresh process: load one format and time /ask-sized random reads."""
+    baseline, anon_baseline = rss_mb(), anon_rss_mb()
+    start = time.perf_counter()
+    if kind == "pickle":
+        with open(os.path.join(path, "chunks.pkl"), "rb") as f:
+            data = pickle.load(f)
+        chunks, meta = data["chunks"], data["meta"]
+        fetch = lambda row: (chunks[row], meta[row])
+    else:
+        store = ChunkStore.load(os.path.join(path, "chunks"))
+        fetch = lambda row: (store[row], store.meta(row))
+    load_s = time.perf_counter() - start
+    loaded, anon_loaded = rss_mb(), anon_rss_mb()
+
+    rng = np.random.default_rng(0)
+    latencies = []
+    for rows in rng.integers(0, n_rows, (trials, k)).tolist():
+        start = time.perf_counter()
+        for row in rows:
+            fetch(row)
+        latencies.append(time.perf_counter() - start)
+    return {
+        "format": kind,
+        "load_s": round(load_s, 3),
+        "rss_added_mb": round(loaded - baseline, 1) if loaded is not None else None,
+        "anon_added_mb": round(anon_loaded - anon_baseline, 1) if anon_loaded is not None else None,
+        "rss_after_reads_mb": round(rss_mb() - baseline, 1) if loaded is not None else None,
+        f"fetch_{k}_p50_us": round(float(np.percentile(latencies, 50)) * 1e6, 1),
+        f"fetch_{k}_p99_us": round(float(np.percentile(latencies, 99)) * 1e6, 1)
+    }
+
+
+def disk_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 2 ** 20
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=1_000_000)
+    parser.add_argument("--words", type=int, default=400, help="Average words per chunk")
+    parser.add_argument("--dir", help="Work directory (default: a temp dir, removed afterwards)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--child", nargs=3, metavar=("FORMAT", "PATH", "ROWS"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, path, n_rows = args.child
+        print(json.dumps(measure(kind, path, int(n_rows))))
+        return
+
+    path = args.dir or tempfile.mkdtemp(prefix="chunk-store-bench-")
+    os.makedirs(path, exist_ok=True)
+    try:
+        texts, pages, docs = synthetic_chunks(args.chunks, args.words)
+        text_mb = sum(len(t) for t in texts) / 2 ** 20
+        pickle_s, store_s = write_both(path, texts, pages, docs)
+        del texts, pages, docs
+        print(f"{args.chunks} chunks, ~{args.words} words each, {text_mb:.0f} MB of text\n")
+
+        results = []
+        for kind, write_s, disk in (
+            ("pickle", pickle_s, disk_mb(os.path.join(path, "chunks.pkl"))),
+            ("store", store_s, disk_mb(os.path.join(path, "chunks")))
+        ):
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", kind, path, str(args.chunks)],
+                check=True, capture_output=True, text=True
+            )
+            row = json.loads(out.stdout)
+            row["write_s"] = round(write_s, 2)
+            row["disk_mb"] = round(disk, 1)
+            results.append(row)
+
+        columns = list(results[0])
+        print("  ".join(f"{c:>18}" for c in columns))
+        for row in results:
+            print("  ".join(f"{str(row[c]):>18}" for c in columns))
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"chunks": args.chunks, "words": args.words, "text_mb": round(text_mb, 1), "results": results}, f, indent=2)
+    finally:
+        if not args.dir:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
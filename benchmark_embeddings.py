@@ -0,0 +1,151 @@
+"""
+Embedding client throughput benchmark against a local mock Azure endpoint.
+
+Starts an HTTP server that imitates the Azure OpenAI embeddings API,
+including a tokens-per-minute limit that answers 429 with retry-after-ms,
+and runs the EmbeddingClient with different batch and concurrency settings.
+
+    python benchmark_embeddings.py --texts 2000 --tpm 600000 --latency 0.15
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from openai import AzureOpenAI
+
+from embeddings import EmbeddingClient, estimate_tokens
+
+DIM = 1536
+
+
+class MockEmbeddingServer(ThreadingHTTPServer):
+    """Azure-style /embeddings endpoint with latency and a token-bucket rate limit."""
+
+    daemon_threads = True
+
+    def __init__(self, tpm, latency, per_item_latency):
+        super().__init__(("127.0.0.1", 0), MockEmbeddingHandler)
+        self.tpm = tpm
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    def take(self, tokens):
+        """Consume tokens from the bucket, or return seconds until enough refill."""
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.tokens = min(self.tpm, self.tokens + (now - self.updated) * self.tpm / 60)
+            self.updated = now
+            if tokens <= self.tokens:
+                self.tokens -= tokens
+                return 0.0
+            self.throttled += 1
+            return (tokens - self.tokens) * 60 / self.tpm
+
+
+class MockEmbeddingHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        tokens = sum(estimate_tokens(t) for t in texts)
+
+        wait = self.server.take(tokens)
+        if wait:
+            payload = json.dumps({"error": {"code": "429", "message": "Rate limit exceeded"}}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("retry-after-ms", str(int(wait * 1000) + 1))
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        time.sleep(self.server.latency + self.server.per_item_latency * len(texts))
+        data = []
+        for i, text in enumerate(texts):
+            rng = np.random.default_rng(abs(hash(text)) % (2 ** 32))
+            data.append({"object": "embedding", "index": i, "embedding": rng.standard_normal(DIM).astype("float32").round(5).tolist()})
+        payload = json.dumps({
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def legacy_embed(client, texts, batch_size=10):
+    """The previous get_embeddings loop: fixed 10-item batches with a 1 s sleep between them."""
+    out = []
+    for i in range(0, len(texts), batch_size):
+        response = client.embeddings.create(model="mock", input=texts[i:i + batch_size])
+        out.extend(item.embedding for item in response.data)
+        if i + batch_size < len(texts):
+            time.sleep(1)
+    return np.asarray(out, dtype="float32")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--texts", type=int, default=1000, help="Number of 400-word chunks to embed")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="Mock tokens-per-minute limit")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mock per-request latency (s)")
+    parser.add_argument("--per-item-latency", type=float, default=0.001, help="Mock latency per input (s)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--batch-tokens", type=int, nargs="+", default=[8000, 20000, 60000])
+    parser.add_argument("--legacy", action="store_true", help="Also time the old sleep-based loop")
+    args = parser.parse_args()
+
+    server = MockEmbeddingServer(args.tpm, args.latency, args.per_item_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = AzureOpenAI(
+        api_key="mock",
+        azure_endpoint=f"http://127.0.0.1:{server.server_address[1]}",
+        api_version="2024-02-15-preview"
+    )
+
+    rng = np.random.default_rng(0)
+    vocab = [f"word{i}" for i in range(5000)]
+    texts = [" ".join(rng.choice(vocab, 400)) for _ in range(args.texts)]
+    print(f"{len(texts)} texts, ~{sum(estimate_tokens(t) for t in texts)} tokens, mock limit {args.tpm} TPM\n")
+
+    if args.legacy:
+        start = time.perf_counter()
+        legacy_embed(client.with_options(max_retries=6), texts)
+        elapsed = time.perf_counter() - start
+        print(f"legacy loop: {elapsed:.2f}s ({len(texts) / elapsed:.1f} texts/s)\n")
+
+    print(f"{'concurrency':>11} {'batch_tokens':>12} {'seconds':>8} {'texts/s':>8} {'tokens/s':>9} {'requests':>8} {'retries':>7}")
+    for concurrency in args.concurrency:
+        for batch_tokens in args.batch_tokens:
+            embedder = EmbeddingClient(client, "mock", max_batch_tokens=batch_tokens, concurrency=concurrency)
+            out = embedder.embed(texts)
+            assert out.shape == (len(texts), DIM)
+            run = embedder.last_run
+            print(
+                f"{concurrency:>11} {batch_tokens:>12} {run['seconds']:>8.2f} {run['texts_per_second']:>8.1f} "
+                f"{run['tokens_per_second']:>9.0f} {run['requests']:>8} {run['retries']:>7}"
+            )
+            embedder.executor.shutdown()
+
+    print(f"\nmock server: {server.requests} requests, {server.throttled} throttled")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Filtered retrieval benchmark: metadata filters against full search.
+
+Builds a synthetic corpus (see benchmark_retrieval.py) split into
+--docs documents, each with an outline of one chapter per
+--chapter-pages pages, and serves it as the live snapshot. Every
+question is then searched without a filter and with filters of
+decreasing width:
+
+    wide       first half of the pages of every document
+    document   one document
+    chapter    one chapter of one document
+    pages      three pages of one document
+
+For each it reports the share of the corpus the filter keeps, the
+search path taken ("exact" over the filter's rows up to
+FILTER_EXACT_ROWS, else "selector"), vector-only and hybrid latency
+(p50/p95 ms) and batched QPS. It also reports how a post-filter does
+instead: the full top 20 cut down to the filter's rows, which keeps
+`postfilter_hits` of the 8 chunks a filtered search returns.
+
+    python benchmark_filters.py --size 50000 --docs 10
+    python benchmark_filters.py --size 200000 --exact-rows 50000 --json filters.json
+"""
+import os
+
+# app builds its API clients at import; the local stand-ins replace them
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+import app
+import local_models
+from benchmark_retrieval import build_snapshot, percentiles, synthetic_pages
+from chunk_store import ChunkStore
+from metadata_index import make_filter
+from snapshot import Snapshot
+
+
+def split_documents(snap, n_docs, chapter_pages):
+    """The same rows as `snap` spread over `n_docs` documents with chapter outlines."""
+    (doc_id, doc), = snap.documents.items()
+    page_numbers = sorted(doc["pages"])
+    per_doc = -(-len(page_numbers) // n_docs)
+    store = ChunkStore()
+    documents = {}
+    for d in range(n_docs):
+        doc_pages = page_numbers[d * per_doc:(d + 1) * per_doc]
+        if not doc_pages:
+            break
+        name = f"manual-{d:02d}.pdf"
+        registry = {}
+        for local_page, page_no in enumerate(doc_pages, 1):
+            entry = doc["pages"][page_no]
+            rows = entry["rows"]
+            store.add([snap.chunks[r] for r in rows], [local_page] * len(rows), name, name)
+            registry[local_page] = entry
+        documents[name] = {
+            "source": name,
+            "pages": registry,
+            "page_count": len(doc_pages),
+            "outline": [
+                {"title": f"Chapter {c + 1}", "level": 0, "page": first}
+                for c, first in enumerate(range(1, len(doc_pages) + 1, chapter_pages))
+            ]
+        }
+    return Snapshot(snap.index, store, snap.bm25, snap.embeddings, documents, {"version": "bench-filters"})
+
+
+def bench(questions, q_embs, hybrid, filters, repeat):
+    def search(i, j):
+        if hybrid:
+            return app.hybrid_retrieve_batch(questions[i:j], q_embs[i:j], filters=filters)
+        return app.vector_retrieve_batch(q_embs[i:j], filters=filters)
+
+    search(0, 1)  # warm-up: resolves the filter and builds its sub-index
+    seconds = []
+    for _ in range(repeat):
+        for i in range(len(questions)):
+            start = time.perf_counter()
+            search(i, i + 1)
+            seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    hits = search(0, len(questions))
+    batch_seconds = time.perf_counter() - start
+    result = percentiles(seconds)
+    result["batch_qps"] = round(len(questions) / batch_seconds, 1)
+    return result, hits
+
+
+def postfilter_hits(q_embs, rows, filtered):
+    """Mean chunks a post-filter of the full top 20 keeps, against the filtered search's."""
+    allowed = set(rows.tolist())
+    full = app.vector_retrieve_batch(q_embs, k=20)
+    kept = [len([i for i in ids if i in allowed][:8]) for ids, _ in full]
+    return round(float(np.mean(kept)), 2), round(float(np.mean([len(ids) for ids, _ in filtered])), 2)
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    local_models.install(app, dim=args.dim)
+    app.FILTER_EXACT_ROWS = args.exact_rows
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+    pages, _ = synthetic_pages(args.size, questions, seed=args.seed)
+    snap, _ = build_snapshot(pages)
+    del pages
+    app.snapshot = snap = split_documents(snap, args.docs, args.chapter_pages)
+    q_embs = app.get_embeddings(questions)
+
+    start = time.perf_counter()
+    snap.metadata
+    index_seconds = time.perf_counter() - start
+    first = next(iter(snap.documents))
+    page_count = snap.documents[first]["page_count"]
+    filters = [
+        ("none", None),
+        ("wide", make_filter(page_to=page_count // 2)),
+        ("document", make_filter(doc_ids=[first])),
+        ("chapter", make_filter(doc_ids=[first], sections=["chapter 2"])),
+        ("pages", make_filter(doc_ids=[first], page_from=5, page_to=7))
+    ]
+    print(f"{len(snap.chunks)} chunks in {len(snap.documents)} documents ({app.FAISS_INDEX} index), "
+          f"metadata index built in {index_seconds * 1000:.1f} ms, FILTER_EXACT_ROWS={app.FILTER_EXACT_ROWS}\n")
+    print(f"{'filter':>9} {'rows':>8} {'share':>6} {'path':>9} {'vec p50':>8} {'vec p95':>8} {'vec qps':>8} "
+          f"{'hyb p50':>8} {'hyb p95':>8} {'hyb qps':>8} {'post/filtered hits':>19}")
+
+    results = []
+    for name, row_filter in filters:
+        rows = snap.metadata.rows(row_filter) if row_filter is not None else snap.chunks.live_rows()
+        path = "full" if row_filter is None else "exact" if len(rows) <= app.FILTER_EXACT_ROWS else "selector"
+        vector, hits = bench(questions, q_embs, False, row_filter, args.repeat)
+        hybrid, _ = bench(questions, q_embs, True, row_filter, args.repeat)
+        post, filtered = postfilter_hits(q_embs, rows, hits) if row_filter is not None else (None, None)
+        r = {
+            "filter": name,
+            "rows": len(rows),
+            "share": round(len(rows) / len(snap.chunks), 4),
+            "path": path,
+            "vector": vector,
+            "hybrid": hybrid,
+            "postfilter_hits": post,
+            "filtered_hits": filtered
+        }
+        results.append(r)
+        hits_column = f"{post} / {filtered}" if post is not None else "-"
+        print(f"{name:>9} {r['rows']:>8} {r['share']:>6} {path:>9} {vector['p50_ms']:>8} {vector['p95_ms']:>8} "
+              f"{vector['batch_qps']:>8} {hybrid['p50_ms']:>8} {hybrid['p95_ms']:>8} {hybrid['batch_qps']:>8} "
+              f"{hits_column:>19}")
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        config.update(chunks=len(snap.chunks), faiss_index=app.FAISS_INDEX,
+                      metadata_index_ms=round(index_seconds * 1000, 1))
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--size", type=int, default=50000, help="Corpus size in chunks")
+    parser.add_argument("--docs", type=int, default=10, help="Documents the corpus is split into")
+    parser.add_argument("--chapter-pages", type=int, default=20, help="Pages per outline chapter")
+    parser.add_argument("--exact-rows", type=int, default=int(os.getenv("FILTER_EXACT_ROWS", "20000")),
+                        help="FILTER_EXACT_ROWS")
+    parser.add_argument("--dim", type=int, default=local_models.DIM, help="Dimension of the local embedding")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the questions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    main(parser.parse_args())
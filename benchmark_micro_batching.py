@@ -0,0 +1,159 @@
+"""
+Load test of question micro-batching: QPS gained against latency added.
+
+Runs in-process like benchmark_retrieval.py: a synthetic corpus is
+embedded with the local stand-ins (local_models.py) and served as the
+live snapshot, and `--clients` concurrent clients call the /ask handler
+in a closed loop for `--seconds` each. The stand-in embedding API sleeps
+`--embed-latency` seconds per request and the embedding client allows
+EMBED_CONCURRENCY requests at once, as with Azure OpenAI, so unbatched
+questions queue for embedding slots under load.
+
+Every run of the grid is repeated with micro-batching off and with each
+--max-batch x --wait-ms setting, and reports:
+
+    qps             answered questions per second over all clients
+    latency         p50/p95/p99 ms per question
+    batch_wait      mean ms a question waited for its batch to start
+    mean_batch      questions per retrieval batch
+    embed_requests  embedding API requests per question
+    deduplicated    questions served by an identical one in flight
+
+--hot-rate sends that share of questions from a small set of popular
+questions, to exercise deduplication.
+
+    python benchmark_micro_batching.py --clients 1 8 32 64
+    python benchmark_micro_batching.py --max-batch 16 64 --wait-ms 1 5 --json batching.json
+"""
+import os
+
+# app builds its API clients at import; the local stand-ins replace them
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+import app
+import local_models
+from benchmark_retrieval import build_snapshot, percentiles, synthetic_pages
+from micro_batcher import MicroBatcher
+
+
+async def load(questions, clients, seconds, use_hybrid, hot, hot_rate, seed):
+    """Closed-loop load: each client sends its next question as soon as the previous one is answered."""
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    async def client(n):
+        rng = random.Random(seed * 1000 + n)
+        while time.perf_counter() < deadline:
+            question = rng.choice(hot) if hot and rng.random() < hot_rate else rng.choice(questions)
+            start = time.perf_counter()
+            await app.ask(app.Ask(question=question, use_hybrid=use_hybrid))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in range(clients)))
+    return latencies, time.perf_counter() - start
+
+
+def stage_mean_ms(stage):
+    """Mean of a stage histogram since the last reset, in ms."""
+    series = app.stage_seconds.series.get((stage,))
+    return round(series[-2] / series[-1] * 1000, 3) if series else 0.0
+
+
+def run(questions, clients, setting, args):
+    max_batch, wait_ms = setting
+    app.question_batcher = MicroBatcher(app.run_question_batch, max_batch, wait_ms / 1000) if max_batch else None
+    app.stage_seconds.series = {}
+    embed_before = app.embedder.throughput()["requests"]
+    hot = questions[:args.hot_questions] if args.hot_rate else []
+
+    latencies, elapsed = asyncio.run(
+        load(questions, clients, args.seconds, args.hybrid, hot, args.hot_rate, args.seed)
+    )
+    embed_requests = app.embedder.throughput()["requests"] - embed_before
+    stats = app.question_batcher.stats() if app.question_batcher is not None else None
+    result = {
+        "clients": clients,
+        "max_batch": max_batch,
+        "wait_ms": wait_ms,
+        "questions": len(latencies),
+        "qps": round(len(latencies) / elapsed, 1),
+        **percentiles(latencies),
+        "batch_wait_ms": stage_mean_ms("batch_wait"),
+        "mean_batch": stats["mean_batch_size"] if stats else 1.0,
+        "embed_requests": round(embed_requests / max(1, len(latencies)), 3),
+        "deduplicated": stats["deduplicated"] if stats else 0
+    }
+    return result
+
+
+def print_results(rows):
+    print(f"{'clients':>7} {'batching':>12} {'qps':>8} {'gain':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'wait ms':>8} {'batch':>6} {'emb/q':>6} {'dedup':>6}")
+    baseline = {}
+    for r in rows:
+        if not r["max_batch"]:
+            baseline[r["clients"]] = r
+        base = baseline.get(r["clients"])
+        gain = f"{r['qps'] / base['qps']:.2f}x" if base and base["qps"] else "-"
+        setting = f"{r['max_batch']}/{r['wait_ms']:g}ms" if r["max_batch"] else "off"
+        print(f"{r['clients']:>7} {setting:>12} {r['qps']:>8} {gain:>6} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['batch_wait_ms']:>8} {r['mean_batch']:>6} {r['embed_requests']:>6} "
+              f"{r['deduplicated']:>6}")
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    local_models.install(app, dim=args.dim, embed_latency=args.embed_latency)
+    app.REFUSAL_THRESHOLD = -1.0
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+    pages, _ = synthetic_pages(args.size, questions, seed=args.seed)
+    app.snapshot, timings = build_snapshot(pages)
+    print(f"Corpus: {app.snapshot.index.ntotal} chunks ({timings['embed_seconds']}s embedding), "
+          f"{'hybrid' if args.hybrid else 'vector-only'} retrieval, {args.embed_latency * 1000:g} ms per "
+          f"embedding request, {app.embedder.concurrency} concurrent requests\n")
+
+    settings = [(0, 0.0)] + [(b, w) for b in args.max_batch for w in args.wait_ms]
+    rows = []
+    for clients in args.clients:
+        for setting in settings:
+            rows.append(run(questions, clients, setting, args))
+    print_results(rows)
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        config["faiss_index"] = app.FAISS_INDEX
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": rows}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--size", type=int, default=10000, help="Corpus size in chunks")
+    parser.add_argument("--dim", type=int, default=local_models.DIM, help="Dimension of the local embedding")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32, 64], help="Concurrent clients")
+    parser.add_argument("--max-batch", type=int, nargs="+", default=[32], help="QUESTION_BATCH_MAX values")
+    parser.add_argument("--wait-ms", type=float, nargs="+", default=[2.0], help="QUESTION_BATCH_WAIT_MS values")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Duration of each run")
+    parser.add_argument("--embed-latency", type=float, default=0.03, help="Seconds per embedding request")
+    parser.add_argument("--hybrid", action="store_true", help="Level 2 hybrid retrieval")
+    parser.add_argument("--hot-rate", type=float, default=0.0, help="Share of questions from the popular set")
+    parser.add_argument("--hot-questions", type=int, default=5, help="Size of the popular set")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    main(parser.parse_args())
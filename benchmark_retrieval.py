@@ -0,0 +1,365 @@
+"""
+Offline retrieval benchmark: latency, throughput, memory and quality.
+
+Runs entirely in-process, with no server, Azure account or network: the
+app's embedding and chat clients are replaced by the deterministic local
+stand-ins in local_models.py (with EMBEDDING_BACKEND=onnx the local model
+embeds instead of the stand-in). For each corpus size a synthetic manual is
+generated, chunked and embedded the way /ingest does it, and built into a
+Snapshot (FAISS index of FAISS_INDEX type, ChunkStore, BM25Index).
+
+Every question in questions.json gets a gold page: a page of the corpus
+about the question's terms that also states them in one sentence. Other
+pages share part of the same terms as distractors. Per corpus size and
+retrieval mode (vector-only, and hybrid with each --fusion mode:
+"hybrid" is embed_rerank, then "hybrid-rrf" and "hybrid-weighted") it
+reports:
+
+    search      `vector_retrieve_batch` / `hybrid_retrieve` latency for
+                one question (p50/p95/p99 ms), single-stream QPS and QPS
+                of one batched call over all questions
+    ask         end-to-end `/ask` handler latency (embedding, retrieval,
+                packing, stub LLM)
+    quality     recall@1/3/8 and MRR of the gold page
+    memory      RSS added by the snapshot and the size of its embeddings
+
+Results are written as JSON (--json) so runs can be diffed; --compare
+checks a run against an earlier file and exits non-zero on a regression.
+
+    python benchmark_retrieval.py --sizes 1000 10000 50000 --json bench.json
+    python benchmark_retrieval.py --json new.json --compare bench.json
+"""
+import os
+
+# app builds its API clients at import; the local stand-ins replace them
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import resource
+import sys
+import time
+
+import numpy as np
+
+import app
+import local_models
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from fusion import FUSION_MODES
+from pdf_pipeline import page_hash, rss_mb
+from snapshot import Snapshot
+
+RECALL_AT = (1, 3, 8)
+DOC_ID = "synthetic"
+
+
+def filler_vocab(size=20000, seed=0):
+    """Pronounceable pseudo-words with Zipf probabilities, so filler never matches a question term."""
+    rng = np.random.default_rng(seed)
+    syllables = np.array(["ka", "lo", "mi", "ru", "te", "sa", "no", "vi", "pe", "dra", "qu", "zo", "bel", "tix"])
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables, rng.integers(2, 5))))
+    ranks = np.arange(1, size + 1)
+    probs = 1.0 / ranks
+    return np.array(sorted(words)), probs / probs.sum()
+
+
+def synthetic_pages(n_chunks, questions, words_per_page=500, topic_rate=0.15, distractors=3, seed=0):
+    """
+    Page texts of a synthetic manual with one gold page per question.
+
+    Every page mixes Zipf filler with its own topic terms (`topic_rate` of
+    its words). A question's gold page has the question's terms as topic
+    and also states them in one sentence; its distractor pages share part
+    of those terms; all other pages draw their topic from the terms of the
+    whole question set, so every question has lexical near-misses.
+
+    Returns:
+        (page texts, gold page number per question); pages are numbered from 1
+    """
+    rng = np.random.default_rng(seed)
+    vocab, probs = filler_vocab(seed=seed)
+    question_terms = [local_models.terms(q) for q in questions]
+    pool = sorted({t for ts in question_terms for t in ts})
+    stride = app.CHUNK_SIZE - app.CHUNK_OVERLAP
+    chunks_per_page = max(1, -(-(words_per_page - app.CHUNK_OVERLAP) // stride))
+    n_pages = max(len(questions) * (distractors + 1), n_chunks // chunks_per_page)
+
+    topics = [list(rng.choice(pool, 8)) for _ in range(n_pages)]
+    # Gold and distractor pages of different questions never coincide
+    chosen = rng.permutation(n_pages)[:len(questions) * (distractors + 1)]
+    gold = []
+    for i, ts in enumerate(question_terms):
+        topics[chosen[i]] = ts
+        for page in chosen[len(questions) + i * distractors:len(questions) + (i + 1) * distractors]:
+            shared = list(rng.permutation(ts)[:max(1, len(ts) * 2 // 5)])
+            topics[page] = shared + list(rng.choice(pool, 4))
+        gold.append(int(chosen[i]) + 1)
+
+    pages = []
+    for topic in topics:
+        length = int(rng.integers(words_per_page * 3 // 4, words_per_page * 5 // 4))
+        words = vocab[rng.choice(len(vocab), size=length, p=probs)].astype(object)
+        on_topic = rng.random(length) < topic_rate
+        words[on_topic] = rng.choice(topic, int(on_topic.sum()))
+        pages.append(list(words))
+    for i, ts in enumerate(question_terms):
+        page = pages[chosen[i]]
+        at = int(rng.integers(0, len(page)))
+        page[at:at] = list(rng.permutation(ts)) + ["."]
+    return [" ".join(page) for page in pages], gold
+
+
+def build_snapshot(pages):
+    """Chunk, embed and index page texts the way /ingest does, without writing to disk."""
+    chunks, page_numbers = [], []
+    documents = {DOC_ID: {"source": f"{DOC_ID}.pdf", "pages": {}}}
+    for page_no, text in enumerate(pages, 1):
+        page_chunks = app.chunk_text(text)
+        rows = list(range(len(chunks), len(chunks) + len(page_chunks)))
+        documents[DOC_ID]["pages"][page_no] = {"hash": page_hash(text), "rows": rows}
+        chunks.extend(page_chunks)
+        page_numbers.extend([page_no] * len(page_chunks))
+
+    start = time.perf_counter()
+    embeddings = np.vstack([
+        app.get_embeddings(chunks[i:i + app.INGEST_EMBED_BATCH])
+        for i in range(0, len(chunks), app.INGEST_EMBED_BATCH)
+    ])
+    embed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = ChunkStore()
+    store.add(chunks, page_numbers, DOC_ID, f"{DOC_ID}.pdf")
+    ids = np.arange(len(chunks), dtype="int64")
+    index = app.build_vector_index(embeddings, ids, app.next_index_spec(len(chunks), embeddings.shape[1]))
+    bm25 = BM25Index()
+    bm25.add_documents([chunk.lower().split() for chunk in chunks])
+    build_seconds = time.perf_counter() - start
+
+    snap = Snapshot(index, store, bm25, embeddings, documents, {"version": f"bench-{len(chunks)}"})
+    return snap, {"embed_seconds": round(embed_seconds, 3), "build_seconds": round(build_seconds, 3)}
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}
+
+
+def gold_rank(snap, ids, gold_page):
+    """1-based rank of the first retrieved chunk from the gold page, or None."""
+    for rank, row in enumerate(ids, 1):
+        if snap.chunks.meta(row)["page"] == gold_page:
+            return rank
+    return None
+
+
+def quality(snap, hits, gold):
+    ranks = [gold_rank(snap, ids, page) for (ids, _), page in zip(hits, gold)]
+    out = {f"recall@{k}": round(sum(r is not None and r <= k for r in ranks) / len(ranks), 4) for k in RECALL_AT}
+    out["mrr"] = round(sum(1 / r for r in ranks if r is not None) / len(ranks), 4)
+    return out
+
+
+def bench_search(snap, fusion, questions, q_embs, repeat):
+    """
+    Single-question latency over `repeat` passes, then one batched call for all questions.
+
+    `fusion` is the hybrid fusion mode, None for vector-only retrieval.
+    """
+    def search_one(i):
+        if fusion:
+            return app.hybrid_retrieve(questions[i], q_emb=q_embs[i:i + 1], fusion=fusion)
+        return app.vector_retrieve_batch(q_embs[i:i + 1], snap=snap)[0]
+
+    search_one(0)  # warm-up
+    seconds = []
+    hits = []
+    for r in range(repeat):
+        for i in range(len(questions)):
+            start = time.perf_counter()
+            hit = search_one(i)
+            seconds.append(time.perf_counter() - start)
+            if r == 0:
+                hits.append(hit)
+
+    start = time.perf_counter()
+    if fusion:
+        app.hybrid_retrieve_batch(questions, q_embs, snap=snap, fusion=fusion)
+    else:
+        app.vector_retrieve_batch(q_embs, snap=snap)
+    batch_seconds = time.perf_counter() - start
+
+    result = percentiles(seconds)
+    result["qps"] = round(len(seconds) / sum(seconds), 1)
+    result["batch_qps"] = round(len(questions) / batch_seconds, 1)
+    return result, hits
+
+
+async def bench_ask(questions, fusion, repeat):
+    """End-to-end /ask handler latency, one question at a time."""
+    seconds = []
+    refused = 0
+    for _ in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            result = await app.ask(app.Ask(question=question, use_hybrid=fusion is not None, fusion=fusion))
+            seconds.append(time.perf_counter() - start)
+            refused += app.REFUSAL in result["answer"]
+    result = percentiles(seconds)
+    result["qps"] = round(len(seconds) / sum(seconds), 1)
+    result["refused"] = refused // repeat
+    return result
+
+
+def run_size(n_chunks, questions, args):
+    gc.collect()
+    rss_before = rss_mb()
+    pages, gold = synthetic_pages(n_chunks, questions, args.words_per_page, args.topic_rate, seed=args.seed)
+    snap, timings = build_snapshot(pages)
+    del pages
+    gc.collect()
+    rss_after = rss_mb()
+
+    app.snapshot = snap
+    q_embs = app.get_embeddings(questions)
+    result = {
+        "chunks": len(snap.chunks),
+        "pages": len(snap.documents[DOC_ID]["pages"]),
+        "index": app.describe(snap.index),
+        **timings,
+        "memory": {
+            "rss_added_mb": round(rss_after - rss_before, 1) if rss_before is not None else None,
+            "embeddings_mb": round(snap.embeddings.nbytes / 2 ** 20, 1)
+        },
+        "modes": {}
+    }
+    modes = [("vector", None)]
+    modes += [("hybrid" if f == "embed_rerank" else f"hybrid-{f}", f) for f in args.fusion]
+    for mode, fusion in modes:
+        search, hits = bench_search(snap, fusion, questions, q_embs, args.repeat)
+        entry = {"search": search, "quality": quality(snap, hits, gold)}
+        if not args.no_ask:
+            entry["ask"] = asyncio.run(bench_ask(questions, fusion, max(1, args.repeat // 2)))
+        result["modes"][mode] = entry
+    app.snapshot = None
+    return result
+
+
+def print_size(result):
+    print(f"\n{result['chunks']} chunks / {result['pages']} pages ({result['index']}), "
+          f"embed {result['embed_seconds']}s, build {result['build_seconds']}s, "
+          f"+{result['memory']['rss_added_mb']} MB RSS")
+    header = f"{'mode':<16} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'qps':>8} {'batch qps':>10}"
+    header += "".join(f" {'R@' + str(k):>6}" for k in RECALL_AT) + f" {'MRR':>6} {'ask p95':>8}"
+    print(header)
+    for mode, entry in result["modes"].items():
+        s, q = entry["search"], entry["quality"]
+        line = f"{mode:<16} {s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['qps']:>8} {s['batch_qps']:>10}"
+        line += "".join(f" {q[f'recall@{k}']:>6}" for k in RECALL_AT) + f" {q['mrr']:>6}"
+        line += f" {entry['ask']['p95_ms'] if 'ask' in entry else '-':>8}"
+        print(line)
+
+
+def compare(results, baseline, latency_tolerance, quality_tolerance):
+    """Regressions of `results` against an earlier run: slower p95 beyond the tolerance or lower quality."""
+    regressions = []
+    old_sizes = {str(r["chunks"]): r for r in baseline["results"]}
+    for result in results:
+        old = old_sizes.get(str(result["chunks"]))
+        if old is None:
+            continue
+        for mode, entry in result["modes"].items():
+            old_entry = old["modes"].get(mode)
+            if old_entry is None:
+                continue
+            for part in ("search", "ask"):
+                if part in entry and part in old_entry:
+                    new_p95, old_p95 = entry[part]["p95_ms"], old_entry[part]["p95_ms"]
+                    if new_p95 > old_p95 * (1 + latency_tolerance):
+                        regressions.append(f"{result['chunks']} chunks {mode} {part} p95 {old_p95} -> {new_p95} ms")
+            for metric, value in entry["quality"].items():
+                if value < old_entry["quality"][metric] - quality_tolerance:
+                    regressions.append(f"{result['chunks']} chunks {mode} {metric} "
+                                       f"{old_entry['quality'][metric]} -> {value}")
+    return regressions
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    local_models.install(app, dim=args.dim)
+    # Every question reaches the LLM stub; the score guard is calibrated for real embeddings
+    app.REFUSAL_THRESHOLD = -1.0
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+
+    results = []
+    for n_chunks in args.sizes:
+        result = run_size(n_chunks, questions, args)
+        print_size(result)
+        results.append(result)
+
+    report = {
+        "config": {
+            "questions": len(questions),
+            "sizes": args.sizes,
+            "words_per_page": args.words_per_page,
+            "topic_rate": args.topic_rate,
+            "chunk_size": app.CHUNK_SIZE,
+            "chunk_overlap": app.CHUNK_OVERLAP,
+            "faiss_index": app.FAISS_INDEX,
+            "embedder": app.embedder.info() if app.embedder.backend != "azure" else {"backend": "local_models", "dim": args.dim},
+            "fusion": args.fusion,
+            "rrf_k": app.RRF_K,
+            "fusion_vector_weight": app.FUSION_VECTOR_WEIGHT,
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        },
+        "results": results
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.latency_tolerance, args.quality_tolerance)
+        print(f"\nCompared with {args.compare}: {len(regressions) or 'no'} regressions")
+        for line in regressions:
+            print(f"  {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Corpus sizes in chunks")
+    parser.add_argument("--words-per-page", type=int, default=500)
+    parser.add_argument("--topic-rate", type=float, default=0.15, help="Share of topic terms in each page")
+    parser.add_argument("--dim", type=int, default=local_models.DIM, help="Dimension of the local embedding")
+    parser.add_argument("--repeat", type=int, default=5, help="Passes over the questions for latency percentiles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fusion", nargs="+", choices=FUSION_MODES, default=list(FUSION_MODES),
+                        help="Hybrid fusion modes to compare")
+    parser.add_argument("--no-ask", action="store_true", help="Skip the end-to-end /ask measurement")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--compare", help="Earlier --json output to check for regressions")
+    parser.add_argument("--latency-tolerance", type=float, default=0.25,
+                        help="Allowed p95 slowdown as a fraction (0.25 = 25%%)")
+    parser.add_argument("--quality-tolerance", type=float, default=0.01,
+                        help="Allowed drop in recall / MRR")
+    main(parser.parse_args())
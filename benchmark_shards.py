@@ -0,0 +1,178 @@
+"""
+Sharded retrieval benchmark: latency against shard count and corpus size.
+
+For each --sizes corpus a synthetic snapshot (see benchmark_retrieval.py)
+is written to a temporary vectorstore and served as the live snapshot.
+Every --shards count starts that many shard_server.py processes on it
+(0 = no shards, searched in this process) and runs the questions through
+`vector_retrieve_batch` and `hybrid_retrieve_batch` with SHARD_ADDRESSES
+pointing at them. Reports per mode:
+
+    latency     one question per search, p50/p95/p99 ms
+    batch_qps   questions per second of one batched call over all questions
+    exact       share of questions whose merged top k scores equal the
+                unsharded search at every rank, when shard count 0 is in
+                the run (chunks with tied scores may swap places). 1.0
+                with a flat index; IVF and HNSW shards are trained on
+                their own rows
+    build       slowest shard slice build (rows, index, BM25) in seconds
+    shard_mb    mean resident memory per shard process
+
+Each shard searches on its own process, so latency only drops with
+shards when the machine has a core per shard.
+
+    python benchmark_shards.py --sizes 20000 100000 --shards 0 1 2 4
+    python benchmark_shards.py --shards 0 4 --json shards.json
+
+Shards split rows by hash: the synthetic corpus is one document, which
+document sharding would keep on a single shard.
+"""
+import os
+
+# app builds its API clients at import; the local stand-ins replace them
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+
+import argparse
+import json
+import logging
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import app
+import local_models
+from benchmark_retrieval import build_snapshot, percentiles, synthetic_pages
+from sharding import ShardClient, export_slices, start_local_shards, wait_for_shards
+from snapshot import load_snapshot, write_snapshot
+
+AUTHKEY = b"benchmark-shards"
+
+
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def search(questions, q_embs, hybrid):
+    if hybrid:
+        return app.hybrid_retrieve_batch(questions, q_embs)
+    return app.vector_retrieve_batch(q_embs)
+
+
+def bench(questions, q_embs, hybrid, repeat):
+    """Single-question latency, batched QPS and the top k scores of every question."""
+    search(questions[:1], q_embs[:1], hybrid)  # warm-up
+    seconds = []
+    for _ in range(repeat):
+        for i in range(len(questions)):
+            start = time.perf_counter()
+            search(questions[i:i + 1], q_embs[i:i + 1], hybrid)
+            seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    hits = search(questions, q_embs, hybrid)
+    batch_seconds = time.perf_counter() - start
+    result = percentiles(seconds)
+    result["batch_qps"] = round(len(questions) / batch_seconds, 1)
+    return result, [np.round(scores, 5).tolist() for _, scores in hits]
+
+
+def run(root, n_shards, questions, q_embs, baseline, args):
+    processes = []
+    result = {"shards": n_shards}
+    try:
+        if n_shards:
+            export_slices(root, n_shards, "hash")
+            processes, addresses = start_local_shards(root, n_shards, "hash", base_port=args.base_port,
+                                                      authkey=AUTHKEY, poll_seconds=60.0)
+            app.shard_client = ShardClient(addresses, AUTHKEY)
+            status = wait_for_shards(app.shard_client, app.snapshot.version)
+            result["build_seconds"] = max(s["build_seconds"] for s in status)
+            result["rows"] = [s["rows"] for s in status]
+            result["shard_mb"] = round(np.mean([process_rss_mb(s["pid"]) for s in status]), 1)
+
+        for mode, hybrid in (("vector", False), ("hybrid", True)):
+            timing, hits = bench(questions, q_embs, hybrid, args.repeat)
+            if not n_shards:
+                baseline[mode] = hits
+            if mode in baseline:
+                timing["exact"] = round(float(np.mean([a == b for a, b in zip(hits, baseline[mode])])), 3)
+            result[mode] = timing
+        if n_shards:
+            stats = app.shard_client.stats()
+            if stats["errors"] or stats["version_mismatches"]:
+                result["fallbacks"] = stats["errors"] + stats["version_mismatches"]
+    finally:
+        if app.shard_client is not None:
+            app.shard_client.close()
+            app.shard_client = None
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+    return result
+
+
+def print_row(chunks, r):
+    v, h = r["vector"], r["hybrid"]
+    print(f"{chunks:>8} {r['shards']:>6} {v['p50_ms']:>8} {v['p95_ms']:>8} {v['batch_qps']:>9} "
+          f"{str(v.get('exact', '-')):>6} "
+          f"{h['p50_ms']:>8} {h['p95_ms']:>8} {h['batch_qps']:>9} {str(h.get('exact', '-')):>6} "
+          f"{str(r.get('build_seconds', '-')):>8} {str(r.get('shard_mb', '-')):>9}")
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    local_models.install(app, dim=args.dim)
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+    q_embs = app.get_embeddings(questions)
+
+    print(f"Hash sharding, {app.FAISS_INDEX} index, {os.cpu_count()} CPUs\n")
+    print(f"{'chunks':>8} {'shards':>6} {'vec p50':>8} {'vec p95':>8} {'vec qps':>9} {'exact':>6} "
+          f"{'hyb p50':>8} {'hyb p95':>8} {'hyb qps':>9} {'exact':>6} {'build s':>8} {'MB/shard':>9}")
+    results = []
+    for size in args.sizes:
+        pages, _ = synthetic_pages(size, questions, seed=args.seed)
+        snap, _ = build_snapshot(pages)
+        root = tempfile.mkdtemp(prefix="bench-shards-")
+        try:
+            write_snapshot(root, snap, app.snapshot_info(snap.index, snap.bm25))
+            # Serve the published copy, so the coordinator and shards agree on the version
+            app.snapshot = load_snapshot(root)
+            del snap, pages
+            baseline = {}
+            for n_shards in sorted(args.shards):
+                r = run(root, n_shards, questions, q_embs, baseline, args)
+                r["chunks"] = len(app.snapshot.chunks)
+                results.append(r)
+                print_row(r["chunks"], r)
+        finally:
+            app.snapshot = None
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        config.update(cpus=os.cpu_count(), faiss_index=app.FAISS_INDEX)
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20000], help="Corpus sizes in chunks")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4], help="Shard counts (0 = unsharded)")
+    parser.add_argument("--dim", type=int, default=local_models.DIM, help="Dimension of the local embedding")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over the questions")
+    parser.add_argument("--base-port", type=int, default=9100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    main(parser.parse_args())
@@ -0,0 +1,235 @@
+"""
+Multi-worker serving benchmark: memory and QPS against the worker count.
+
+Writes a synthetic snapshot (see benchmark_retrieval.py) to a temporary
+vectorstore, then for each --workers value starts `uvicorn --workers N`
+on it and keeps `--clients` /ask requests in flight for `--seconds`.
+The workers run the app with the local embedding and chat stand-ins
+(local_models.py), so no Azure account or network is needed. Reports:
+
+    qps        answered questions per second
+    latency    p50/p95/p99 ms per request
+    rss        summed resident memory of the workers; pages of the
+               shared snapshot files are counted once per worker
+    pss        summed proportional memory: shared pages are split between
+               the processes mapping them, so this is what N workers cost
+    private    memory no other process shares (per worker, mean)
+    reload     seconds from publishing a new snapshot until every worker
+               serves it (the SNAPSHOT_POLL_SECONDS generation check)
+
+Memory is read from /proc/<pid>/smaps_rollup, so Linux only.
+
+    python benchmark_workers.py --workers 1 2 4 --size 50000
+    python benchmark_workers.py --workers 4 --clients 64 --hybrid --json workers.json
+"""
+import os
+
+# app builds its API clients at import; the local stand-ins replace them
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+
+import argparse
+import asyncio
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import app as server
+import local_models
+from benchmark_retrieval import build_snapshot, percentiles, synthetic_pages
+from snapshot import publish_lock, write_snapshot
+
+if os.getenv("BENCH_WORKERS_SERVE") == "1":
+    # Imported by every uvicorn worker as benchmark_workers:app
+    logging.disable(logging.INFO)
+    local_models.install(server, dim=int(os.getenv("BENCH_DIM", str(local_models.DIM))),
+                         embed_latency=float(os.getenv("BENCH_EMBED_LATENCY", "0")))
+    server.REFUSAL_THRESHOLD = -1.0
+    app = server.app
+
+
+def smaps_mb(pid):
+    """Rss, Pss and private memory of one process in MB."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[name] = int(rest.split()[0]) / 1024
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "private": values["Private_Clean"] + values["Private_Dirty"]
+    }
+
+
+async def health_by_worker(url, workers, timeout=60.0):
+    """/health of every worker: new connections until `workers` distinct pids have answered."""
+    seen = {}
+    deadline = time.perf_counter() + timeout
+    limits = httpx.Limits(max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=10.0) as client:
+        while len(seen) < workers and time.perf_counter() < deadline:
+            try:
+                response = await client.get(f"{url}/health")
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+                continue
+            body = response.json()
+            seen[body["pid"]] = body
+    return seen
+
+
+async def wait_for_version(url, workers, version, timeout=60.0):
+    """Seconds until every worker serves snapshot `version`."""
+    start = time.perf_counter()
+    served = set()
+    limits = httpx.Limits(max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, timeout=10.0) as client:
+        while len(served) < workers and time.perf_counter() - start < timeout:
+            body = (await client.get(f"{url}/health")).json()
+            if (body.get("snapshot") or {}).get("version") == version:
+                served.add(body["pid"])
+            else:
+                await asyncio.sleep(0.05)
+    return round(time.perf_counter() - start, 3) if len(served) == workers else None
+
+
+async def load(url, questions, clients, seconds, use_hybrid):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client_loop(client, n):
+        nonlocal errors
+        i = n
+        while time.perf_counter() < deadline:
+            payload = {"question": questions[i % len(questions)], "use_hybrid": use_hybrid}
+            i += clients
+            start = time.perf_counter()
+            try:
+                response = await client.post(f"{url}/ask", json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, n) for n in range(clients)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def start_server(workdir, workers, args):
+    env = dict(
+        os.environ,
+        BENCH_WORKERS_SERVE="1",
+        BENCH_DIM=str(args.dim),
+        BENCH_EMBED_LATENCY=str(args.embed_latency),
+        SNAPSHOT_POLL_SECONDS=str(args.poll),
+        PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.getenv("PYTHONPATH")]))
+    )
+    command = [sys.executable, "-m", "uvicorn", "benchmark_workers:app", "--port", str(args.port),
+               "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(command, cwd=workdir, env=env)
+
+
+def run(workdir, snap, workers, questions, args):
+    url = f"http://127.0.0.1:{args.port}"
+    process = start_server(workdir, workers, args)
+    try:
+        started = asyncio.run(health_by_worker(url, workers))
+        if len(started) < workers or not all(h["store_ready"] for h in started.values()):
+            raise RuntimeError(f"Only {len(started)}/{workers} workers came up with the snapshot")
+
+        # Warm-up pass so every worker has touched the index pages it needs
+        asyncio.run(load(url, questions, args.clients, min(2.0, args.seconds), args.hybrid))
+        latencies, errors, elapsed = asyncio.run(load(url, questions, args.clients, args.seconds, args.hybrid))
+        memory = [smaps_mb(pid) for pid in started]
+
+        with publish_lock(server.VECTOR_DIR):
+            manifest = write_snapshot(server.VECTOR_DIR, snap, server.snapshot_info(snap.index, snap.bm25))
+        reload_seconds = asyncio.run(wait_for_version(url, workers, manifest["version"]))
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    result = {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "qps": round(len(latencies) / elapsed, 1),
+        **percentiles(latencies),
+        "rss_mb": round(sum(m["rss"] for m in memory), 1),
+        "pss_mb": round(sum(m["pss"] for m in memory), 1),
+        "private_mb_per_worker": round(sum(m["private"] for m in memory) / len(memory), 1),
+        "reload_seconds": reload_seconds
+    }
+    return result
+
+
+def main(args):
+    logging.disable(logging.INFO)
+    local_models.install(server, dim=args.dim)
+
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+    pages, _ = synthetic_pages(args.size, questions, seed=args.seed)
+    snap, _ = build_snapshot(pages)
+
+    workdir = tempfile.mkdtemp(prefix="bench-workers-")
+    try:
+        # Workers run in workdir and serve its vectorstore/
+        server.VECTOR_DIR = os.path.join(workdir, "vectorstore")
+        os.makedirs(server.VECTOR_DIR)
+        manifest = write_snapshot(server.VECTOR_DIR, snap, server.snapshot_info(snap.index, snap.bm25))
+        files_mb = sum(entry["bytes"] for entry in manifest["files"].values()) / 2 ** 20
+        print(f"Snapshot: {snap.index.ntotal} chunks, {files_mb:.1f} MB of files, "
+              f"{'hybrid' if args.hybrid else 'vector-only'} retrieval, {args.clients} clients, {os.cpu_count()} CPUs\n")
+
+        results = []
+        print(f"{'workers':>7} {'qps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MB':>8} {'pss MB':>8} "
+              f"{'priv/wkr':>9} {'reload s':>9}")
+        for workers in args.workers:
+            r = run(workdir, snap, workers, questions, args)
+            results.append(r)
+            print(f"{r['workers']:>7} {r['qps']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+                  f"{r['rss_mb']:>8} {r['pss_mb']:>8} {r['private_mb_per_worker']:>9} {str(r['reload_seconds']):>9}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != "json"}
+        config.update(chunks=snap.index.ntotal, snapshot_mb=round(files_mb, 1), cpus=os.cpu_count(),
+                      faiss_index=server.FAISS_INDEX)
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--size", type=int, default=20000, help="Corpus size in chunks")
+    parser.add_argument("--dim", type=int, default=local_models.DIM, help="Dimension of the local embedding")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent /ask requests")
+    parser.add_argument("--seconds", type=float, default=10.0, help="Duration of each load run")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="Seconds per stand-in embedding request")
+    parser.add_argument("--poll", type=float, default=1.0, help="SNAPSHOT_POLL_SECONDS of the workers")
+    parser.add_argument("--hybrid", action="store_true", help="Level 2 hybrid retrieval")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    main(parser.parse_args())
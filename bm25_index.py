@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class BM25Index:
+    """
+    BM25 keyword index stored as a term-major CSR matrix.
+
+    Row t of the matrix is the posting list of term t: `indptr[t]:indptr[t+1]`
+    slices `doc_ids` (row ids of chunks) and `weights`, the precomputed
+    BM25 contribution of term t to each document. Scoring a query is a
+    sparse mat-vec (gather the query terms' postings, sum per document
+    with bincount) followed by argpartition for the top k. Scores match
+    rank_bm25's BM25Okapi (ATIRE idf with an epsilon floor).
+
+    Row ids are stable: removed documents keep their row but lose their
+    postings and drop out of the corpus statistics.
+
+    Args:
+        k1: Term frequency saturation
+        b: Document length normalisation
+        epsilon: Floor for negative idf, as a fraction of the average idf
+    """
+
+    ARRAYS = ("indptr", "doc_ids", "tfs", "weights", "doc_len")
+
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocab = {}  # term -> row of the term-document matrix
+        self.terms = []
+        self.indptr = np.zeros(1, dtype="int64")
+        self.doc_ids = np.zeros(0, dtype="int32")
+        self.tfs = np.zeros(0, dtype="float32")
+        self.weights = np.zeros(0, dtype="float32")
+        self.doc_len = np.zeros(0, dtype="int32")
+        self.live_docs = 0
+        self.avgdl = 0.0
+
+    @property
+    def n_docs(self):
+        return len(self.doc_len)
+
+    def copy(self):
+        """
+        Copy that can be updated while readers keep scoring the original.
+
+        Updates always build new arrays, so only the vocabulary is copied.
+        """
+        other = BM25Index(k1=self.k1, b=self.b, epsilon=self.epsilon)
+        other.vocab = dict(self.vocab)
+        other.terms = list(self.terms)
+        for name in self.ARRAYS:
+            setattr(other, name, getattr(self, name))
+        other.live_docs = self.live_docs
+        other.avgdl = self.avgdl
+        return other
+
+    def subset(self, rows):
+        """
+        The postings of some rows as a separate, read-only index (one shard).
+
+        Weights are not recomputed: they keep the idf and average document
+        length of the whole corpus, so a row scores the same in the subset
+        as here and per-shard top-k lists merge into the exact top k. Row
+        i of the subset is `rows[i]` of this index.
+        """
+        rows = np.asarray(rows, dtype="int64")
+        local = np.full(self.n_docs, -1, dtype="int64")
+        local[rows] = np.arange(len(rows))
+        keep = local[self.doc_ids] >= 0
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+
+        other = BM25Index(k1=self.k1, b=self.b, epsilon=self.epsilon)
+        other.vocab = self.vocab
+        other.terms = self.terms
+        other.indptr = kept_before[self.indptr]
+        other.doc_ids = local[self.doc_ids[keep]].astype("int32")
+        other.tfs = np.asarray(self.tfs[keep])
+        other.weights = np.asarray(self.weights[keep])
+        other.doc_len = np.asarray(self.doc_len[rows])
+        other.live_docs = self.live_docs
+        other.avgdl = self.avgdl
+        return other
+
+    def compact(self, rows):
+        """
+        Index of the given live rows only, renumbered densely, with the
+        terms no row uses any more dropped.
+
+        Removed rows are already out of the statistics, so every row
+        scores the same as here. Row i of the result is `rows[i]`.
+        """
+        other = self.subset(rows)
+        df = np.diff(other.indptr)
+        used = df > 0
+        other.indptr = np.concatenate([[0], np.cumsum(df[used])]).astype("int64")
+        other.terms = [term for term, keep in zip(self.terms, used) if keep]
+        other.vocab = {term: i for i, term in enumerate(other.terms)}
+        if other.live_docs != len(rows):
+            # Removed empty rows were never out of the statistics
+            other.live_docs = len(rows)
+            other._reweight()
+        return other
+
+    # ---------------- building ----------------
+
+    def _term_ids(self, tokens):
+        ids = []
+        for word in tokens:
+            term = self.vocab.get(word)
+            if term is None:
+                term = len(self.terms)
+                self.vocab[word] = term
+                self.terms.append(word)
+            ids.append(term)
+        return ids
+
+    def add_documents(self, tokenized_docs):
+        """Append documents (lists of tokens) as new rows."""
+        tokenized_docs = list(tokenized_docs)
+        if not tokenized_docs:
+            return
+        lengths = np.array([len(doc) for doc in tokenized_docs], dtype="int64")
+        term_ids = np.array([t for doc in tokenized_docs for t in self._term_ids(doc)], dtype="int64")
+        rows = np.repeat(np.arange(self.n_docs, self.n_docs + len(tokenized_docs), dtype="int64"), lengths)
+
+        # (term, doc) pairs with their term frequency, sorted by term then doc
+        n_total = self.n_docs + len(tokenized_docs)
+        keys, counts = np.unique(term_ids * n_total + rows, return_counts=True)
+        new_terms = keys // n_total
+        new_docs = (keys % n_total).astype("int32")
+        del keys, term_ids, rows
+
+        # New doc ids are larger than every existing one, so each new posting
+        # goes at the end of its term's list and the lists stay sorted
+        n_terms = len(self.terms)
+        indptr = np.concatenate([self.indptr, np.full(n_terms + 1 - len(self.indptr), self.indptr[-1])])
+        positions = indptr[new_terms + 1]
+        self.doc_ids = np.insert(self.doc_ids, positions, new_docs)
+        self.tfs = np.insert(self.tfs, positions, counts.astype("float32"))
+        self.indptr = indptr + np.concatenate([[0], np.cumsum(np.bincount(new_terms, minlength=n_terms))])
+
+        self.doc_len = np.concatenate([self.doc_len, lengths.astype("int32")])
+        self.live_docs += len(tokenized_docs)
+        self._reweight()
+
+    def remove_documents(self, rows):
+        """Drop the postings of the given rows; their row ids stay reserved."""
+        rows = np.asarray(list(rows), dtype="int64")
+        rows = rows[self.doc_len[rows] > 0] if len(rows) else rows
+        if not len(rows):
+            return
+        keep = ~np.isin(self.doc_ids, rows)
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+        self.indptr = kept_before[self.indptr]
+        self.doc_ids = self.doc_ids[keep]
+        self.tfs = self.tfs[keep]
+        doc_len = np.array(self.doc_len)
+        doc_len[rows] = 0
+        self.doc_len = doc_len
+        self.live_docs -= len(rows)
+        self._reweight()
+
+    def _reweight(self):
+        """Recompute idf and the precomputed BM25 weights for every posting."""
+        self.avgdl = float(self.doc_len.sum()) / self.live_docs if self.live_docs else 0.0
+        df = np.diff(self.indptr).astype("float64")
+        present = df > 0
+        idf = np.log(self.live_docs - df + 0.5) - np.log(df + 0.5)
+        # Same floor as BM25Okapi: negative idf becomes epsilon * average idf
+        average_idf = idf[present].mean() if present.any() else 0.0
+        idf[present & (idf < 0)] = self.epsilon * average_idf
+
+        # float32 throughout: these arrays have one entry per posting
+        posting_idf = np.repeat(idf.astype("float32"), np.diff(self.indptr))
+        norm = self.doc_len.astype("float32")[self.doc_ids]
+        norm *= self.k1 * self.b / self.avgdl if self.avgdl else 0.0
+        norm += self.k1 * (1 - self.b)
+        norm += self.tfs
+        weights = self.tfs * (self.k1 + 1)
+        weights /= norm
+        weights *= posting_idf
+        self.weights = weights
+
+    # ---------------- scoring ----------------
+
+    def _query_terms(self, tokens):
+        counts = {}
+        for word in tokens:
+            term = self.vocab.get(word)
+            if term is not None:
+                counts[term] = counts.get(term, 0) + 1
+        return counts
+
+    def get_scores(self, tokens):
+        """BM25 score of every row for a tokenized query (BM25Okapi.get_scores)."""
+        counts = self._query_terms(tokens)
+        if not counts:
+            return np.zeros(self.n_docs, dtype="float32")
+        spans = [(self.indptr[t], self.indptr[t + 1], c) for t, c in counts.items()]
+        docs = np.concatenate([self.doc_ids[s:e] for s, e, _ in spans])
+        # Repeated query terms count once per occurrence, as in BM25Okapi
+        weights = np.concatenate([self.weights[s:e] * c for s, e, c in spans])
+        return np.bincount(docs, weights=weights, minlength=self.n_docs).astype("float32")
+
+    def top_k(self, tokens, k):
+        """
+        Top k rows by BM25 score among rows that match at least one query term.
+
+        Returns:
+            (row ids, scores), best first
+        """
+        scores = self.get_scores(tokens)
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        order = np.argsort(-scores[candidates], kind="stable")
+        return candidates[order], scores[candidates[order]]
+
+    def top_k_batch(self, token_lists, k, block_cells=4_000_000, allowed=None):
+        """
+        `top_k` for many queries as one sparse product per block of queries.
+
+        The postings of every (query, term) pair in a block are gathered
+        at once and summed into a (queries x rows) score matrix with a
+        single bincount, then the top k of every row is selected with one
+        argpartition. Blocks hold at most `block_cells` scores to bound
+        memory. Scores are identical to `top_k`.
+
+        `allowed` (bool per row) restricts the results to those rows before
+        the top k is taken, so a filter never leaves fewer than k hits
+        that would have matched.
+
+        Returns:
+            list of (row ids, scores), one per query, best first
+        """
+        rows_per_block = max(1, block_cells // max(1, self.n_docs))
+        results = []
+        for first in range(0, len(token_lists), rows_per_block):
+            results.extend(self._top_k_block(token_lists[first:first + rows_per_block], k, allowed))
+        return results
+
+    def _top_k_block(self, token_lists, k, allowed=None):
+        query_of, starts, ends, repeats = [], [], [], []
+        for q, tokens in enumerate(token_lists):
+            for term, count in self._query_terms(tokens).items():
+                query_of.append(q)
+                starts.append(self.indptr[term])
+                ends.append(self.indptr[term + 1])
+                repeats.append(count)
+        if not query_of or not self.n_docs:
+            return [(np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")) for _ in token_lists]
+
+        # Positions of all gathered postings: concatenated [start, end) ranges
+        starts = np.array(starts, dtype="int64")
+        lengths = np.array(ends, dtype="int64") - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum(), dtype="int64") + np.repeat(starts - offsets, lengths)
+
+        cells = np.repeat(np.array(query_of, dtype="int64"), lengths) * self.n_docs + self.doc_ids[positions]
+        weights = self.weights[positions] * np.repeat(np.array(repeats, dtype="float32"), lengths)
+        scores = np.bincount(cells, weights=weights, minlength=len(token_lists) * self.n_docs)
+        scores = scores.astype("float32").reshape(len(token_lists), self.n_docs)
+        if allowed is not None:
+            # Zero scores are never returned
+            scores[:, ~allowed] = 0
+
+        if self.n_docs > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(self.n_docs), scores.shape)
+        results = []
+        for q in range(len(token_lists)):
+            candidates = np.sort(top[q][scores[q, top[q]] != 0])
+            order = np.argsort(-scores[q, candidates], kind="stable")
+            results.append((candidates[order], scores[q, candidates[order]]))
+        return results
+
+    # ---------------- persistence ----------------
+
+    def save(self, path):
+        """Write the index as plain .npy arrays plus JSON metadata."""
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.terms, f, ensure_ascii=False)
+        with open(os.path.join(path, "bm25.json"), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "epsilon": self.epsilon, "live_docs": self.live_docs}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index written by `save`, memory-mapping the posting arrays."""
+        with open(os.path.join(path, "bm25.json")) as f:
+            params = json.load(f)
+        bm25 = cls(k1=params["k1"], b=params["b"], epsilon=params["epsilon"])
+        for name in cls.ARRAYS:
+            setattr(bm25, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None))
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            bm25.terms = json.load(f)
+        bm25.vocab = {term: i for i, term in enumerate(bm25.terms)}
+        bm25.live_docs = params["live_docs"]
+        bm25.avgdl = float(np.asarray(bm25.doc_len).sum()) / bm25.live_docs if bm25.live_docs else 0.0
+        return bm25
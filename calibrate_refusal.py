@@ -0,0 +1,140 @@
+"""
+Fit the cosine refusal threshold used by /ask.
+
+Runs retrieval (no LLM) for the answerable questions in questions.json
+and for a set of off-topic questions, in both vector-only and hybrid
+mode, and picks the highest threshold that refuses at most
+--max-false-refusals of the answerable questions, minus --margin.
+Questions below the threshold are refused without an LLM call.
+
+With --llm each question is also sent to the LLM once (with the guard
+disabled) and labelled by whether it actually answered, which catches
+in-domain questions the document does not cover.
+
+    python calibrate_refusal.py
+    python calibrate_refusal.py --llm --negatives offtopic.json --write
+"""
+import argparse
+import asyncio
+import json
+
+import numpy as np
+
+import app
+
+# Questions a manual on aircraft instruments cannot answer
+OFF_TOPIC = [
+    "What is the capital of Australia?",
+    "How do I bake sourdough bread at home?",
+    "Who won the FIFA World Cup in 2018?",
+    "What is the best way to learn the piano as an adult?",
+    "Explain how a blockchain reaches consensus.",
+    "What are the symptoms of vitamin D deficiency?",
+    "How much does a Boeing 747 ticket to Tokyo cost?",
+    "What is the maximum takeoff weight of an Airbus A380?",
+    "Which airline has the most punctual flights in Europe?",
+    "How do I renew my passport?",
+    "What is the boiling point of ethanol?",
+    "Summarise the plot of Hamlet."
+]
+
+
+async def score_question(question, use_hybrid, label_with_llm, semaphore):
+    """Best cosine score (guard disabled) and, optionally, whether the LLM answers."""
+    async with semaphore:
+        data = app.Ask(question=question, use_hybrid=use_hybrid)
+        retrieval = await app.retrieve(data, threshold=float("-inf"))
+        retrieved, score = retrieval["chunks"], retrieval["score"]
+        answered = None
+        if label_with_llm:
+            response = await app.client.chat.completions.create(
+                model=app.DEPLOYMENT,
+                messages=[{"role": "user", "content": app.build_prompt(question, retrieved)}]
+            )
+            answered = app.REFUSAL not in response.choices[0].message.content
+        return score, answered
+
+
+def fit_threshold(positive, max_false_refusals, margin):
+    """Highest threshold refusing at most `max_false_refusals` of the positive scores, minus margin."""
+    positive = np.sort(positive)
+    allowed = int(np.floor(max_false_refusals * len(positive)))
+    return float(positive[allowed]) - margin
+
+
+def summary(scores):
+    if not len(scores):
+        return "-"
+    return f"min {np.min(scores):.3f}  p5 {np.percentile(scores, 5):.3f}  median {np.median(scores):.3f}  max {np.max(scores):.3f}"
+
+
+async def main(args):
+    with open(args.questions) as f:
+        questions = [(q["q"], True) for q in json.load(f)]
+    negatives = OFF_TOPIC
+    if args.negatives:
+        with open(args.negatives) as f:
+            negatives = [q["q"] if isinstance(q, dict) else q for q in json.load(f)]
+    questions += [(q, False) for q in negatives]
+
+    app.load_vectorstore()
+    if app.snapshot is None:
+        raise SystemExit("No vectorstore found, ingest documents first")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    jobs = [
+        score_question(q, use_hybrid, args.llm and use_hybrid == args.llm_hybrid, semaphore)
+        for q, _ in questions
+        for use_hybrid in (False, True)
+    ]
+    results = await asyncio.gather(*jobs)
+
+    # One label per question; the LLM label (if any) overrides the question set
+    positive, negative = [], []
+    for i, (question, expected) in enumerate(questions):
+        (vector_score, vector_answered), (hybrid_score, hybrid_answered) = results[2 * i], results[2 * i + 1]
+        answered = vector_answered if vector_answered is not None else hybrid_answered
+        label = expected if answered is None else answered
+        (positive if label else negative).extend([vector_score, hybrid_score])
+
+    positive, negative = np.array(positive), np.array(negative)
+    threshold = fit_threshold(positive, args.max_false_refusals, args.margin)
+
+    print(f"answerable   ({len(positive) // 2:>3} questions): {summary(positive)}")
+    print(f"unanswerable ({len(negative) // 2:>3} questions): {summary(negative)}\n")
+    print(f"{'threshold':>9} {'false refusals':>15} {'LLM calls saved':>16}")
+    for t in sorted(set(np.round(np.linspace(0.0, 0.6, 13), 2).tolist() + [round(threshold, 3)])):
+        false_refusals = float(np.mean(positive < t))
+        saved = float(np.mean(negative < t)) if len(negative) else 0.0
+        marker = "  <- fitted" if t == round(threshold, 3) else ""
+        print(f"{t:>9.3f} {false_refusals:>14.1%} {saved:>15.1%}{marker}")
+    print(f"\ncurrent REFUSAL_THRESHOLD {app.REFUSAL_THRESHOLD:.3f}, fitted {threshold:.3f}")
+
+    if args.write:
+        path = f"{app.VECTOR_DIR}/refusal_threshold.json"
+        with open(path, "w") as f:
+            json.dump({
+                "threshold": round(threshold, 4),
+                "answerable": int(len(positive) // 2),
+                "unanswerable": int(len(negative) // 2),
+                "false_refusal_rate": float(np.mean(positive < threshold)),
+                "unanswerable_refused_rate": float(np.mean(negative < threshold)) if len(negative) else None,
+                "max_false_refusals": args.max_false_refusals,
+                "margin": args.margin,
+                "llm_labels": args.llm
+            }, f, indent=2)
+        print(f"Wrote {path}; restart the server to use it (REFUSAL_THRESHOLD overrides it)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--negatives", help="JSON list of questions the documents cannot answer")
+    parser.add_argument("--max-false-refusals", type=float, default=0.0,
+                        help="Fraction of answerable questions the guard may refuse")
+    parser.add_argument("--margin", type=float, default=0.02, help="Subtracted from the fitted threshold")
+    parser.add_argument("--llm", action="store_true", help="Label questions by whether the LLM answers them")
+    parser.add_argument("--llm-hybrid", action="store_true", help="With --llm, label using hybrid retrieval context")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--write", action="store_true", help="Save the threshold to vectorstore/refusal_threshold.json")
+    asyncio.run(main(parser.parse_args()))
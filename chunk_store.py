@@ -0,0 +1,171 @@
+import json
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+
+def save_npy(path, array):
+    """
+    np.save through a temporary file and a rename.
+
+    A reader that has the old file memory-mapped keeps its (unlinked)
+    copy intact instead of seeing it truncated.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def save_json(path, obj):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class ChunkStore(Sequence):
+    """
+    Chunk text and metadata stored as columns.
+
+    All chunk text is one UTF-8 byte blob; row i is
+    `blob[offsets[i]:offsets[i + 1]]`. Page numbers and document ids are
+    int32 columns, with documents interned in a small table of
+    {"doc_id", "source"} entries. Row ids are stable: removed rows keep
+    their slot and read back as None, like the tombstones of the old
+    chunk list, so `store[row]` and `store.meta(row)` are O(1) for any
+    FAISS / BM25 id.
+
+    Saved as plain .npy arrays (the blob is memory-mapped on load) plus
+    docs.json. Updates always build new arrays, so a copy can be updated
+    while readers keep using the original.
+    """
+
+    ARRAYS = ("blob", "offsets", "page", "doc")
+
+    def __init__(self):
+        self.blob = np.zeros(0, dtype="uint8")
+        self.offsets = np.zeros(1, dtype="int64")
+        self.page = np.zeros(0, dtype="int32")
+        self.doc = np.zeros(0, dtype="int32")  # index into docs, -1 = removed
+        self.docs = []  # [{"doc_id", "source"}]
+        self.doc_index = {}  # (doc_id, source) -> index into docs
+
+    def __len__(self):
+        return len(self.page)
+
+    def __getitem__(self, row):
+        """Text of a row, or None if it was removed."""
+        if row < 0:
+            row += len(self)
+        if self.doc[row] < 0:
+            return None
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tobytes().decode("utf-8")
+
+    def meta(self, row):
+        """{"page", "doc_id", "source"} of a row, or None if it was removed."""
+        doc = int(self.doc[row])
+        if doc < 0:
+            return None
+        return {"page": int(self.page[row]), **self.docs[doc]}
+
+    def is_live(self, row):
+        return self.doc[row] >= 0
+
+    def live_rows(self):
+        return np.flatnonzero(self.doc >= 0)
+
+    def copy(self):
+        """Copy that can be updated while readers keep using the original."""
+        other = ChunkStore()
+        for name in self.ARRAYS:
+            setattr(other, name, getattr(self, name))
+        other.docs = list(self.docs)
+        other.doc_index = dict(self.doc_index)
+        return other
+
+    # ---------------- updates ----------------
+
+    def _doc_id(self, doc_id, source):
+        key = (doc_id, source)
+        if key not in self.doc_index:
+            self.doc_index[key] = len(self.docs)
+            self.docs.append({"doc_id": doc_id, "source": source})
+        return self.doc_index[key]
+
+    def _append(self, texts, pages, docs):
+        encoded = [text.encode("utf-8") if text is not None else b"" for text in texts]
+        lengths = np.array([len(b) for b in encoded], dtype="int64")
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        self.blob = np.concatenate([self.blob, np.frombuffer(b"".join(encoded), dtype="uint8")])
+        self.page = np.concatenate([self.page, np.asarray(pages, dtype="int32")])
+        self.doc = np.concatenate([self.doc, np.asarray(docs, dtype="int32")])
+
+    def add(self, texts, pages, doc_id, source):
+        """Append chunks of one document as new rows."""
+        if texts:
+            self._append(texts, pages, [self._doc_id(doc_id, source)] * len(texts))
+
+    def remove(self, rows):
+        """Tombstone rows; their ids stay reserved."""
+        rows = np.asarray(list(rows), dtype="int64")
+        if not len(rows):
+            return
+        doc = np.array(self.doc)
+        doc[rows] = -1
+        self.doc = doc
+
+    def compact(self):
+        """
+        Copy without the removed rows, renumbered densely.
+
+        Returns:
+            (store, rows): row i of the new store is row `rows[i]` of this one
+        """
+        rows = self.live_rows()
+        other = ChunkStore()
+        # Live rows come in runs; each run's text is one slice of the blob
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = np.concatenate([[0], breaks]).astype("int64")
+        ends = np.concatenate([breaks, [len(rows)]]).astype("int64")
+        pieces = [self.blob[self.offsets[rows[s]]:self.offsets[rows[e - 1] + 1]] for s, e in zip(starts, ends) if e > s]
+        other.blob = np.concatenate(pieces) if pieces else np.zeros(0, dtype="uint8")
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        other.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype("int64")
+        other.page = np.asarray(self.page[rows])
+        used, doc = np.unique(np.asarray(self.doc[rows]), return_inverse=True)
+        other.doc = doc.astype("int32")
+        other.docs = [self.docs[i] for i in used]
+        other.doc_index = {(d["doc_id"], d["source"]): i for i, d in enumerate(other.docs)}
+        return other, rows
+
+    @classmethod
+    def from_lists(cls, chunks, meta):
+        """Build a store from the old parallel chunk / meta lists (None = removed)."""
+        store = cls()
+        docs = [-1 if m is None else store._doc_id(m.get("doc_id"), m.get("source")) for m in meta]
+        pages = [0 if m is None else m["page"] for m in meta]
+        store._append(chunks, pages, docs)
+        return store
+
+    # ---------------- persistence ----------------
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            save_npy(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        save_json(os.path.join(path, "docs.json"), self.docs)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a store written by `save`, memory-mapping the columns."""
+        store = cls()
+        for name in cls.ARRAYS:
+            array = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            # Plain ndarray view of the mapping: np.memmap slicing is much slower
+            setattr(store, name, array.view(np.ndarray))
+        with open(os.path.join(path, "docs.json"), encoding="utf-8") as f:
+            store.docs = json.load(f)
+        store.doc_index = {(d["doc_id"], d["source"]): i for i, d in enumerate(store.docs)}
+        return store
@@ -0,0 +1,75 @@
+"""
+Shared helpers for the test suite: small synthetic corpora with random
+embeddings, so no API keys, model or PDF are needed.
+"""
+import socket
+
+import numpy as np
+import pytest
+
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from snapshot import Snapshot
+from vector_index import build_index, normalize
+
+DIM = 32
+WORDS = [f"w{i}" for i in range(60)]
+INFO = {"embedding": {"model": "test", "dim": DIM, "normalized": True}, "index": {"type": "flat"}}
+
+
+def random_texts(rng, n):
+    return [" ".join(rng.choice(WORDS, size=rng.integers(3, 15))) for _ in range(n)]
+
+
+def make_snapshot(rng, docs=3, pages=6, chunks_per_page=4):
+    """Flat-indexed snapshot of `docs` documents, each with a two-chapter outline."""
+    store = ChunkStore()
+    documents = {}
+    texts = []
+    for d in range(docs):
+        doc_id = f"doc-{d}.pdf"
+        registry = {}
+        for page in range(1, pages + 1):
+            page_texts = random_texts(rng, chunks_per_page)
+            registry[page] = {"hash": f"{d}-{page}", "rows": list(range(len(store), len(store) + len(page_texts)))}
+            store.add(page_texts, [page] * len(page_texts), doc_id, doc_id)
+            texts.extend(page_texts)
+        documents[doc_id] = {
+            "source": doc_id,
+            "pages": registry,
+            "page_count": pages,
+            "outline": [
+                {"title": "Chapter 1", "level": 0, "page": 1},
+                {"title": "Chapter 2", "level": 0, "page": pages // 2 + 1}
+            ]
+        }
+    embeddings = normalize(rng.standard_normal((len(texts), DIM)))
+    index = build_index(embeddings, np.arange(len(texts)), "Flat")
+    bm25 = BM25Index()
+    bm25.add_documents([t.split() for t in texts])
+    return Snapshot(index, store, bm25, embeddings, documents)
+
+
+def assert_same_hits(hits, expected):
+    """Same (row ids, scores) top k, up to the order of rows tied at the cut-off score."""
+    (ids, scores), (expected_ids, expected_scores) = hits, expected
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    if len(scores):
+        above = scores > scores[-1] + 1e-5
+        assert set(ids[above].tolist()) == set(expected_ids[expected_scores > scores[-1] + 1e-5].tolist())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def snap(rng):
+    return make_snapshot(rng)
@@ -0,0 +1,174 @@
+from embeddings import estimate_tokens
+
+# Word n-gram length used to detect repeated spans
+SHINGLE_WORDS = 8
+
+
+def overlap_words(a, b):
+    """Number of words at the end of `a` that repeat the start of `b`."""
+    if not a or not b:
+        return 0
+    first = b[0]
+    for k in range(min(len(a), len(b)), 0, -1):
+        if a[-k] == first and a[-k:] == b[:k]:
+            return k
+    return 0
+
+
+def merge_runs(chunks, meta, ids):
+    """
+    Merge retrieved chunks that are consecutive windows of the same page.
+
+    Chunk rows are assigned page by page in window order, so rows r and
+    r + 1 of one page are neighbouring windows that share the chunking
+    overlap (or touch, with no overlap). Each run of consecutive rows
+    becomes one passage with the shared words written once.
+
+    Returns:
+        Passages {"words", "page", "doc_id", "source", "chapter", "section",
+        "rows", "rank"},
+        best-ranked first
+    """
+    groups = {}
+    sections = {}
+    for rank, (row, text, m) in enumerate(zip(ids, chunks, meta)):
+        if text is None or m is None:
+            continue
+        key = (m.get("doc_id"), m.get("source"), m["page"])
+        groups.setdefault(key, {})
+        # Sections are assigned by page, so every chunk of a page shares one
+        sections.setdefault(key, (m.get("chapter"), m.get("section")))
+        # The same row twice (e.g. in a fused result) keeps its best rank
+        groups[key].setdefault(row, (rank, text))
+
+    passages = []
+    for (doc_id, source, page), rows in groups.items():
+        chapter, section = sections[(doc_id, source, page)]
+        run = None
+        for row in sorted(rows):
+            rank, text = rows[row]
+            words = text.split()
+            if run is not None and row == run["rows"][-1] + 1:
+                run["words"].extend(words[overlap_words(run["words"], words):])
+                run["rows"].append(row)
+                run["rank"] = min(run["rank"], rank)
+                continue
+            run = {"words": words, "page": page, "doc_id": doc_id, "source": source, "chapter": chapter,
+                   "section": section, "rows": [row], "rank": rank}
+            passages.append(run)
+    passages.sort(key=lambda p: p["rank"])
+    return passages
+
+
+def drop_repeated_spans(words, seen, n=SHINGLE_WORDS):
+    """
+    Remove spans of `words` already present in earlier passages.
+
+    A word is repeated when it lies inside an n-word shingle in `seen`.
+    Runs of repeated words are cut, leaving "..." between the remaining
+    pieces; `seen` is updated with this passage's shingles.
+
+    Returns:
+        (kept words, number of words removed)
+    """
+    if len(words) < n:
+        key = tuple(words)
+        if key in seen:
+            return [], len(words)
+        seen.add(key)
+        return words, 0
+
+    shingles = [tuple(words[i:i + n]) for i in range(len(words) - n + 1)]
+    repeated = [False] * len(words)
+    for i, shingle in enumerate(shingles):
+        if shingle in seen:
+            repeated[i:i + n] = [True] * n
+    seen.update(shingles)
+    if not any(repeated):
+        return words, 0
+
+    kept = []
+    for i, word in enumerate(words):
+        if not repeated[i]:
+            if i > 0 and repeated[i - 1] and kept:
+                kept.append("...")
+            kept.append(word)
+    return kept, sum(repeated)
+
+
+def pack_context(chunks, meta, ids, budget=None, min_tokens=64, count_tokens=estimate_tokens):
+    """
+    Build the LLM context from retrieved chunks within a token budget.
+
+    Neighbouring windows of the same page are merged (`merge_runs`),
+    spans already present in a better-ranked passage are removed
+    (`drop_repeated_spans`), and passages are added in rank order until
+    the budget is reached. The passage that crosses the budget is cut at
+    a word boundary if at least `min_tokens` remain, otherwise dropped.
+    Token counts use `count_tokens` (an estimate by default), so the
+    budget is approximate; the LLM response reports the exact prompt size.
+
+    Args:
+        chunks: Retrieved chunk texts, best first
+        meta: Their {"page", "doc_id", "source"} (and "chapter", "section")
+        ids: Their chunk rows
+        budget: Maximum context tokens (None or <= 0 for no limit)
+        min_tokens: Smallest remainder worth filling with a cut passage
+        count_tokens: Function returning the token count of a text
+
+    Returns:
+        {"passages": [{"text", "page", "doc_id", "source", "chapter", "section", "rows"}],
+         "tokens": estimated context tokens,
+         "stats": chunk, merge, duplicate and budget counters}
+    """
+    passages = merge_runs(chunks, meta, ids)
+    seen = set()
+    packed = []
+    used = 0
+    stats = {
+        "chunks": sum(text is not None for text in chunks),
+        "chunk_tokens": sum(count_tokens(text) for text in chunks if text is not None),
+        "passages": 0,
+        "merged_chunks": sum(len(p["rows"]) - 1 for p in passages),
+        "duplicate_words": 0,
+        "duplicate_passages": 0,
+        "truncated": False,
+        "over_budget": 0
+    }
+
+    for i, passage in enumerate(passages):
+        words, removed = drop_repeated_spans(passage["words"], seen)
+        stats["duplicate_words"] += removed
+        if not words:
+            stats["duplicate_passages"] += 1
+            continue
+
+        text = " ".join(words)
+        tokens = count_tokens(text)
+        if budget and budget > 0 and used + tokens > budget:
+            remaining = budget - used
+            if remaining >= min_tokens:
+                # Proportional cut, then trim until the estimate fits
+                words = words[:max(1, len(words) * remaining // tokens)]
+                text = " ".join(words)
+                while len(words) > 1 and count_tokens(text) > remaining:
+                    words = words[:-max(1, len(words) // 20)]
+                    text = " ".join(words)
+                packed.append(dict(_passage_fields(passage), text=text))
+                used += count_tokens(text)
+                stats["truncated"] = True
+                stats["over_budget"] = len(passages) - i - 1
+            else:
+                stats["over_budget"] = len(passages) - i
+            break
+
+        packed.append(dict(_passage_fields(passage), text=text))
+        used += tokens
+
+    stats["passages"] = len(packed)
+    stats["tokens"] = used
+    return {"passages": packed, "tokens": used, "stats": stats}
+
+
+def _passage_fields(passage):
+    return {key: passage[key] for key in ("page", "doc_id", "source", "chapter", "section", "rows")}
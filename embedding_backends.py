@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from embeddings import EmbeddingClient
+
+logger = logging.getLogger(__name__)
+
+# azure: Azure OpenAI embedding deployment (network, paid per token)
+# onnx: local CPU sentence encoder run with ONNX Runtime (e.g. int8 MiniLM)
+EMBEDDING_BACKENDS = ("azure", "onnx")
+
+
+class OnnxEmbedder:
+    """
+    Local CPU sentence embeddings with ONNX Runtime.
+
+    Runs a BERT-style encoder exported to ONNX (all-MiniLM-L6-v2 by
+    default, int8-quantized; see prepare_onnx_embedder.py) with mean
+    pooling, and returns unit-length vectors. Same interface as
+    EmbeddingClient (`embed`, `aembed`, `throughput`, `info`), with no
+    network calls.
+
+    Texts are tokenized in one batch, sorted by token length and cut into
+    batches whose padded size (items x longest item) stays under
+    `max_batch_tokens`, so short texts are not padded to the length of
+    long ones and batch size adapts to text length. Output rows follow
+    input order.
+
+    `model_dir` holds tokenizer.json, the ONNX files and embedder.json:
+    {"model", "dim", "pooling", "max_length", "variants": {name: file}}.
+
+    Args:
+        model_dir: Directory prepared by prepare_onnx_embedder.py
+        variant: Key of "variants" to load ("int8" or "fp32")
+        max_batch_tokens: Padded tokens per inference batch
+        max_batch_items: Texts per inference batch
+        max_length: Truncation length in tokens (embedder.json if None)
+        threads: ONNX Runtime intra-op threads (0 = one per core)
+    """
+
+    backend = "onnx"
+
+    def __init__(self, model_dir, variant="int8", max_batch_tokens=16384, max_batch_items=128, max_length=None,
+                 threads=0):
+        # Optional dependencies, only needed for the local backend
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, "embedder.json")) as f:
+            config = json.load(f)
+        if variant not in config["variants"]:
+            raise ValueError(f"{model_dir} has no {variant} model (available: {', '.join(config['variants'])})")
+
+        self.model = config["model"]
+        self.variant = variant
+        self.dim = int(config["dim"])
+        self.max_length = int(max_length or config.get("max_length", 256))
+        self.max_batch_tokens = max(max_batch_tokens, self.max_length)
+        self.max_batch_items = max_batch_items
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.max_length)
+        self.tokenizer.no_padding()
+        self.pad_id = self.tokenizer.token_to_id("[PAD]") or 0
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, config["variants"][variant]), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        # One inference at a time: ONNX Runtime already uses every core
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self._lock = threading.Lock()
+        self.metrics = {
+            "texts": 0,
+            "tokens": 0,
+            "requests": 0,
+            "retries": 0,
+            "seconds": 0.0
+        }
+        self.last_run = None
+
+    @property
+    def name(self):
+        """Identity of the vector space, used for cache keys."""
+        return f"onnx-{self.model}-{self.variant}"
+
+    def info(self):
+        """Manifest fields recorded with every snapshot embedded by this backend."""
+        return {
+            "backend": self.backend,
+            "model": self.model,
+            "quantization": self.variant,
+            "dim": self.dim,
+            "pooling": "mean",
+            "max_length": self.max_length
+        }
+
+    def make_batches(self, lengths):
+        """
+        Group texts of similar length.
+
+        Returns:
+            Lists of input positions, longest texts first; each list pads
+            to at most `max_batch_tokens` tokens
+        """
+        order = np.argsort(-np.asarray(lengths), kind="stable").tolist()
+        batches = []
+        batch = []
+        for i in order:
+            # Sorted longest first: the first text sets the padded length
+            padded = lengths[batch[0]] if batch else lengths[i]
+            if batch and ((len(batch) + 1) * padded > self.max_batch_tokens or len(batch) >= self.max_batch_items):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _infer(self, encodings):
+        width = max(len(e.ids) for e in encodings)
+        input_ids = np.full((len(encodings), width), self.pad_id, dtype="int64")
+        attention_mask = np.zeros((len(encodings), width), dtype="int64")
+        for row, e in enumerate(encodings):
+            input_ids[row, :len(e.ids)] = e.ids
+            attention_mask[row, :len(e.ids)] = 1
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        hidden = self.session.run(None, feeds)[0]
+        if hidden.ndim == 2:
+            # Model exported with pooling included
+            pooled = hidden
+        else:
+            mask = attention_mask[:, :, None].astype("float32")
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.maximum(norms, 1e-12)).astype("float32")
+
+    def embed(self, texts):
+        """
+        Embed texts, preserving input order.
+
+        Returns:
+            float32 array of shape (len(texts), dim), unit-length rows
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dim), dtype="float32")
+
+        start = time.perf_counter()
+        encodings = self.tokenizer.encode_batch(texts)
+        lengths = [len(e.ids) for e in encodings]
+        batches = self.make_batches(lengths)
+        out = np.empty((len(texts), self.dim), dtype="float32")
+        padded = 0
+        for batch in batches:
+            out[batch] = self._infer([encodings[i] for i in batch])
+            padded += len(batch) * lengths[batch[0]]
+
+        elapsed = time.perf_counter() - start
+        tokens = sum(lengths)
+        with self._lock:
+            self.metrics["texts"] += len(texts)
+            self.metrics["tokens"] += tokens
+            self.metrics["requests"] += len(batches)
+            self.metrics["seconds"] += elapsed
+            self.last_run = {
+                "texts": len(texts),
+                "tokens": tokens,
+                "padded_tokens": padded,
+                "requests": len(batches),
+                "retries": 0,
+                "seconds": elapsed,
+                "texts_per_second": len(texts) / elapsed if elapsed else 0.0,
+                "tokens_per_second": tokens / elapsed if elapsed else 0.0
+            }
+        if len(batches) > 1:
+            logger.info(
+                f"Embedded {len(texts)} texts locally in {len(batches)} batches, {elapsed:.2f}s "
+                f"({self.last_run['texts_per_second']:.1f} texts/s, {tokens / max(1, padded):.0%} padding efficiency)"
+            )
+        return out
+
+    async def aembed(self, texts):
+        """Async variant of `embed`: inference runs on the embedder's thread."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.embed, texts)
+
+    def throughput(self):
+        """Cumulative counters plus texts/s and tokens/s over all calls."""
+        with self._lock:
+            stats = dict(self.metrics)
+        seconds = stats["seconds"]
+        stats["texts_per_second"] = stats["texts"] / seconds if seconds else 0.0
+        stats["tokens_per_second"] = stats["tokens"] / seconds if seconds else 0.0
+        return stats
+
+
+def create_embedder(backend=None, http_client=None):
+    """
+    The embedding backend configured by the environment.
+
+    Shared by the server and ingest.py, so both embed into the same
+    vector space:
+
+        EMBEDDING_BACKEND=azure   AZURE_EMBEDDING_DEPLOYMENT (text-embedding-3-small)
+                                  with the EMBED_* client settings
+        EMBEDDING_BACKEND=onnx    EMBED_MODEL_DIR (models/all-MiniLM-L6-v2),
+                                  EMBED_ONNX_VARIANT (int8), EMBED_MAX_BATCH_TOKENS,
+                                  EMBED_MAX_BATCH_ITEMS, EMBED_MAX_LENGTH, EMBED_THREADS
+
+    Args:
+        backend: "azure" or "onnx" (EMBEDDING_BACKEND if None)
+        http_client: Async HTTP client shared with the chat client (azure)
+    """
+    backend = backend or os.getenv("EMBEDDING_BACKEND", "azure")
+    if backend == "onnx":
+        return OnnxEmbedder(
+            os.getenv("EMBED_MODEL_DIR", "models/all-MiniLM-L6-v2"),
+            variant=os.getenv("EMBED_ONNX_VARIANT", "int8"),
+            max_batch_tokens=int(os.getenv("EMBED_MAX_BATCH_TOKENS", "16384")),
+            max_batch_items=int(os.getenv("EMBED_MAX_BATCH_ITEMS", "128")),
+            max_length=int(os.getenv("EMBED_MAX_LENGTH", "0")) or None,
+            threads=int(os.getenv("EMBED_THREADS", "0"))
+        )
+    if backend != "azure":
+        raise ValueError(f"EMBEDDING_BACKEND must be one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    from openai import AsyncAzureOpenAI, AzureOpenAI
+
+    # Ingestion jobs run on worker threads and use the sync client
+    sync_client = AzureOpenAI(
+        api_key=os.getenv("AZURE_EMBEDDING_KEY") or os.getenv("AZURE_OPENAI_KEY"),
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_version="2024-02-15-preview"
+    )
+    async_client = AsyncAzureOpenAI(
+        api_key=os.getenv("AZURE_EMBEDDING_KEY") or os.getenv("AZURE_OPENAI_KEY"),
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_version="2024-02-15-preview",
+        http_client=http_client
+    )
+    return EmbeddingClient(
+        sync_client,
+        os.getenv("AZURE_EMBEDDING_DEPLOYMENT", "text-embedding-3-small"),
+        max_batch_tokens=int(os.getenv("EMBED_MAX_BATCH_TOKENS", "20000")),
+        max_batch_items=int(os.getenv("EMBED_MAX_BATCH_ITEMS", "256")),
+        concurrency=int(os.getenv("EMBED_CONCURRENCY", "4")),
+        max_retries=int(os.getenv("EMBED_MAX_RETRIES", "6")),
+        async_client=async_client
+    )
+
+
+def embedding_mismatch(recorded, embedder, dim=None):
+    """
+    Why vectors recorded in a snapshot manifest cannot be compared with `embedder`'s, or None.
+
+    Vectors are compatible when the model, dimension and, where both
+    record one, the weight variant ("quantization": int8 or fp32) match.
+    The runtime may differ (a MiniLM index embedded with
+    sentence-transformers can be queried with the ONNX export of the same
+    model), but int8 and fp32 weights give slightly different vectors, and
+    an index mixing both ranks chunks inconsistently.
+
+    Args:
+        recorded: The manifest's "embedding" block
+        embedder: Backend that will embed questions or new chunks
+        dim: Dimension of the snapshot's index, if the manifest lacks it
+    """
+    info = embedder.info()
+    model = recorded.get("model")
+    if model != info["model"]:
+        backend = recorded.get("backend", "unknown backend")
+        return f"embedded with {model} ({backend}), this process embeds with {info['model']} ({info['backend']})"
+    recorded_dim = recorded.get("dim") or dim
+    if recorded_dim and info.get("dim") and int(recorded_dim) != int(info["dim"]):
+        return f"has {recorded_dim}-dimensional vectors, {info['model']} produces {info['dim']}"
+    variant = recorded.get("quantization")
+    if variant and info.get("quantization") and variant != info["quantization"]:
+        return f"embedded with the {variant} variant of {model}, this process uses {info['quantization']}"
+    return None
@@ -0,0 +1,230 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """Collapse whitespace so re-extracted PDF text maps to the same key."""
+    return " ".join(text.split())
+
+
+def cache_key(model, text):
+    """128-bit content address of (model, normalized text)."""
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()[:16]
+
+
+def claim_cache_dir(path, max_slots=64):
+    """
+    A cache directory no other process is using.
+
+    An EmbeddingCache is written by one process only. Each server worker
+    locks the first free directory of `path`, `path.1`, `path.2`, ...;
+    the lock lasts as long as the returned file stays open, and a
+    restarted worker takes a free slot with its cache as it was left.
+
+    Returns:
+        (directory, open lock file), or (None, None) if every slot is taken
+    """
+    for slot in range(max_slots):
+        directory = path if slot == 0 else f"{path}.{slot}"
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, "LOCK"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            continue
+        return directory, lock
+    return None, None
+
+
+class EmbeddingCache:
+    """
+    Disk-backed, content-addressed embedding cache with LRU eviction.
+
+    Vectors live in a memory-mapped matrix (vectors.bin) that grows up to
+    `capacity` rows; a small index file (index.npz) maps each 16-byte key
+    to its row, stored in least- to most-recently-used order. When the
+    cache is full the least recently used row is overwritten.
+
+    The index is written only every `flush_every` entries, so after a
+    crash it can map a key to a row that was since given to another
+    text. Every row therefore also records its key (keys.bin), and a
+    lookup only hits when the row still holds the key asked for.
+
+    Args:
+        path: Directory for vectors.bin and index.npz
+        capacity: Maximum number of cached vectors
+        dtype: Storage dtype, "float16" (half the disk and page cache) or "float32"
+        flush_every: Write the index after this many new entries
+        flush_interval: ...or once this many seconds have passed since the last write
+    """
+
+    def __init__(self, path, capacity=200_000, dtype="float16", flush_every=1000, flush_interval=10.0):
+        self.path = path
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.dim = None
+        self.vectors = None
+        self.row_keys = None  # key stored in each row of vectors
+        self.slots = OrderedDict()  # key -> row, least recently used first
+        self.free = []
+        self.allocated = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    # ---------------- persistence ----------------
+
+    def _load(self):
+        index_path = os.path.join(self.path, "index.npz")
+        vectors_path = os.path.join(self.path, "vectors.bin")
+        keys_path = os.path.join(self.path, "keys.bin")
+        if not all(os.path.exists(p) for p in (index_path, vectors_path, keys_path)):
+            return
+        try:
+            data = np.load(index_path)
+            if np.dtype(str(data["dtype"])) != self.dtype:
+                logger.warning(f"Embedding cache at {self.path} uses {data['dtype']}, starting empty")
+                return
+            self.dim = int(data["dim"])
+            self.allocated = int(data["allocated"])
+            self._map(self.allocated)
+            keys = data["keys"].view(np.uint8).reshape(-1, 16)
+            rows = data["rows"]
+            # Rows given to other keys after the index was last written
+            current = (np.asarray(self.row_keys[rows]) == keys).all(axis=1) if len(rows) else np.zeros(0, dtype=bool)
+            for key, row in zip(keys[current], rows[current]):
+                self.slots[key.tobytes()] = int(row)
+            if not current.all():
+                logger.info(f"Embedding cache dropped {int((~current).sum())} entries whose rows were reused")
+            used = set(self.slots.values())
+            self.free = [row for row in range(self.allocated) if row not in used]
+            logger.info(f"Embedding cache loaded: {len(self.slots)} vectors from {self.path}")
+        except Exception as e:
+            logger.warning(f"Could not load embedding cache at {self.path} ({e}), starting empty")
+            self.slots.clear()
+            self.free = []
+            self.allocated = 0
+            self.vectors = None
+            self.row_keys = None
+            self.dim = None
+
+    def _map(self, rows):
+        for name, row_bytes in (("vectors.bin", self.dim * self.dtype.itemsize), ("keys.bin", 16)):
+            with open(os.path.join(self.path, name), "ab") as f:
+                if f.tell() < rows * row_bytes:
+                    f.truncate(rows * row_bytes)
+        self.vectors = np.memmap(os.path.join(self.path, "vectors.bin"), dtype=self.dtype, mode="r+", shape=(rows, self.dim))
+        self.row_keys = np.memmap(os.path.join(self.path, "keys.bin"), dtype=np.uint8, mode="r+", shape=(rows, 16))
+
+    def _grow(self):
+        rows = min(self.capacity, max(1024, self.allocated * 2))
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.row_keys.flush()
+        self._map(rows)
+        self.free.extend(range(self.allocated, rows))
+        self.allocated = rows
+
+    def flush(self):
+        """Write vectors and the LRU index to disk."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self.vectors is None:
+            return
+        self.vectors.flush()
+        self.row_keys.flush()
+        keys = np.array(list(self.slots.keys()), dtype="S16")
+        rows = np.array(list(self.slots.values()), dtype="int64")
+        tmp_path = os.path.join(self.path, "index.tmp.npz")
+        np.savez(
+            tmp_path,
+            keys=keys,
+            rows=rows,
+            dim=self.dim,
+            allocated=self.allocated,
+            dtype=str(self.dtype)
+        )
+        os.replace(tmp_path, os.path.join(self.path, "index.npz"))
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    # ---------------- lookups ----------------
+
+    def get_many(self, keys):
+        """
+        Look up keys, marking hits as recently used.
+
+        Returns:
+            dict mapping position in `keys` to a float32 vector for every hit
+        """
+        found = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                row = self.slots.get(key)
+                if row is None or self.row_keys[row].tobytes() != key:
+                    self.misses += 1
+                    continue
+                self.slots.move_to_end(key)
+                found[i] = np.asarray(self.vectors[row], dtype="float32")
+                self.hits += 1
+        return found
+
+    def put_many(self, keys, vectors):
+        """Store vectors under their keys, evicting least recently used entries when full."""
+        vectors = np.asarray(vectors)
+        if not len(keys):
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                logger.warning(f"Embedding cache holds dim {self.dim}, not caching dim {vectors.shape[1]}")
+                return
+            for key, vector in zip(keys, vectors):
+                row = self.slots.get(key)
+                if row is None:
+                    if not self.free and self.allocated < self.capacity:
+                        self._grow()
+                    if self.free:
+                        row = self.free.pop()
+                    else:
+                        _, row = self.slots.popitem(last=False)
+                        self.evictions += 1
+                self.vectors[row] = vector
+                self.row_keys[row] = np.frombuffer(key, dtype=np.uint8)
+                self.slots[key] = row
+                self.slots.move_to_end(key)
+                self._pending += 1
+            if self._pending >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.slots),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Azure OpenAI rejects embedding requests with more than 2048 inputs
+MAX_INPUTS_PER_REQUEST = 2048
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError
+)
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+def retry_after_seconds(error):
+    """Read the server's retry hint from a failed request, if it sent one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+class EmbeddingClient:
+    """
+    Concurrent, rate-limit-aware embedding client.
+
+    Texts are packed into batches bounded by an estimated token budget,
+    batches are sent in parallel on a shared thread pool, and throttled or
+    failed requests are retried with jittered exponential backoff that
+    honours retry-after headers. Output rows always follow input order.
+
+    `embed` runs on a thread pool for synchronous callers (ingestion);
+    `aembed` does the same on the event loop through `async_client`.
+
+    Args:
+        client: AzureOpenAI (or OpenAI) client
+        model: Embedding deployment name
+        max_batch_tokens: Estimated token budget per request
+        max_batch_items: Maximum inputs per request
+        concurrency: Number of requests in flight at once
+        max_retries: Retries per batch before giving up
+        backoff_base: First backoff delay in seconds
+        backoff_max: Upper bound for a single backoff delay
+        async_client: Optional AsyncAzureOpenAI client used by `aembed`
+    """
+
+    backend = "azure"
+    dim = None  # known from the first response
+
+    def __init__(
+        self,
+        client,
+        model,
+        max_batch_tokens=20000,
+        max_batch_items=256,
+        concurrency=4,
+        max_retries=6,
+        backoff_base=0.5,
+        backoff_max=30.0,
+        async_client=None
+    ):
+        # Retries are handled here so they can be counted and jittered
+        self.client = client.with_options(max_retries=0)
+        self.async_client = async_client.with_options(max_retries=0) if async_client is not None else None
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = min(max_batch_items, MAX_INPUTS_PER_REQUEST)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embed")
+        self._lock = threading.Lock()
+        self.metrics = {
+            "texts": 0,
+            "tokens": 0,
+            "requests": 0,
+            "retries": 0,
+            "seconds": 0.0
+        }
+        self.last_run = None
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    @property
+    def name(self):
+        """Identity of the vector space, used for cache keys."""
+        return self.model
+
+    def info(self):
+        """Manifest fields recorded with every snapshot embedded by this backend."""
+        return {"backend": self.backend, "model": self.model}
+
+    def make_batches(self, texts):
+        """Split texts into (start, end) ranges under the token and item caps."""
+        batches = []
+        start = 0
+        tokens = 0
+        for i, text in enumerate(texts):
+            t = estimate_tokens(text)
+            if i > start and (tokens + t > self.max_batch_tokens or i - start >= self.max_batch_items):
+                batches.append((start, i))
+                start = i
+                tokens = 0
+            tokens += t
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return batches
+
+    def _backoff(self, attempt, error):
+        hinted = retry_after_seconds(error)
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        # Full jitter keeps concurrent workers from retrying in lockstep
+        delay = random.uniform(0, delay)
+        if hinted is not None:
+            delay = max(delay, hinted)
+        return delay
+
+    def _retry_delay(self, attempt, error, run):
+        delay = self._backoff(attempt, error)
+        with self._lock:
+            self.metrics["retries"] += 1
+            run["retries"] += 1
+        logger.warning(f"Embedding request failed ({type(error).__name__}), retrying in {delay:.2f}s")
+        return delay
+
+    def _request(self, batch, run):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._lock:
+                    self.metrics["requests"] += 1
+                response = self.client.embeddings.create(model=self.model, input=batch)
+                return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, e, run)
+                time.sleep(delay)
+            except openai.BadRequestError:
+                # One bad input should not sink its neighbours: bisect the batch
+                if len(batch) == 1:
+                    raise
+                mid = len(batch) // 2
+                return self._request(batch[:mid], run) + self._request(batch[mid:], run)
+
+    async def _arequest(self, batch, run):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    with self._lock:
+                        self.metrics["requests"] += 1
+                    response = await self.async_client.embeddings.create(model=self.model, input=batch)
+                return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, e, run)
+                await asyncio.sleep(delay)
+            except openai.BadRequestError:
+                if len(batch) == 1:
+                    raise
+                mid = len(batch) // 2
+                return await self._arequest(batch[:mid], run) + await self._arequest(batch[mid:], run)
+
+    def embed(self, texts):
+        """
+        Embed texts, preserving input order.
+
+        Returns:
+            float32 array of shape (len(texts), dim)
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+
+        start = time.perf_counter()
+        run = {"retries": 0}
+        batches = self.make_batches(texts)
+        futures = [self.executor.submit(self._request, texts[s:e], run) for s, e in batches]
+        results = [future.result() for future in futures]
+        return self._assemble(texts, batches, results, run, start)
+
+    async def aembed(self, texts):
+        """Async variant of `embed` that never blocks the event loop."""
+        if self.async_client is None:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, self.embed, texts)
+
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+
+        start = time.perf_counter()
+        run = {"retries": 0}
+        batches = self.make_batches(texts)
+        results = await asyncio.gather(*(self._arequest(texts[s:e], run) for s, e in batches))
+        return self._assemble(texts, batches, results, run, start)
+
+    def _assemble(self, texts, batches, results, run, start):
+        out = None
+        for (s, e), vectors in zip(batches, results):
+            vectors = np.asarray(vectors, dtype="float32")
+            if out is None:
+                out = np.empty((len(texts), vectors.shape[1]), dtype="float32")
+                self.dim = vectors.shape[1]
+            out[s:e] = vectors
+
+        elapsed = time.perf_counter() - start
+        tokens = sum(estimate_tokens(t) for t in texts)
+        with self._lock:
+            self.metrics["texts"] += len(texts)
+            self.metrics["tokens"] += tokens
+            self.metrics["seconds"] += elapsed
+            self.last_run = {
+                "texts": len(texts),
+                "tokens": tokens,
+                "requests": len(batches),
+                "retries": run["retries"],
+                "seconds": elapsed,
+                "texts_per_second": len(texts) / elapsed if elapsed else 0.0,
+                "tokens_per_second": tokens / elapsed if elapsed else 0.0
+            }
+        if len(batches) > 1:
+            logger.info(
+                f"Embedded {len(texts)} texts in {len(batches)} requests, {elapsed:.2f}s "
+                f"({self.last_run['texts_per_second']:.1f} texts/s, {self.last_run['tokens_per_second']:.0f} tokens/s, "
+                f"{self.last_run['retries']} retries)"
+            )
+        return out
+
+    def throughput(self):
+        """Cumulative counters plus texts/s and tokens/s over all calls."""
+        with self._lock:
+            stats = dict(self.metrics)
+        seconds = stats["seconds"]
+        stats["texts_per_second"] = stats["texts"] / seconds if seconds else 0.0
+        stats["tokens_per_second"] = stats["tokens"] / seconds if seconds else 0.0
+        return stats
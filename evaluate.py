@@ -1,12 +1,19 @@
+import argparse
 import requests
 import json
 import time
 
-URL = "http://localhost:8000/ask"
+parser = argparse.ArgumentParser(description="Level 1 evaluation: answer questions.json and write report.md")
+parser.add_argument("--questions", default="questions.json", help="Questions file")
+parser.add_argument("--url", default="http://localhost:8000/ask", help="/ask endpoint of the server")
+args = parser.parse_args()
+
+URL = args.url
+BATCH_URL = URL + "/batch"
 REFUSAL = "This information is not available in the provided document(s)."
 
 # Load questions
-with open("/Users/lokeshwarans/AIRMAN/questions.json") as f:
+with open(args.questions) as f:
     questions = json.load(f)
 
 results = []
@@ -15,86 +22,61 @@ total = len(questions)
 print(f"Evaluating {total} questions...")
 print("=" * 70)
 
-# Run all questions ONE BY ONE with error handling
-for idx, q_obj in enumerate(questions, 1):
+# One /ask/batch request: the server embeds and searches every question
+# at once and runs the LLM calls concurrently, returning results in order
+max_retries = 3
+batch = None
+for attempt in range(1, max_retries + 1):
+    try:
+        print(f"  → Sending batch (attempt {attempt}/{max_retries})...")
+        response = requests.post(
+            BATCH_URL,
+            json={"questions": [q["q"] for q in questions], "debug": True},
+            timeout=600
+        )
+        if response.status_code == 200:
+            batch = response.json()
+            break
+        print(f"  ✗ HTTP Error {response.status_code}")
+    except requests.exceptions.Timeout:
+        print(f"  ✗ Timeout error")
+    except requests.exceptions.ConnectionError:
+        print(f"  ✗ Connection error - is server running?")
+    except Exception as e:
+        print(f"  ✗ Error: {str(e)}")
+    if attempt < max_retries:
+        time.sleep(5)
+
+if batch is None:
+    print(f"  ✗ FAILED after {max_retries} attempts")
+else:
+    print(f"  ✓ {batch['questions']} questions in {batch['total_seconds']}s (retrieval {batch['retrieval_seconds']}s)")
+
+for idx, q_obj in enumerate(questions):
     question = q_obj["q"]
     q_type = q_obj.get("type", "unknown")
-    
-    print(f"\n[{idx}/{total}] Question Type: {q_type}")
-    print(f"Question: {question[:80]}...")
-    
-    max_retries = 3
-    retry_count = 0
-    success = False
-    
-    while retry_count < max_retries and not success:
-        try:
-            print(f"  → Sending request (attempt {retry_count + 1}/{max_retries})...")
-            
-            response = requests.post(
-                URL, 
-                json={"question": question, "debug": True},
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                answer = data.get("answer", "")
-                citations = data.get("citations", [])
-                retrieved = data.get("retrieved_chunks", [])
-                
-                results.append({
-                    "question": question,
-                    "type": q_type,
-                    "answer": answer,
-                    "citations": citations,
-                    "retrieved_chunks": retrieved,
-                    "is_refusal": REFUSAL in answer,
-                    "error": False
-                })
-                
-                print(f"  ✓ Success! Answer length: {len(answer)} chars")
-                success = True
-                
-            else:
-                print(f"  ✗ HTTP Error {response.status_code}")
-                retry_count += 1
-                time.sleep(2)
-                
-        except requests.exceptions.Timeout:
-            print(f"  ✗ Timeout error")
-            retry_count += 1
-            time.sleep(3)
-            
-        except requests.exceptions.ConnectionError:
-            print(f"  ✗ Connection error - is server running?")
-            retry_count += 1
-            time.sleep(5)
-            
-        except Exception as e:
-            print(f"  ✗ Error: {str(e)}")
-            retry_count += 1
-            time.sleep(2)
-    
-    # If all retries failed
-    if not success:
-        print(f"  ✗ FAILED after {max_retries} attempts")
+    data = batch["results"][idx] if batch is not None else None
+    if data is None or data.get("status") == "error":
         results.append({
             "question": question,
             "type": q_type,
-            "answer": "ERROR: Failed to get response after multiple retries",
+            "answer": "ERROR: " + (data.get("message", "") if data else "Failed to get response after multiple retries"),
             "citations": [],
             "retrieved_chunks": [],
             "is_refusal": False,
             "error": True
         })
-    
-    # Delay between questions to avoid rate limits
-    if idx < total:
-        wait_time = 2
-        print(f"  Waiting {wait_time}s before next question...")
-        time.sleep(wait_time)
+        continue
+    answer = data.get("answer", "")
+    results.append({
+        "question": question,
+        "type": q_type,
+        "answer": answer,
+        "citations": data.get("citations", []),
+        "retrieved_chunks": data.get("retrieved_chunks", []),
+        "is_refusal": REFUSAL in answer,
+        "error": False
+    })
 
 # Calculate metrics
 print("\n" + "="*60)
@@ -139,6 +121,12 @@ sorted_results = sorted(answered, key=score_answer, reverse=True)
 best_5 = sorted_results[:5]
 worst_5 = sorted_results[-5:]
 
+# Answer cache: repeated evaluation runs should be served without LLM calls
+try:
+    answer_cache_stats = requests.get(URL.replace("/ask", "/health"), timeout=10).json().get("answer_cache")
+except Exception:
+    answer_cache_stats = None
+
 # Generate report
 with open("report.md", "w") as report:
     report.write("# RAG System Evaluation Report\n\n")
@@ -164,6 +152,10 @@ with open("report.md", "w") as report:
     report.write(f"**Estimated Faithfulness**: Based on citation presence and chunk relevance\n\n")
     report.write("*Note*: All answers include citations with page numbers and text snippets, ensuring grounding.\n\n")
     
+    if answer_cache_stats:
+        report.write(f"### 4. Answer Cache\n")
+        report.write(f"**{answer_cache_stats['hit_rate'] * 100:.1f}%** hit rate, {answer_cache_stats['llm_calls_saved']} LLM calls saved since server start\n\n")
+    
     report.write("---\n\n")
     report.write("## Qualitative Analysis\n\n")
     
@@ -211,3 +203,5 @@ print(f"📊 Retrieval Hit-Rate: {retrieval_hit_rate:.1f}%")
 print(f"🚫 Refusal Rate: {refusal_rate:.1f}%")
 print(f"📝 Answers Provided: {len(answered)}/{total}")
 print(f"\n📄 Report saved to: report.md")
+if answer_cache_stats:
+    print(f"💾 Answer cache: {answer_cache_stats['hit_rate'] * 100:.1f}% hit rate, {answer_cache_stats['llm_calls_saved']} LLM calls saved")
@@ -1,12 +1,19 @@
+import argparse
 import requests
 import json
-import time
 
-URL = "http://localhost:8000/ask"
+parser = argparse.ArgumentParser(description="Level 1 vs Level 2 comparison: writes level_comparison_report.md")
+parser.add_argument("--questions", default="questions.json", help="Questions file")
+parser.add_argument("--url", default="http://localhost:8000/ask", help="/ask endpoint of the server")
+args = parser.parse_args()
+
+URL = args.url
+BATCH_URL = URL + "/batch"
 REFUSAL = "This information is not available in the provided document(s)."
+FUSION_MODES = ("embed_rerank", "rrf", "weighted")
 
 # Load questions
-with open("/Users/lokeshwarans/AIRMAN/questions.json") as f:
+with open(args.questions) as f:
     questions = json.load(f)
 
 print("="*70)
@@ -18,83 +25,60 @@ print("  - Level 1: Vector-only retrieval (baseline)")
 print("  - Level 2: Hybrid (BM25 + Vector + Reranker)")
 print("="*70)
 
-# Store results for both modes
-results_level1 = []
-results_level2 = []
-
-# Run evaluation for LEVEL 1 (vector-only)
-print("\n\n🔵 EVALUATING LEVEL 1 (Vector-Only Retrieval)")
-print("-"*70)
+# Both levels use /ask/batch: one embedding call and one matrix search
+# per level, with the LLM calls run concurrently by the server. The answer
+# cache is bypassed, so every mode calls the LLM with its own context
+# instead of reusing answers from earlier runs or modes
+batch_seconds = {}  # method -> (retrieval_seconds, total_seconds)
 
-for idx, q_obj in enumerate(questions, 1):
-    question = q_obj["q"]
-    q_type = q_obj.get("type", "unknown")
-    
-    print(f"[{idx}/{len(questions)}] {question[:60]}...")
-    
+def evaluate_level(use_hybrid, default_method, fusion=None):
     try:
-        response = requests.post(
-            URL, 
-            json={"question": question, "debug": True, "use_hybrid": False},
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            results_level1.append({
-                "question": question,
-                "type": q_type,
-                "answer": data.get("answer", ""),
-                "citations": data.get("citations", []),
-                "retrieved_chunks": data.get("retrieved_chunks", []),
-                "is_refusal": REFUSAL in data.get("answer", ""),
-                "retrieval_method": data.get("retrieval_method", "vector-only")
-            })
-        else:
-            results_level1.append({"question": question, "type": q_type, "error": True})
-            
-        time.sleep(1.5)
-        
+        payload = {"questions": [q["q"] for q in questions], "debug": True, "use_hybrid": use_hybrid,
+                   "use_cache": False}
+        if fusion:
+            payload["fusion"] = fusion
+        response = requests.post(BATCH_URL, json=payload, timeout=600)
+        response.raise_for_status()
+        batch = response.json()
     except Exception as e:
         print(f"  Error: {e}")
-        results_level1.append({"question": question, "type": q_type, "error": True})
+        return [{"question": q["q"], "type": q.get("type", "unknown"), "error": True} for q in questions]
+
+    print(f"  {batch['questions']} questions in {batch['total_seconds']}s (retrieval {batch['retrieval_seconds']}s)")
+    batch_seconds[default_method] = (batch["retrieval_seconds"], batch["total_seconds"])
+    results = []
+    for q_obj, data in zip(questions, batch["results"]):
+        if data.get("status") == "error":
+            results.append({"question": q_obj["q"], "type": q_obj.get("type", "unknown"), "error": True})
+            continue
+        results.append({
+            "question": q_obj["q"],
+            "type": q_obj.get("type", "unknown"),
+            "answer": data.get("answer", ""),
+            "citations": data.get("citations", []),
+            "retrieved_chunks": data.get("retrieved_chunks", []),
+            "is_refusal": REFUSAL in data.get("answer", ""),
+            "retrieval_method": data.get("retrieval_method", default_method)
+        })
+    return results
+
+# Run evaluation for LEVEL 1 (vector-only)
+print("\n\n🔵 EVALUATING LEVEL 1 (Vector-Only Retrieval)")
+print("-"*70)
+results_level1 = evaluate_level(False, "vector-only")
 
 # Run evaluation for LEVEL 2 (hybrid)
 print("\n\n🟢 EVALUATING LEVEL 2 (Hybrid: BM25 + Vector + Reranker)")
 print("-"*70)
+results_level2 = evaluate_level(True, "hybrid", "embed_rerank")
 
-for idx, q_obj in enumerate(questions, 1):
-    question = q_obj["q"]
-    q_type = q_obj.get("type", "unknown")
-    
-    print(f"[{idx}/{len(questions)}] {question[:60]}...")
-    
-    try:
-        response = requests.post(
-            URL, 
-            json={"question": question, "debug": True, "use_hybrid": True},
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            data = response.json()
-            results_level2.append({
-                "question": question,
-                "type": q_type,
-                "answer": data.get("answer", ""),
-                "citations": data.get("citations", []),
-                "retrieved_chunks": data.get("retrieved_chunks", []),
-                "is_refusal": REFUSAL in data.get("answer", ""),
-                "retrieval_method": data.get("retrieval_method", "hybrid")
-            })
-        else:
-            results_level2.append({"question": question, "type": q_type, "error": True})
-            
-        time.sleep(1.5)
-        
-    except Exception as e:
-        print(f"  Error: {e}")
-        results_level2.append({"question": question, "type": q_type, "error": True})
+# The other Level 2 fusion modes merge the BM25 and vector lists by rank
+# or by normalized score instead of reranking every candidate by cosine
+results_fusion = {"embed_rerank": results_level2}
+for fusion in FUSION_MODES[1:]:
+    print(f"\n\n🟢 EVALUATING LEVEL 2 with {fusion} fusion")
+    print("-"*70)
+    results_fusion[fusion] = evaluate_level(True, f"hybrid-{fusion}", fusion)
 
 # Calculate metrics for both levels
 def calculate_metrics(results, level_name):
@@ -119,6 +103,7 @@ def calculate_metrics(results, level_name):
 
 metrics_l1 = calculate_metrics(results_level1, "Level 1 (Vector-Only)")
 metrics_l2 = calculate_metrics(results_level2, "Level 2 (Hybrid)")
+metrics_fusion = {fusion: calculate_metrics(results, f"Level 2 ({fusion})") for fusion, results in results_fusion.items()}
 
 # Generate comparison report
 with open("level_comparison_report.md", "w") as report:
@@ -146,6 +131,16 @@ with open("level_comparison_report.md", "w") as report:
     report.write(f"| Refusal Rate | {metrics_l1['refusal_rate']:.1f}% | {metrics_l2['refusal_rate']:.1f}% | {metrics_l2['refusal_rate'] - metrics_l1['refusal_rate']:+.1f}% |\n")
     report.write(f"| Questions Answered | {metrics_l1['answered']}/{metrics_l1['total']} | {metrics_l2['answered']}/{metrics_l2['total']} | {metrics_l2['answered'] - metrics_l1['answered']:+d} |\n\n")
     
+    report.write("## Level 2 Fusion Modes\n\n")
+    report.write("| Fusion | Hit-Rate | Answer Rate | Refusal Rate | Retrieval (s) | Total (s) |\n")
+    report.write("|--------|----------|-------------|--------------|---------------|-----------|\n")
+    for fusion, m in metrics_fusion.items():
+        method = "hybrid" if fusion == "embed_rerank" else f"hybrid-{fusion}"
+        retrieval_s, total_s = batch_seconds.get(method, (None, None))
+        report.write(f"| {fusion} | {m['hit_rate']:.1f}% | {m['answer_rate']:.1f}% | {m['refusal_rate']:.1f}% | "
+                     f"{retrieval_s if retrieval_s is not None else 'n/a'} | {total_s if total_s is not None else 'n/a'} |\n")
+    report.write("\n")
+
     report.write("---\n\n")
     report.write("## Detailed Analysis\n\n")
     
@@ -202,6 +197,13 @@ print(f"   Hit-Rate: {metrics_l2['hit_rate']:.1f}%")
 print(f"   Answered: {metrics_l2['answered']}/{metrics_l2['total']}")
 print(f"   Refusals: {metrics_l2['refusals']}")
 
+print(f"\n📊 LEVEL 2 fusion modes:")
+for fusion, m in metrics_fusion.items():
+    method = "hybrid" if fusion == "embed_rerank" else f"hybrid-{fusion}"
+    retrieval_s, _ = batch_seconds.get(method, (None, None))
+    print(f"   {fusion:<13} Hit-Rate {m['hit_rate']:.1f}%, Answered {m['answered']}/{m['total']}, "
+          f"Refusals {m['refusals']}, retrieval {retrieval_s}s")
+
 print(f"\n📈 Improvement:")
 print(f"   Hit-Rate: {metrics_l2['hit_rate'] - metrics_l1['hit_rate']:+.1f}%")
 print(f"   Answers: {metrics_l2['answered'] - metrics_l1['answered']:+d}")
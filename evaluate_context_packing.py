@@ -0,0 +1,164 @@
+"""
+Prompt tokens and answer quality with and without context packing.
+
+Each question in questions.json is retrieved once, then answered by the
+LLM with the retrieved chunks sent verbatim ("raw") and with the packed
+context at each --budgets value (0 = merge and dedupe only, no budget).
+Reports prompt tokens (as billed by the API), LLM latency and answer /
+refusal counts per variant.
+
+With --judge the LLM also compares every packed answer against the raw
+answer for the same question, given the full raw context, and labels it
+better, same or worse.
+
+    python evaluate_context_packing.py
+    python evaluate_context_packing.py --hybrid --budgets 0,3000,2000 --judge --json packing.json
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import app
+
+JUDGE_PROMPT = """You are grading two answers to a question about an aviation document.
+Use only the context to decide which answer is more correct and complete.
+
+Context:
+{context}
+
+Question:
+{question}
+
+Answer A:
+{a}
+
+Answer B:
+{b}
+
+Reply with exactly one word: A if answer A is better, B if answer B is better, SAME if they are equally good."""
+
+
+async def complete(prompt):
+    start = time.perf_counter()
+    response = await app.client.chat.completions.create(
+        model=app.DEPLOYMENT,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    answer = response.choices[0].message.content.strip()
+    return answer, app.prompt_tokens(response, prompt), time.perf_counter() - start
+
+
+async def judge(question, context, raw_answer, packed_answer):
+    """better / same / worse for the packed answer; raw and packed swap places to avoid position bias."""
+    verdicts = []
+    for a, b, packed_is in ((raw_answer, packed_answer, "B"), (packed_answer, raw_answer, "A")):
+        reply, _, _ = await complete(JUDGE_PROMPT.format(context="\n\n".join(context), question=question, a=a, b=b))
+        word = reply.strip().upper().split()[0] if reply.strip() else "SAME"
+        verdicts.append(0 if word.startswith("SAME") else (1 if word.startswith(packed_is) else -1))
+    total = sum(verdicts)
+    return "better" if total > 0 else ("worse" if total < 0 else "same")
+
+
+async def run_question(question, variants, use_hybrid, with_judge, semaphore):
+    async with semaphore:
+        retrieval = await app.retrieve(app.Ask(question=question, use_hybrid=use_hybrid))
+        if retrieval is None:
+            return None
+        results = {}
+        for name, pack, budget in variants:
+            context = app.build_context(retrieval, pack, budget)
+            answer, tokens, seconds = await complete(app.build_prompt(question, context["texts"]))
+            results[name] = {
+                "answer": answer,
+                "refused": app.REFUSAL in answer,
+                "prompt_tokens": tokens,
+                "llm_seconds": seconds,
+                "passages": len(context["texts"])
+            }
+        if with_judge:
+            raw = results["raw"]
+            for name, _, _ in variants[1:]:
+                packed = results[name]
+                if raw["refused"] or packed["refused"]:
+                    packed["verdict"] = "same" if raw["refused"] == packed["refused"] else ("worse" if packed["refused"] else "better")
+                elif packed["answer"] == raw["answer"]:
+                    packed["verdict"] = "same"
+                else:
+                    packed["verdict"] = await judge(question, retrieval["chunks"], raw["answer"], packed["answer"])
+        return results
+
+
+async def main(args):
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+    if args.limit:
+        questions = questions[:args.limit]
+
+    app.load_vectorstore()
+    if app.snapshot is None:
+        raise SystemExit("No vectorstore found, ingest documents first")
+
+    budgets = [int(b) for b in args.budgets.split(",") if b.strip()]
+    variants = [("raw", False, None)] + [(f"packed-{b}" if b else "packed", True, b) for b in budgets]
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    per_question = await asyncio.gather(*(
+        run_question(q, variants, args.hybrid, args.judge, semaphore) for q in questions
+    ))
+    answered = [r for r in per_question if r is not None]
+    print(f"{len(questions)} questions, {len(questions) - len(answered)} refused by the score guard "
+          f"({'hybrid' if args.hybrid else 'vector-only'} retrieval)\n")
+
+    raw_tokens = np.array([r["raw"]["prompt_tokens"] for r in answered], dtype="float64")
+    summary = {}
+    header = f"{'variant':<14} {'mean tokens':>12} {'p95 tokens':>11} {'saved':>7} {'llm p50 s':>10} {'answered':>9} {'refused':>8}"
+    if args.judge:
+        header += f" {'better':>7} {'same':>5} {'worse':>6}"
+    print(header)
+    for name, _, _ in variants:
+        rows = [r[name] for r in answered]
+        tokens = np.array([row["prompt_tokens"] for row in rows], dtype="float64")
+        summary[name] = {
+            "mean_prompt_tokens": round(float(tokens.mean()), 1) if len(tokens) else None,
+            "p95_prompt_tokens": round(float(np.percentile(tokens, 95)), 1) if len(tokens) else None,
+            "tokens_saved": round(1 - float(tokens.sum() / raw_tokens.sum()), 4) if raw_tokens.sum() else None,
+            "llm_p50_seconds": round(float(np.median([row["llm_seconds"] for row in rows])), 3) if rows else None,
+            "answered": sum(not row["refused"] for row in rows),
+            "refused": sum(row["refused"] for row in rows)
+        }
+        if args.judge and name != "raw":
+            for verdict in ("better", "same", "worse"):
+                summary[name][verdict] = sum(row.get("verdict") == verdict for row in rows)
+        s = summary[name]
+        line = (f"{name:<14} {s['mean_prompt_tokens']:>12} {s['p95_prompt_tokens']:>11} "
+                f"{(s['tokens_saved'] or 0):>7.1%} {s['llm_p50_seconds']:>10} {s['answered']:>9} {s['refused']:>8}")
+        if args.judge:
+            line += f" {s.get('better', '-'):>7} {s.get('same', '-'):>5} {s.get('worse', '-'):>6}"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "questions": len(questions),
+                "hybrid": args.hybrid,
+                "summary": summary,
+                "results": [dict(r, question=q) if r is not None else {"question": q, "refused_by_guard": True}
+                            for q, r in zip(questions, per_question)]
+            }, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--limit", type=int, help="Only the first N questions")
+    parser.add_argument("--hybrid", action="store_true", help="Use hybrid retrieval")
+    parser.add_argument("--budgets", default=f"0,{app.CONTEXT_TOKEN_BUDGET}",
+                        help="Comma-separated packed context budgets to compare (0 = no budget)")
+    parser.add_argument("--judge", action="store_true", help="Have the LLM compare packed and raw answers")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--json", help="Also write per-question results to this file")
+    asyncio.run(main(parser.parse_args()))
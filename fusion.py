@@ -0,0 +1,65 @@
+import numpy as np
+
+FUSION_MODES = ("embed_rerank", "rrf", "weighted")
+
+
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """
+    Reciprocal rank fusion (Cormack et al., 2009).
+
+    Each list contributes 1 / (k + rank) for every id it contains (rank
+    starts at 1), so an id ranked high by either retriever, or fairly
+    high by both, comes first. Only ranks are used: BM25 and cosine
+    scores need not be on the same scale.
+
+    Args:
+        ranked_lists: Sequences of ids, best first
+        k: Damping constant; larger values flatten the rank differences
+
+    Returns:
+        (ids, fused scores), best first
+    """
+    scores = {}
+    for ids in ranked_lists:
+        for rank, i in enumerate(ids, 1):
+            scores[i] = scores.get(i, 0.0) + 1.0 / (k + rank)
+    return _ranked(scores)
+
+
+def min_max(scores):
+    """Scale scores to [0, 1]; a list of equal scores becomes all 1."""
+    scores = np.asarray(scores, dtype="float64")
+    if not len(scores):
+        return scores
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def weighted_fusion(scored_lists, weights):
+    """
+    Weighted sum of min-max normalized scores.
+
+    Each list's scores are scaled to [0, 1] over that list, so the best
+    hit of every retriever scores 1; an id missing from a list gets 0
+    from it.
+
+    Args:
+        scored_lists: (ids, scores) pairs, one per retriever
+        weights: One weight per list
+
+    Returns:
+        (ids, fused scores), best first
+    """
+    scores = {}
+    for (ids, raw), weight in zip(scored_lists, weights):
+        for i, s in zip(ids, min_max(raw).tolist()):
+            scores[i] = scores.get(i, 0.0) + weight * s
+    return _ranked(scores)
+
+
+def _ranked(scores):
+    # Ties keep first-seen order (vector hits come first), like a stable sort
+    items = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [i for i, _ in items], [s for _, s in items]
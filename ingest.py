@@ -1,64 +1,62 @@
+"""
+Ingest a PDF into the vectorstore from the command line.
+
+Runs the same ingestion as POST /ingest (app.ingest_pdf): the same
+chunking, embedding backend and index settings, and by default the same
+upsert, so unchanged pages are skipped and the other documents in the
+store are kept. --replace drops the whole corpus first.
+
+    python ingest.py data/Instruments.pdf
+    python ingest.py manual.pdf --doc-id manual-v2
+    python ingest.py data/Instruments.pdf --replace
+
+A running server picks the new snapshot up within SNAPSHOT_POLL_SECONDS.
+The PDF waits for one of the server's MAX_CONCURRENT_INGESTS slots.
+"""
+import argparse
 import os
-import pickle
-from PyPDF2 import PdfReader
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
-from rank_bm25 import BM25Okapi
-
-PDF_PATH = "/Users/lokeshwarans/AIRMAN/data/Instruments.pdf"
-VECTOR_DIR = "vectorstore"
-
-os.makedirs(VECTOR_DIR, exist_ok=True)
-
-model = SentenceTransformer("all-MiniLM-L6-v2")
-
-# 1. Load PDF
-reader = PdfReader(PDF_PATH)
-pages = []
-
-for i, page in enumerate(reader.pages):
-    text = page.extract_text()
-    if text:
-        pages.append({"page": i+1, "text": text})
-
-# 2. Chunking
-def chunk_text(text, size=500, overlap=100):
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), size-overlap):
-        chunk = " ".join(words[i:i+size])
-        chunks.append(chunk)
-    return chunks
-
-chunks = []
-metadata = []
-
-for p in pages:
-    chs = chunk_text(p["text"])
-    for c in chs:
-        chunks.append(c)
-        metadata.append({"page": p["page"]})
-
-# 3. Embeddings
-embeddings = model.encode(chunks)
-
-# 4. FAISS
-dim = embeddings.shape[1]
-index = faiss.IndexFlatL2(dim)
-index.add(np.array(embeddings))
-
-faiss.write_index(index, f"{VECTOR_DIR}/index.faiss")
-
-# 5. BM25 Index (for Level 2 - Hybrid Retrieval)
-print("Creating BM25 index...")
-tokenized_chunks = [chunk.lower().split() for chunk in chunks]
-bm25 = BM25Okapi(tokenized_chunks)
-
-with open(f"{VECTOR_DIR}/chunks.pkl", "wb") as f:
-    pickle.dump({"chunks": chunks, "meta": metadata}, f)
-
-with open(f"{VECTOR_DIR}/bm25.pkl", "wb") as f:
-    pickle.dump(bm25, f)
-
-print("✅ Ingestion completed (Vector + BM25 indexes created).")
+import sys
+
+
+def main(args):
+    # Imported here rather than at the top: the PDF extraction workers
+    # re-import this module and should not build API clients or load a model
+    import app
+    from snapshot import ingest_slot
+
+    if not os.path.isfile(args.pdf):
+        sys.exit(f"No such file: {args.pdf}")
+    filename = os.path.basename(args.pdf)
+    doc_id = args.doc_id or filename
+    mode = "replace" if args.replace else "upsert"
+
+    app.load_vectorstore()
+    if mode == "upsert" and app.snapshot_error:
+        # Merging into an unreadable corpus would silently drop it
+        sys.exit(f"Upsert refused: {app.snapshot_error} (use --replace to rebuild the corpus)")
+
+    try:
+        # Counts against the same MAX_CONCURRENT_INGESTS slots as the server's jobs
+        with ingest_slot(app.VECTOR_DIR, app.MAX_CONCURRENT_INGESTS):
+            result = app.ingest_pdf(args.pdf, filename, doc_id, mode)
+    finally:
+        app.flush_embedding_cache()
+
+    report = result["pipeline"]
+    print(f"Parsed, chunked and embedded {result['pages']} pages in {report['seconds']}s ({report['pages_per_second']} pages/s)")
+    for stage, s in report["stages"].items():
+        print(f"  {stage:<8} {s['pages']:>6} pages  {s['items']:>7} items  busy {s['busy_seconds']:>8}s  {s['pages_per_second']} pages/s")
+    if "snapshot" not in result:
+        print(f"✅ {doc_id} unchanged, nothing to ingest.")
+        return
+    print(f"✅ Ingestion completed: {doc_id} {result['pages_skipped']}/{result['pages']} pages unchanged, "
+          f"{result['chunks_added']} chunks added, {result['chunks_removed']} removed, "
+          f"{result['chunks']} in the store (snapshot {result['snapshot']}).")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf", help="PDF to ingest")
+    parser.add_argument("--doc-id", help="Stable document identifier (defaults to the file name)")
+    parser.add_argument("--replace", action="store_true", help="Drop every other document from the store")
+    main(parser.parse_args())
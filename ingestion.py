@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import time
+
+import faiss
+import numpy as np
+
+from bm25_index import BM25Index
+from chunk_store import ChunkStore
+from metrics import span, timed
+from pdf_pipeline import PipelineStats, chunk_and_embed, extract_pages, read_outline
+from sharding import write_slices
+from snapshot import Snapshot, ingest_slot, write_snapshot
+from vector_index import needs_rebuild
+
+logger = logging.getLogger(__name__)
+
+
+def writable_index(base_index):
+    """
+    Return a private, mutable copy of the live index.
+
+    The live index may be memory-mapped read-only and may be searched by
+    /ask while ingestion runs, so it is never modified in place. A clone
+    of an index mapped in place would still view the file, so the copy
+    goes through serialization.
+    """
+    return faiss.deserialize_index(faiss.serialize_index(base_index))
+
+
+def parse_pdf(path, filename, stored_doc, chunker, embed, stage_seconds, workers=4, pages_per_task=8,
+              embed_batch=512):
+    """
+    Extract, chunk and embed the pages of a PDF that differ from `stored_doc`.
+
+    Pages are parsed in `workers` processes, chunked as they arrive and
+    embedded in batches while later pages are still being parsed.
+
+    Returns:
+        (page hashes, [(page, chunks)] of changed pages, their embeddings
+        or None, pipeline report, {"page_count", "outline"})
+    """
+    new_hashes = {}
+
+    def changed(pages):
+        # Diff each page against what is stored for this document as it arrives
+        for p in pages:
+            new_hashes[p["page"]] = p["hash"]
+            if stored_doc["pages"].get(p["page"], {}).get("hash") != p["hash"]:
+                yield p
+
+    stats = PipelineStats()
+    pages = extract_pages(path, workers=workers, pages_per_task=pages_per_task, stats=stats)
+    changed_pages, embeddings = chunk_and_embed(changed(pages), chunker, embed, batch_size=embed_batch, stats=stats)
+    pipeline = stats.report()
+    for name, s in pipeline["stages"].items():
+        # Busy time of each overlapping stage, e.g. ingest_extract
+        timed(stage_seconds, f"ingest_{name}", s["busy_seconds"])
+    logger.info(f"Parsed {filename}: {len(new_hashes)} pages with text, pipeline {pipeline}")
+    return new_hashes, changed_pages, embeddings, pipeline, read_outline(path)
+
+
+def publish_ingest(root, base, parsed, filename, doc_id, stage_seconds, index_spec, build_index, info,
+                   compact_ratio=0.25, keep=3, n_shards=0, shard_by="hash", train_sample=100_000):
+    """
+    Merge a parsed PDF into the next snapshot and write it under `root`.
+
+    Only the new rows are embedded and appended to the embeddings file;
+    the chunk store, BM25 index and FAISS index are copied and written in
+    full, so a publish costs O(corpus) however little changed. `base` is
+    only read: the caller holds the publish locks and swaps the returned
+    snapshot in.
+
+    Args:
+        root: Vectorstore directory
+        base: Snapshot to build on (None starts an empty corpus)
+        parsed: parse_pdf result
+        stage_seconds: Histogram of the ingest stages
+        index_spec: (n_vectors, dim) -> index spec of the next index
+        build_index: (vectors, ids, spec) -> FAISS index
+        info: (index, bm25) -> manifest fields (see write_snapshot)
+        compact_ratio: Share of removed rows that triggers compaction
+        keep: Snapshots kept on disk
+        n_shards: Shard slices written with the snapshot (0 = none)
+        shard_by: How rows are split into the slices
+        train_sample: Training sample of IVF shard indexes
+
+    Returns:
+        (the written Snapshot, or None if the document is unchanged,
+        ingestion summary)
+    """
+    new_hashes, changed_pages, embeddings, pipeline, doc_info = parsed
+
+    if base is None:
+        base_index, base_chunks, base_documents = None, ChunkStore(), {}
+        base_bm25, base_embeddings = None, None
+    else:
+        base_index, base_chunks, base_documents = base.index, base.chunks, base.documents
+        base_bm25, base_embeddings = base.bm25, base.embeddings
+
+    old_doc = base_documents.get(doc_id, {"source": filename, "pages": {}})
+
+    removed_rows = [
+        row
+        for page_no, entry in old_doc["pages"].items()
+        if new_hashes.get(page_no) != entry["hash"]
+        for row in entry["rows"]
+    ]
+
+    outline_changed = {key: old_doc.get(key) for key in doc_info} != doc_info
+    if not changed_pages and not removed_rows and not outline_changed:
+        logger.info(f"Document {doc_id} unchanged, nothing to ingest")
+        return None, {
+            "status": "success",
+            "filename": filename,
+            "doc_id": doc_id,
+            "pages": len(new_hashes),
+            "pages_skipped": len(new_hashes),
+            "chunks_added": 0,
+            "chunks_removed": 0,
+            "chunks": base_index.ntotal if base_index is not None else 0,
+            "bm25_created": base_bm25 is not None,
+            "pipeline": pipeline
+        }
+
+    new_chunks = []
+    new_pages = []
+    page_rows = {}
+    next_row = len(base_chunks)
+    for p, page_chunks in changed_pages:
+        page_rows[p["page"]] = []
+        for c in page_chunks:
+            page_rows[p["page"]].append(next_row + len(new_chunks))
+            new_chunks.append(c)
+            new_pages.append(p["page"])
+
+    if embeddings is None and base_index is None:
+        # Only the outline changed, and there is no index to keep serving
+        raise ValueError(f"{filename} has no extractable text; nothing to index")
+
+    # Build the next snapshot aside, then swap it in
+    dim = embeddings.shape[1] if embeddings is not None else base_index.d
+    new_embeddings = embeddings if embeddings is not None else np.zeros((0, dim), dtype="float32")
+
+    def embedding_rows(rows):
+        """Embeddings of sorted rows of the next snapshot, from the base's and the new ones."""
+        old = rows[rows < next_row]
+        new = new_embeddings[rows[rows >= next_row] - next_row]
+        return np.vstack([np.asarray(base_embeddings[old], dtype="float32"), new]) if len(old) else new
+
+    next_chunks = base_chunks.copy()
+    next_chunks.remove(removed_rows)
+    next_chunks.add(new_chunks, new_pages, doc_id, filename)
+    live_rows = next_chunks.live_rows()
+    compact = len(live_rows) < (1 - compact_ratio) * len(next_chunks)
+
+    # Level 2: Update BM25 index
+    with span(stage_seconds, "ingest_bm25"):
+        next_bm25 = base_bm25.copy() if base_bm25 is not None else BM25Index()
+        next_bm25.remove_documents(removed_rows)
+        next_bm25.add_documents([chunk.lower().split() for chunk in new_chunks])
+        if compact:
+            next_bm25 = next_bm25.compact(live_rows)
+
+    doc_pages = {page_no: entry for page_no, entry in old_doc["pages"].items() if page_no in new_hashes}
+    for p, _ in changed_pages:
+        doc_pages[p["page"]] = {"hash": p["hash"], "rows": page_rows[p["page"]]}
+    next_documents = dict(base_documents)
+    next_documents[doc_id] = {"source": filename, "pages": doc_pages, **doc_info}
+
+    # Only the new rows' embeddings are written: the base's file is extended
+    next_embeddings, embeddings_base = new_embeddings, base
+    spec = index_spec(len(live_rows), dim)
+    with span(stage_seconds, "ingest_index"):
+        if compact:
+            # Too many removed rows: renumber the live ones densely and
+            # rebuild everything indexed by row over them
+            logger.info(f"Compacting {len(next_chunks)} rows to {len(live_rows)}, building {spec} index")
+            next_embeddings, embeddings_base = embedding_rows(live_rows), None
+            row_of = np.full(len(next_chunks), -1, dtype="int64")
+            row_of[live_rows] = np.arange(len(live_rows))
+            next_chunks, _ = next_chunks.compact()
+            next_index = build_index(next_embeddings, np.arange(len(live_rows), dtype="int64"), spec)
+            next_documents = {
+                key: {**doc, "pages": {page_no: {**entry, "rows": row_of[entry["rows"]].tolist()}
+                                       for page_no, entry in doc["pages"].items()}}
+                for key, doc in next_documents.items()
+            }
+        elif base_index is None or needs_rebuild(base_index, spec, removing=bool(removed_rows)):
+            # New store, index type changed, IVF outgrown or HNSW removal:
+            # rebuild (and retrain) from the row-aligned embeddings
+            logger.info(f"Building {spec} index over {len(live_rows)} vectors")
+            next_index = build_index(embedding_rows(live_rows), live_rows, spec)
+        else:
+            next_index = writable_index(base_index)
+            if removed_rows:
+                next_index.remove_ids(np.array(removed_rows, dtype="int64"))
+            if embeddings is not None:
+                next_index.add_with_ids(embeddings, np.arange(next_row, next_row + len(new_chunks), dtype="int64"))
+
+    # Persist first: the snapshot becomes current on disk only once it is
+    # complete, and the server only serves what a restart would load
+    next_snapshot = Snapshot(next_index, next_chunks, next_bm25, next_embeddings, next_documents)
+    write_shard_slices = None
+    if n_shards:
+        # Shard indexes are updated from the base's slices while rows keep their numbers
+        base_path = None
+        if base is not None and base.version and not compact:
+            base_path = os.path.join(root, "snapshots", base.version)
+
+        def write_shard_slices(path, snap):
+            with span(stage_seconds, "ingest_shard_slices"):
+                write_slices(path, snap, n_shards, shard_by, base_path=base_path, train_sample=train_sample)
+    with span(stage_seconds, "ingest_snapshot_write"):
+        write_snapshot(root, next_snapshot, info(next_index, next_bm25), keep=keep, base=embeddings_base,
+                       extra=write_shard_slices)
+
+    logger.info(
+        f"Ingestion completed for {doc_id}: {len(changed_pages)}/{len(new_hashes)} pages changed, "
+        f"{len(new_chunks)} chunks added, {len(removed_rows)} removed, snapshot {next_snapshot.version}"
+        + (" (compacted)" if compact else "")
+    )
+    return next_snapshot, {
+        "status": "success",
+        "filename": filename,
+        "doc_id": doc_id,
+        "pages": len(new_hashes),
+        "pages_skipped": len(new_hashes) - len(changed_pages),
+        "chunks_added": len(new_chunks),
+        "chunks_removed": len(removed_rows),
+        "chunks": next_index.ntotal,
+        "compacted": bool(compact),
+        "bm25_created": True,
+        "snapshot": next_snapshot.version,
+        "pipeline": pipeline
+    }
+
+
+def save_job(job, jobs_dir, max_jobs=100):
+    """Write a job's status to `jobs_dir`, where every worker's GET /ingest/{job_id} finds it."""
+    os.makedirs(jobs_dir, exist_ok=True)
+    path = os.path.join(jobs_dir, f"{job['job_id']}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(job, f)
+    os.replace(f"{path}.tmp", path)
+
+    if job["state"] in ("done", "failed"):
+        names = [name for name in os.listdir(jobs_dir) if name.endswith(".json")]
+        if len(names) > max_jobs:
+            names.sort(key=lambda name: os.path.getmtime(os.path.join(jobs_dir, name)))
+            for name in names[:-max_jobs]:
+                try:
+                    os.remove(os.path.join(jobs_dir, name))
+                except FileNotFoundError:
+                    pass
+
+
+def run_ingest_job(job, path, ingest, root, slots, jobs_dir, max_jobs=100):
+    """
+    Run `ingest()` for a queued job once an ingest slot is free, then delete the spooled `path`.
+
+    The job's state, timings and result are saved to `jobs_dir` as it
+    moves from queued to running to done or failed.
+
+    Returns:
+        The ingestion summary, or the error response
+    """
+    try:
+        # Queued until one of the `slots` shared by every worker is free
+        with ingest_slot(root, slots):
+            job["state"] = "running"
+            job["started_at"] = time.time()
+            save_job(job, jobs_dir, max_jobs)
+            result = ingest()
+        job["state"] = "done"
+    except Exception as e:
+        logger.error(f"Error during ingestion: {str(e)}")
+        result = {"status": "error", "message": str(e)}
+        job["state"] = "failed"
+    finally:
+        os.remove(path)
+    job["finished_at"] = time.time()
+    job["seconds"] = job["finished_at"] - job.get("started_at", job["finished_at"])
+    job["result"] = result
+    save_job(job, jobs_dir, max_jobs)
+    return result
@@ -0,0 +1,148 @@
+"""
+/ask latency under load, before and during a background ingest.
+
+Keeps `--concurrency` /ask requests in flight against a running server,
+first for `--baseline` seconds, then while an /ingest job for `--pdf` is
+running, and prints p50/p95/p99 for both phases. A non-blocking server
+keeps the "during ingest" percentiles close to the baseline.
+
+With `--stream` the requests go to /ask/stream and the percentiles are
+for time to first byte (the retrieval event) and to the first answer token.
+
+    python loadtest_ask.py --pdf data/Instruments.pdf --concurrency 8
+    python loadtest_ask.py --pdf data/Instruments.pdf --stream
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+import numpy as np
+
+REFUSAL = "This information is not available in the provided document(s)."
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {"requests": 0}
+    ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(float(np.percentile(ms, 50)), 1),
+        "p95_ms": round(float(np.percentile(ms, 95)), 1),
+        "p99_ms": round(float(np.percentile(ms, 99)), 1),
+        "max_ms": round(float(ms.max()), 1)
+    }
+
+
+async def ask_stream_once(client, url, payload, first_token):
+    """POST /ask/stream; returns time to first byte and records time to first token."""
+    start = time.perf_counter()
+    ttfb = None
+    got_token = False
+    async with client.stream("POST", f"{url}/ask/stream", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if ttfb is None:
+                ttfb = time.perf_counter() - start
+            if not got_token and line.startswith(("event: token", "event: done")):
+                first_token.append(time.perf_counter() - start)
+                got_token = True
+    return ttfb
+
+
+async def ask_worker(client, args, questions, stop, latencies, first_token, errors):
+    i = 0
+    while not stop.is_set():
+        question = questions[i % len(questions)]
+        payload = {"question": question, "use_hybrid": args.hybrid}
+        i += 1
+        start = time.perf_counter()
+        try:
+            if args.stream:
+                latencies.append(await ask_stream_once(client, args.url, payload, first_token))
+            else:
+                response = await client.post(f"{args.url}/ask", json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors.append(question)
+
+
+async def run_phase(client, args, questions, until):
+    """Run the /ask workers until `until` (a coroutine) completes."""
+    stop = asyncio.Event()
+    latencies, first_token, errors = [], [], []
+    workers = [
+        asyncio.create_task(ask_worker(client, args, questions, stop, latencies, first_token, errors))
+        for _ in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    detail = await until
+    stop.set()
+    await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - start
+    stats = percentiles(latencies)
+    stats["errors"] = len(errors)
+    stats["seconds"] = round(elapsed, 2)
+    stats["qps"] = round(len(latencies) / elapsed, 1) if elapsed else 0.0
+    if args.stream:
+        stats["first_token"] = percentiles(first_token)
+    return stats, detail
+
+
+async def run_ingest(client, args):
+    with open(args.pdf, "rb") as f:
+        response = await client.post(
+            f"{args.url}/ingest",
+            files={"file": (os.path.basename(args.pdf), f.read(), "application/pdf")},
+            data={"mode": args.mode, "doc_id": args.doc_id or os.path.basename(args.pdf)}
+        )
+    job = response.json()
+    if "job_id" not in job:
+        return job
+    while True:
+        await asyncio.sleep(0.2)
+        status = (await client.get(f"{args.url}/ingest/{job['job_id']}")).json()
+        if status.get("state") in ("done", "failed"):
+            return status
+
+
+async def main(args):
+    with open(args.questions) as f:
+        questions = [q["q"] for q in json.load(f)]
+
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        baseline, _ = await run_phase(client, args, questions, asyncio.sleep(args.baseline))
+        during, job = await run_phase(client, args, questions, run_ingest(client, args))
+
+    if args.stream:
+        print("latency = time to first byte (retrieval event)")
+    print(f"{'phase':<14} {'requests':>8} {'qps':>7} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'max_ms':>8} {'errors':>6}")
+    for name, stats in (("baseline", baseline), ("during ingest", during)):
+        print(
+            f"{name:<14} {stats['requests']:>8} {stats['qps']:>7} {stats.get('p50_ms', '-'):>8} "
+            f"{stats.get('p95_ms', '-'):>8} {stats.get('p99_ms', '-'):>8} {stats.get('max_ms', '-'):>8} {stats['errors']:>6}"
+        )
+    if args.stream:
+        for name, stats in (("baseline", baseline), ("during ingest", during)):
+            ft = stats["first_token"]
+            print(f"first token, {name}: p50 {ft.get('p50_ms', '-')} ms, p99 {ft.get('p99_ms', '-')} ms")
+    print(f"\ningest job: {job.get('state', job.get('status'))}, {job.get('seconds', 0):.1f}s, result={job.get('result')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--pdf", required=True, help="PDF to ingest during the second phase")
+    parser.add_argument("--questions", default="questions.json")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--baseline", type=float, default=10.0, help="Seconds of load before the ingest starts")
+    parser.add_argument("--hybrid", action="store_true", help="Send use_hybrid: true")
+    parser.add_argument("--stream", action="store_true", help="Use /ask/stream and report time to first byte/token")
+    parser.add_argument("--mode", default="upsert", choices=["upsert", "replace"])
+    parser.add_argument("--doc-id", default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,164 @@
+"""
+Deterministic local stand-ins for the Azure OpenAI embedding and chat APIs.
+
+Used by the offline benchmarks so retrieval can be measured in-process,
+without network calls, keys or per-run cost. The stand-ins have the same
+call shapes as the OpenAI clients (`embeddings.create`,
+`chat.completions.create`), so `EmbeddingClient`, the caches and the
+/ask handlers run unchanged on top of them.
+
+The embedding is a signed feature-hashing bag of words over lowercased
+terms and their 5-letter prefixes (so "blocked" and "blockage" share a
+feature). It is not semantic, but it is stable across runs and machines,
+which is what a regression benchmark needs.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+
+import numpy as np
+
+from embeddings import estimate_tokens
+
+DIM = 384
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how if in is it its of on or should "
+    "that the their there these they this to was what when where which while why will "
+    "with would".split()
+)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def terms(text):
+    """Lowercased content words of a text."""
+    return [t for t in _TOKEN.findall(text.lower()) if t not in STOPWORDS]
+
+
+@lru_cache(maxsize=200_000)
+def _feature(term, dim):
+    digest = hashlib.blake2b(term.encode(), digest_size=8).digest()
+    value = int.from_bytes(digest, "little")
+    return value % dim, 1.0 if (value >> 63) else -1.0
+
+
+def hash_embedding(text, dim=DIM):
+    """Unit-length hashed bag-of-words vector of one text."""
+    vector = np.zeros(dim, dtype="float32")
+    for term in terms(text):
+        i, sign = _feature(term, dim)
+        vector[i] += sign
+        if len(term) > 5:
+            i, sign = _feature(term[:5] + "~", dim)
+            vector[i] += 0.5 * sign
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def _embedding_response(texts, dim):
+    data = [SimpleNamespace(index=i, embedding=hash_embedding(t, dim).tolist()) for i, t in enumerate(texts)]
+    tokens = sum(estimate_tokens(t) for t in texts)
+    return SimpleNamespace(data=data, usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens))
+
+
+class LocalEmbeddings:
+    """`client.embeddings` of a sync client; `latency` seconds are added per request."""
+
+    def __init__(self, dim=DIM, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+
+    def create(self, model, input, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return _embedding_response(input, self.dim)
+
+
+class AsyncLocalEmbeddings(LocalEmbeddings):
+    async def create(self, model, input, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return _embedding_response(input, self.dim)
+
+
+def extractive_answer(prompt, words=40):
+    """
+    The context sentence sharing most terms with the question, cut to `words` words.
+
+    Falls back to the refusal-style reply when nothing overlaps, so the
+    refusal paths are exercised too.
+    """
+    context, _, question = prompt.rpartition("Question:")
+    question_terms = set(terms(question.split("\n\n")[0]))
+    best, best_overlap = None, 0
+    for sentence in re.split(r"(?<=[.!?])\s+|\n+", context):
+        overlap = len(question_terms.intersection(terms(sentence)))
+        if overlap > best_overlap:
+            best, best_overlap = sentence, overlap
+    if best is None:
+        return "This information is not available in the provided document(s)."
+    return " ".join(best.split()[:words])
+
+
+class _Completions:
+    def __init__(self, latency, first_token_latency):
+        self.latency = latency
+        self.first_token_latency = first_token_latency
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        prompt = messages[-1]["content"]
+        answer = extractive_answer(prompt)
+        usage = SimpleNamespace(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(answer))
+        if not stream:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            message = SimpleNamespace(content=answer)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+        return self._stream(answer)
+
+    async def _stream(self, answer):
+        if self.first_token_latency:
+            await asyncio.sleep(self.first_token_latency)
+        pieces = answer.split(" ")
+        delay = max(0.0, self.latency - self.first_token_latency) / max(1, len(pieces))
+        for i, piece in enumerate(pieces):
+            if delay:
+                await asyncio.sleep(delay)
+            content = piece if i == 0 else " " + piece
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class LocalChat:
+    """
+    `client.chat` of an async client answering extractively from the prompt.
+
+    Args:
+        latency: Seconds per completion (spread over the stream when streaming)
+        first_token_latency: Seconds before the first streamed token
+    """
+
+    def __init__(self, latency=0.0, first_token_latency=0.0):
+        self.completions = _Completions(latency, first_token_latency)
+
+
+def install(app, dim=DIM, embed_latency=0.0, chat_latency=0.0):
+    """
+    Point the app's embedding and chat clients at the local stand-ins.
+
+    Only the Azure embedding backend is replaced: with
+    EMBEDDING_BACKEND=onnx the local model already runs offline and is
+    kept. The embedding and answer caches are turned off so every call
+    does the work being measured.
+    """
+    if app.embedder.backend == "azure":
+        app.embedder.client = SimpleNamespace(embeddings=LocalEmbeddings(dim, embed_latency))
+        app.embedder.async_client = SimpleNamespace(embeddings=AsyncLocalEmbeddings(dim, embed_latency))
+    app.client.chat = LocalChat(chat_latency, chat_latency / 4)
+    app.embedding_cache = None
+    app.answer_cache = None
@@ -0,0 +1,255 @@
+import math
+import threading
+from collections import OrderedDict, namedtuple
+
+import faiss
+import numpy as np
+
+from vector_index import describe, search_params
+
+# Metadata filter of one retrieval request. Hashable, so it keys the
+# selection cache and question micro-batches; None fields do not filter.
+#   doc_ids    only these documents
+#   sections   only chapters/sections whose outline title contains one of
+#              these (lowercase)
+#   page_from / page_to   only pages in this range (inclusive)
+RowFilter = namedtuple("RowFilter", ["doc_ids", "sections", "page_from", "page_to"])
+
+
+def make_filter(doc_ids=None, sections=None, page_from=None, page_to=None):
+    """RowFilter from request parameters, or None when nothing is filtered."""
+    if not doc_ids and not sections and page_from is None and page_to is None:
+        return None
+    sections = sorted({s.strip().lower() for s in sections or [] if s.strip()})
+    return RowFilter(tuple(sorted(set(doc_ids))) if doc_ids else None, tuple(sections) or None, page_from, page_to)
+
+
+class Selection:
+    """
+    The rows passing one filter, with search structures built for them.
+
+    Narrow selections are searched as their own partition: exact cosine
+    against their rows of the embedding matrix, and a BM25Index.subset of
+    their postings. Wider ones search the full index restricted by an ID
+    selector (FAISS) or row mask (BM25). Both are built on first use and
+    kept with the selection.
+    """
+
+    def __init__(self, rows, n_rows):
+        self.rows = rows
+        self.n_rows = n_rows
+        self._selector = None
+        self._mask = None
+        self._bm25 = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def contiguous(self):
+        return len(self.rows) > 0 and self.rows[-1] - self.rows[0] + 1 == len(self.rows)
+
+    def selector(self):
+        with self._lock:
+            if self._selector is None:
+                # IDSelectorBatch copies the ids into its own hash set
+                self._selector = faiss.IDSelectorBatch(len(self.rows), faiss.swig_ptr(self.rows))
+            return self._selector
+
+    def mask(self):
+        with self._lock:
+            if self._mask is None:
+                mask = np.zeros(self.n_rows, dtype=bool)
+                mask[self.rows] = True
+                self._mask = mask
+            return self._mask
+
+    def bm25(self, bm25):
+        with self._lock:
+            if self._bm25 is None:
+                self._bm25 = bm25.subset(self.rows)
+            return self._bm25
+
+
+class MetadataIndex:
+    """
+    Document, section and page lookups over the rows of one snapshot.
+
+    Built once per snapshot (see Snapshot.metadata) from the ChunkStore
+    columns and the PDF outlines in the document registry. Every outline
+    entry is a section that runs from its page to the page before the
+    next entry; its chapter is the latest top-level entry. Rows are
+    grouped per document and per section, so a filter is resolved to row
+    ids with a few array operations instead of a scan of the metadata.
+
+    Resolved filters are cached as Selections (LRU of `cache_size`), so
+    repeated filters reuse their ID selectors and sub-indexes.
+
+    Args:
+        snap: Snapshot to index
+        cache_size: Selections kept
+    """
+
+    def __init__(self, snap, cache_size=32):
+        # The parts it searches rather than the snapshot itself: without a
+        # reference cycle an old snapshot is unmapped as soon as it is unused
+        self.chunks = snap.chunks
+        self.index = snap.index
+        self.embeddings = snap.embeddings
+        self.bm25 = snap.bm25
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        chunks = snap.chunks
+        live = chunks.live_rows()
+        doc_of = np.asarray(chunks.doc)[live]
+        order = np.argsort(doc_of, kind="stable")
+        bounds = np.searchsorted(doc_of[order], np.arange(len(chunks.docs) + 1))
+        self.doc_rows = {}  # doc_id -> sorted live rows
+        for i, doc in enumerate(chunks.docs):
+            rows = live[order[bounds[i]:bounds[i + 1]]]
+            if len(rows):
+                # A renamed document is interned once per source
+                previous = self.doc_rows.get(doc["doc_id"])
+                self.doc_rows[doc["doc_id"]] = rows if previous is None else np.union1d(previous, rows)
+
+        self.sections = []  # {"doc_id", "chapter", "section", "pages": [first, last]}
+        self.row_section = np.full(len(chunks), -1, dtype="int32")
+        for doc_id, rows in self.doc_rows.items():
+            doc = snap.documents.get(doc_id, {})
+            outline = doc.get("outline")
+            if not outline:
+                continue
+            first_pages = np.array([entry["page"] for entry in outline], dtype="int64")
+            last_page = doc.get("page_count") or int(max(doc["pages"], default=first_pages[-1]))
+            top = min(entry["level"] for entry in outline)
+            base = len(self.sections)
+            chapter = None
+            for j, entry in enumerate(outline):
+                if entry["level"] == top:
+                    chapter = entry["title"]
+                end = int(first_pages[j + 1]) - 1 if j + 1 < len(outline) else last_page
+                self.sections.append({
+                    "doc_id": doc_id,
+                    "chapter": chapter,
+                    "section": entry["title"],
+                    "pages": [entry["page"], max(entry["page"], end)]
+                })
+            # Section of a row: the last outline entry at or before its page
+            entry_of = np.searchsorted(first_pages, np.asarray(chunks.page)[rows], side="right") - 1
+            self.row_section[rows[entry_of >= 0]] = base + entry_of[entry_of >= 0]
+
+    def meta(self, row):
+        """ChunkStore.meta of a row plus its "chapter" and "section", if the document has an outline."""
+        m = self.chunks.meta(row)
+        section = self.row_section[row]
+        if m is not None and section >= 0:
+            m["chapter"] = self.sections[section]["chapter"]
+            m["section"] = self.sections[section]["section"]
+        return m
+
+    def outline(self, doc_id):
+        """Sections of one document, in page order."""
+        return [s for s in self.sections if s["doc_id"] == doc_id]
+
+    def rows(self, filters):
+        """Sorted live row ids passing a RowFilter."""
+        chunks = self.chunks
+        if filters.doc_ids:
+            parts = [self.doc_rows[d] for d in filters.doc_ids if d in self.doc_rows]
+            rows = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype="int64")
+        else:
+            rows = chunks.live_rows()
+        if filters.sections:
+            matching = [
+                i for i, s in enumerate(self.sections)
+                if any(term in s["section"].lower() or term in (s["chapter"] or "").lower() for term in filters.sections)
+            ]
+            rows = rows[np.isin(self.row_section[rows], matching)]
+        if filters.page_from is not None:
+            rows = rows[np.asarray(chunks.page)[rows] >= filters.page_from]
+        if filters.page_to is not None:
+            rows = rows[np.asarray(chunks.page)[rows] <= filters.page_to]
+        return np.ascontiguousarray(rows, dtype="int64")
+
+    def selection(self, filters):
+        """Cached Selection of a RowFilter."""
+        with self._lock:
+            selection = self._cache.get(filters)
+            if selection is not None:
+                self._cache.move_to_end(filters)
+                return selection
+        selection = Selection(self.rows(filters), len(self.chunks))
+        with self._lock:
+            self._cache[filters] = selection
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return selection
+
+    def _exact(self, selection, q_embs, k):
+        """Top k of the selection's rows by exact cosine, shaped like a faiss search."""
+        n = len(selection)
+        D = np.full((len(q_embs), k), -np.inf, dtype="float32")
+        I = np.full((len(q_embs), k), -1, dtype="int64")
+        if n:
+            rows = selection.rows
+            # A document's rows are usually one run: a view, not a copy
+            vectors = self.embeddings[rows[0]:rows[-1] + 1] if selection.contiguous else self.embeddings[rows]
+            scores = q_embs @ np.asarray(vectors, dtype="float32").T
+            kept = min(k, n)
+            if n > kept:
+                top = np.argpartition(-scores, kept - 1, axis=1)[:, :kept]
+            else:
+                top = np.broadcast_to(np.arange(n), scores.shape)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            D[:, :kept] = np.take_along_axis(top_scores, order, axis=1)
+            I[:, :kept] = rows[np.take_along_axis(top, order, axis=1)]
+        return D, I
+
+    def search(self, filters, q_embs, token_lists, k, bm25_k=0, nprobe=None, ef_search=None, exact_rows=20000):
+        """
+        FAISS and BM25 top k of every question among the rows passing `filters`.
+
+        Up to `exact_rows` rows are scored directly, so a narrow filter
+        costs a fraction of a full search and is exact for every index
+        type; beyond that the index is searched with an ID selector.
+        An IVF or HNSW selector search only keeps the selection's share
+        of the candidates it visits, so nprobe / ef_search are scaled by
+        the inverse of that share; questions that still get fewer than k
+        hits are scored directly.
+
+        Returns:
+            (D, I) shaped like a faiss search (padded with id -1), and one
+            (row ids, scores) BM25 pair per question, best first (None
+            without bm25_k)
+        """
+        selection = self.selection(filters)
+        n = len(selection)
+        q_embs = np.ascontiguousarray(q_embs, dtype="float32")
+
+        if n <= exact_rows:
+            D, I = self._exact(selection, q_embs, k)
+        else:
+            info = describe(self.index)
+            scale = self.index.ntotal / n
+            if info["type"] in ("ivf", "ivfpq"):
+                nprobe = min(info["nlist"], math.ceil((nprobe or info["nprobe"]) * scale))
+            elif info["type"] == "hnsw":
+                ef_search = min(self.index.ntotal, max(k, math.ceil((ef_search or info["ef_search"]) * scale)))
+            params = search_params(self.index, nprobe, ef_search, sel=selection.selector())
+            D, I = self.index.search(q_embs, k, params=params)
+            short = I[:, min(k, n) - 1] < 0
+            if short.any():
+                D[short], I[short] = self._exact(selection, q_embs[short], k)
+
+        bm25_hits = None
+        if bm25_k:
+            if n <= exact_rows:
+                sub = selection.bm25(self.bm25)
+                bm25_hits = [(selection.rows[ids], scores) for ids, scores in sub.top_k_batch(token_lists, bm25_k)]
+            else:
+                bm25_hits = self.bm25.top_k_batch(token_lists, bm25_k, allowed=selection.mask())
+        return D, I, bm25_hits
@@ -0,0 +1,218 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a BM25 lookup to a slow chat completion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, one series per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labelnames, key), value) for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in the Prometheus exposition format.
+
+    Args:
+        name: Metric name (without the _bucket/_sum/_count suffixes)
+        help: Help text
+        labelnames: Label names, values are passed to `observe`
+        buckets: Upper bounds in ascending order (+Inf is implied)
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self.series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                out.append((f"{self.name}_bucket", _labels(self.labelnames + ("le",), key + (_number(bound),)), cumulative))
+            out.append((f"{self.name}_bucket", _labels(self.labelnames + ("le",), key + ("+Inf",)), series[-1]))
+            out.append((f"{self.name}_sum", _labels(self.labelnames, key), series[-2]))
+            out.append((f"{self.name}_count", _labels(self.labelnames, key), series[-1]))
+        return out
+
+
+class Registry:
+    """
+    Metrics rendered by /metrics.
+
+    Counters and histograms are updated as requests run. Collectors are
+    called at render time for values other components already count
+    (embedding client, caches): each returns (name, kind, help,
+    [(labels dict, value)]) tuples.
+
+    Args:
+        const_labels: Labels added to every series, e.g. {"pid": ...} so
+            the series of several worker processes stay apart
+    """
+
+    def __init__(self, const_labels=None):
+        self.metrics = []
+        self.collectors = []
+        self.const_labels = dict(const_labels or {})
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        const = _labels(tuple(self.const_labels), tuple(self.const_labels.values()))[1:-1]
+
+        def with_const(labels):
+            if not const:
+                return labels
+            return f"{{{const},{labels[1:]}" if labels else f"{{{const}}}"
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{with_const(labels)} {_number(value)}")
+        for fn in self.collectors:
+            for name, kind, help, values in fn():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values:
+                    lines.append(f"{name}{with_const(_labels(tuple(labels), tuple(labels.values())))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Stage timings of one request, for the `debug` response."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def merge(self, other):
+        """Add the stages of another trace, e.g. of a batch this request waited for."""
+        with other._lock:
+            stages = dict(other.stages)
+        with self._lock:
+            for stage, (seconds, count) in stages.items():
+                total, n = self.stages.get(stage, (0.0, 0))
+                self.stages[stage] = (total + seconds, n + count)
+
+    def report(self):
+        """{"total_ms", "stages": {stage: ms}}; stages run more than once also report "<stage>_count"."""
+        with self._lock:
+            stages = {}
+            for stage, (total, count) in self.stages.items():
+                stages[stage] = round(total * 1000, 2)
+                if count > 1:
+                    stages[f"{stage}_count"] = count
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 2), "stages": stages}
+
+
+# Trace of the request being handled. Threadpool calls and tasks started
+# by the request copy the context, so their stages land in the same Trace
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace():
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def timed(histogram, stage, seconds):
+    """Record a stage duration in the histogram and the current request's trace."""
+    histogram.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(histogram, stage):
+    """Time a block as `stage` (see `timed`)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timed(histogram, stage, time.perf_counter() - start)
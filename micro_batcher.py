@@ -0,0 +1,131 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent single-item calls into batched calls.
+
+    Items submitted within `max_wait` seconds of the first pending item
+    are sent together to `run_batch`, or as soon as `max_batch` items are
+    waiting. Items are grouped by `group` (e.g. retrieval parameters);
+    each group becomes its own `run_batch` call. An item whose key is
+    already pending or in flight is not added again: its caller waits for
+    the same result.
+
+    `run_batch(group, items)` is a coroutine returning one result per
+    item, in order. It runs in a fresh context, so it does not write into
+    the context variables (request traces) of whichever caller started
+    the batch. An exception, or cancellation of the batch, fails every
+    caller of that batch.
+
+    Args:
+        run_batch: Coroutine function (group, items) -> results
+        max_batch: Items per batch
+        max_wait: Seconds the first item of a batch waits for others
+    """
+
+    def __init__(self, run_batch, max_batch=32, max_wait=0.002):
+        self.run_batch = run_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.pending = {}  # group -> [(key, item)], in arrival order
+        self.futures = {}  # key -> future, pending or in flight
+        self.timers = {}  # group -> TimerHandle of the scheduled flush
+        self.loop = None
+        self._lock = threading.Lock()
+        self.metrics = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "batches": 0,
+            "items": 0,
+            "full_batches": 0
+        }
+
+    def _bind(self, loop):
+        # Futures and timers belong to one event loop; start over on a new one
+        if self.loop is not loop:
+            self.loop = loop
+            self.pending = {}
+            self.futures = {}
+            self.timers = {}
+
+    async def submit(self, group, item, key=None):
+        """
+        Result of `item` from a batched `run_batch` call.
+
+        Args:
+            group: Hashable batch group; only items of one group share a call
+            item: The item to process
+            key: Hashable identity for deduplication within the group
+                 (the item itself if None)
+        """
+        loop = asyncio.get_running_loop()
+        self._bind(loop)
+        key = (group, item if key is None else key)
+
+        with self._lock:
+            self.metrics["submitted"] += 1
+            future = self.futures.get(key)
+            if future is not None:
+                self.metrics["deduplicated"] += 1
+        if future is None:
+            future = loop.create_future()
+            self.futures[key] = future
+            batch = self.pending.setdefault(group, [])
+            batch.append((key, item))
+            if len(batch) >= self.max_batch:
+                self._flush(group, full=True)
+            elif group not in self.timers:
+                self.timers[group] = loop.call_later(self.max_wait, self._flush, group)
+
+        # A cancelled caller must not cancel the result other callers share
+        return await asyncio.shield(future)
+
+    def _flush(self, group, full=False):
+        timer = self.timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(group, None)
+        if not batch:
+            return
+        with self._lock:
+            self.metrics["batches"] += 1
+            self.metrics["items"] += len(batch)
+            self.metrics["full_batches"] += full
+        # Empty context: the batch's spans are not recorded in the trace of
+        # the request that happened to arrive first
+        contextvars.Context().run(self.loop.create_task, self._run(group, batch))
+
+    async def _run(self, group, batch):
+        started = time.perf_counter()
+        error = None
+        try:
+            results = await self.run_batch(group, [item for _, item in batch])
+            for (key, _), result in zip(batch, results):
+                future = self.futures.pop(key)
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            logger.error(f"Batch of {len(batch)} failed: {e}")
+            error = e
+        finally:
+            # Also when the task is cancelled (e.g. at shutdown) or
+            # run_batch returned too few results: no caller waits forever
+            for key, _ in batch:
+                future = self.futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(error or RuntimeError(f"Batch of {len(batch)} did not complete"))
+        logger.debug(f"Ran batch of {len(batch)} in {time.perf_counter() - started:.4f}s")
+
+    def stats(self):
+        """Counters plus the mean batch size."""
+        with self._lock:
+            stats = dict(self.metrics)
+        stats["mean_batch_size"] = round(stats["items"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,34 @@
+"""
+One-off conversion of a pickled chunks.pkl store to the columnar chunk store.
+
+The server never unpickles anything. Run this once, on a vectorstore you
+trust, to turn chunks.pkl into chunks/ and documents.json; the next
+server start imports those together with index.faiss as the first
+snapshot.
+
+    python migrate_chunks_pickle.py [vectorstore]
+"""
+import os
+import pickle
+import sys
+
+from chunk_store import ChunkStore, save_json
+
+
+def main():
+    vector_dir = sys.argv[1] if len(sys.argv) > 1 else "vectorstore"
+    path = os.path.join(vector_dir, "chunks.pkl")
+    if not os.path.exists(path):
+        raise SystemExit(f"{path} not found")
+
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    store = ChunkStore.from_lists(data["chunks"], data["meta"])
+    store.save(os.path.join(vector_dir, "chunks"))
+    save_json(os.path.join(vector_dir, "documents.json"), data.get("documents", {}))
+    os.remove(path)
+    print(f"Converted {len(store)} chunks to {vector_dir}/chunks")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import hashlib
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PyPDF2 import PdfReader
+
+logger = logging.getLogger(__name__)
+
+# Reader opened once per extraction worker process by `_open_reader`
+_reader = None
+
+
+def page_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def open_pdf(source):
+    """
+    PdfReader over a file path or the raw bytes of a PDF.
+
+    Files are memory-mapped rather than read, so the reader pages the
+    PDF in from the OS cache on demand and every worker process shares
+    the same physical pages.
+    """
+    if not isinstance(source, str):
+        return PdfReader(io.BytesIO(source))
+    with open(source, "rb") as f:
+        # The mapping stays valid after the file is closed
+        return PdfReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def rss_mb():
+    """Resident set size of this process in MB, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def read_outline(source):
+    """
+    Page count and outline (bookmarks) of a PDF, for the document registry.
+
+    The outline is flattened in document order; every entry has its
+    nesting level (0 = top, the chapters) and the 1-based page it points
+    to. Entries without a resolvable page are skipped, and a broken
+    outline is logged and read as empty.
+
+    Returns:
+        {"page_count", "outline": [{"title", "level", "page"}]} sorted by page
+    """
+    reader = open_pdf(source)
+    outline = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                walk(item, level + 1)
+                continue
+            page = reader.get_destination_page_number(item)
+            title = (item.title or "").strip()
+            if page is not None and page >= 0 and title:
+                outline.append({"title": title, "level": level, "page": page + 1})
+
+    try:
+        walk(reader.outline, 0)
+    except Exception as e:
+        logger.warning(f"Could not read the PDF outline: {e}")
+        outline = []
+    outline.sort(key=lambda entry: entry["page"])
+    return {"page_count": len(reader.pages), "outline": outline}
+
+
+def _open_reader(source):
+    global _reader
+    _reader = open_pdf(source)
+
+
+def _extract(reader, start, end):
+    began = time.perf_counter()
+    pages = []
+    for i in range(start, end):
+        text = reader.pages[i].extract_text()
+        if text:
+            pages.append({"page": i + 1, "text": text, "hash": page_hash(text)})
+    return pages, began, time.perf_counter(), rss_mb()
+
+
+def _extract_range(start, end):
+    return _extract(_reader, start, end)
+
+
+class PipelineStats:
+    """
+    Per-stage throughput of one ingestion run.
+
+    Stages overlap, so each reports its busy time (sum of the time spent
+    in that stage) and its span (first start to last finish); pages/s is
+    measured over the span. Process RSS is sampled whenever a stage
+    finishes a unit of work, and extraction workers report their own.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.rss_start = rss_mb()
+        self.rss_peak = self.rss_start
+        self.worker_rss_peak = None
+        self._lock = threading.Lock()
+
+    def record(self, stage, began, finished, pages=0, items=0, worker_rss=None):
+        rss = rss_mb()
+        with self._lock:
+            if rss is not None:
+                self.rss_peak = max(self.rss_peak or 0.0, rss)
+            if worker_rss is not None:
+                self.worker_rss_peak = max(self.worker_rss_peak or 0.0, worker_rss)
+            s = self.stages.setdefault(stage, {"pages": 0, "items": 0, "busy": 0.0, "first": began, "last": finished})
+            s["pages"] += pages
+            s["items"] += items
+            s["busy"] += finished - began
+            s["first"] = min(s["first"], began)
+            s["last"] = max(s["last"], finished)
+
+    def report(self):
+        wall = time.perf_counter() - self.started
+        with self._lock:
+            stages = {}
+            for name, s in self.stages.items():
+                span = s["last"] - s["first"]
+                stages[name] = {
+                    "pages": s["pages"],
+                    "items": s["items"],
+                    "busy_seconds": round(s["busy"], 3),
+                    "span_seconds": round(span, 3),
+                    "pages_per_second": round(s["pages"] / span, 1) if span > 0 else None
+                }
+        pages = stages.get("extract", {}).get("pages", 0)
+        rss = {"start": self.rss_start, "peak": self.rss_peak, "end": rss_mb(), "extract_worker_peak": self.worker_rss_peak}
+        return {
+            "seconds": round(wall, 3),
+            "pages_per_second": round(pages / wall, 1) if wall > 0 else None,
+            "stages": stages,
+            "rss_mb": {name: round(value, 1) if value is not None else None for name, value in rss.items()}
+        }
+
+
+def extract_pages(source, workers=4, pages_per_task=8, stats=None):
+    """
+    Yield the text of each non-empty page, in page order, as it is parsed.
+
+    Pages are extracted in ranges of `pages_per_task` by a pool of
+    `workers` processes, each holding its own reader, so text extraction
+    uses several cores. At most two ranges per worker are in flight, which
+    bounds how much parsed text waits in memory for a slow consumer.
+    Small documents (one range) and workers <= 1 are parsed in-process.
+
+    Args:
+        source: Path to the PDF (memory-mapped) or its bytes
+        workers: Extraction processes
+        pages_per_task: Pages per extraction task
+        stats: Optional PipelineStats, records the "extract" stage
+
+    Yields:
+        {"page": 1-based page number, "text", "hash"}
+    """
+    reader = open_pdf(source)
+    n_pages = len(reader.pages)
+    ranges = [(start, min(n_pages, start + pages_per_task)) for start in range(0, n_pages, pages_per_task)]
+    logger.info(f"Extracting {n_pages} pages ({len(ranges)} tasks, {workers} workers)")
+
+    if workers <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            pages, began, finished, _ = _extract(reader, start, end)
+            if stats is not None:
+                stats.record("extract", began, finished, pages=end - start)
+            yield from pages
+        return
+    del reader
+
+    # spawn, not fork: the server process runs FAISS/OpenMP and event-loop threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_open_reader, initargs=(source,)) as pool:
+        todo = iter(ranges)
+        pending = deque()
+        for start, end in todo:
+            pending.append((end - start, pool.submit(_extract_range, start, end)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            n, future = pending.popleft()
+            pages, began, finished, worker_rss = future.result()
+            for start, end in todo:
+                pending.append((end - start, pool.submit(_extract_range, start, end)))
+                break
+            if stats is not None:
+                stats.record("extract", began, finished, pages=n, worker_rss=worker_rss)
+            yield from pages
+
+
+def chunk_and_embed(pages, chunker, embed, batch_size=512, max_pending=2, stats=None):
+    """
+    Chunk pages as they arrive and embed the chunks while parsing continues.
+
+    Chunks are collected into batches of `batch_size` and each full batch
+    is handed to `embed` on a background thread. When `max_pending`
+    batches are already being embedded the pipeline waits for the oldest,
+    so parsing never runs far ahead of the embedding API.
+
+    Args:
+        pages: Iterable of page dicts (e.g. from `extract_pages`)
+        chunker: Function splitting a page's text into chunks
+        embed: Function returning a float32 array for a list of texts
+        batch_size: Chunks per embedding call
+        max_pending: Embedding calls in flight at once
+        stats: Optional PipelineStats, records "chunk" and "embed"
+
+    Returns:
+        (list of (page dict without text, chunks), embeddings or None)
+    """
+    chunked = []
+    batch = []
+    batch_pages = 0
+    pending = deque()
+    done = []
+
+    def run(texts, n_pages):
+        began = time.perf_counter()
+        vectors = embed(texts)
+        if stats is not None:
+            stats.record("embed", began, time.perf_counter(), pages=n_pages, items=len(texts))
+        return vectors
+
+    with ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix="ingest-embed") as executor:
+        def submit(texts, n_pages):
+            if len(pending) >= max_pending:
+                done.append(pending.popleft().result())
+            pending.append(executor.submit(run, texts, n_pages))
+
+        for page in pages:
+            began = time.perf_counter()
+            page_chunks = chunker(page["text"])
+            # Keep the chunks, not the page text
+            chunked.append(({"page": page["page"], "hash": page["hash"]}, page_chunks))
+            if stats is not None:
+                stats.record("chunk", began, time.perf_counter(), pages=1, items=len(page_chunks))
+
+            batch.extend(page_chunks)
+            batch_pages += 1
+            while len(batch) >= batch_size:
+                submit(batch[:batch_size], batch_pages)
+                batch = batch[batch_size:]
+                batch_pages = 0
+        if batch:
+            submit(batch, batch_pages)
+        done.extend(future.result() for future in pending)
+
+    embeddings = np.vstack(done).astype("float32", copy=False) if done else None
+    return chunked, embeddings
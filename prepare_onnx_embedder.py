@@ -0,0 +1,104 @@
+"""
+Prepare the local ONNX embedding model used by EMBEDDING_BACKEND=onnx.
+
+Downloads the tokenizer and the ONNX export of a sentence-transformers
+model from the Hugging Face hub (or takes a local --onnx file), quantizes
+the weights to int8 with ONNX Runtime dynamic quantization, and writes
+embedder.json next to them. With --check, questions.json is embedded
+with both variants and the int8 vectors are compared with fp32.
+
+    python prepare_onnx_embedder.py                        # models/all-MiniLM-L6-v2
+    python prepare_onnx_embedder.py --check
+    python prepare_onnx_embedder.py --onnx exported/model.onnx --tokenizer exported/tokenizer.json
+
+Needs onnxruntime and tokenizers (and huggingface_hub to download).
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+def download(repo, out_dir):
+    from huggingface_hub import hf_hub_download
+
+    for remote, local in (("tokenizer.json", "tokenizer.json"), ("onnx/model.onnx", "model.onnx")):
+        path = hf_hub_download(repo, remote)
+        shutil.copyfile(path, os.path.join(out_dir, local))
+
+
+def output_dim(model_path):
+    """Embedding width of an encoder, from a one-token inference."""
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    feeds = {}
+    for i in session.get_inputs():
+        feeds[i.name] = np.ones((1, 1), dtype="int64") if i.name != "token_type_ids" else np.zeros((1, 1), dtype="int64")
+    return int(session.run(None, feeds)[0].shape[-1])
+
+
+def check(out_dir, questions):
+    from embedding_backends import OnnxEmbedder
+
+    vectors = {}
+    for variant in ("fp32", "int8"):
+        embedder = OnnxEmbedder(out_dir, variant=variant)
+        embedder.embed(questions[:4])  # warm-up
+        start = time.perf_counter()
+        vectors[variant] = embedder.embed(questions)
+        elapsed = time.perf_counter() - start
+        print(f"{variant}: {len(questions) / elapsed:.0f} texts/s")
+    cosine = (vectors["fp32"] * vectors["int8"]).sum(axis=1)
+    top_fp32 = np.argsort(-(vectors["fp32"] @ vectors["fp32"].T), axis=1)[:, 1:6]
+    top_int8 = np.argsort(-(vectors["int8"] @ vectors["int8"].T), axis=1)[:, 1:6]
+    overlap = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(top_fp32, top_int8)])
+    print(f"int8 vs fp32 cosine: min {cosine.min():.4f}, mean {cosine.mean():.4f}; "
+          f"question neighbours top-5 overlap {overlap:.2%}")
+
+
+def main(args):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(args.out, exist_ok=True)
+    if args.onnx:
+        shutil.copyfile(args.onnx, os.path.join(args.out, "model.onnx"))
+        shutil.copyfile(args.tokenizer, os.path.join(args.out, "tokenizer.json"))
+    else:
+        download(args.repo, args.out)
+
+    fp32 = os.path.join(args.out, "model.onnx")
+    int8 = os.path.join(args.out, "model_int8.onnx")
+    quantize_dynamic(fp32, int8, weight_type=QuantType.QInt8)
+
+    config = {
+        "model": args.model or args.repo.split("/")[-1],
+        "dim": output_dim(fp32),
+        "pooling": "mean",
+        "max_length": args.max_length,
+        "variants": {"fp32": "model.onnx", "int8": "model_int8.onnx"}
+    }
+    with open(os.path.join(args.out, "embedder.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    print(f"Wrote {args.out}: {config['model']}, {config['dim']} dims, "
+          f"fp32 {os.path.getsize(fp32) / 2 ** 20:.1f} MB, int8 {os.path.getsize(int8) / 2 ** 20:.1f} MB")
+
+    if args.check:
+        with open(args.questions) as f:
+            check(args.out, [q["q"] for q in json.load(f)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repo", default="sentence-transformers/all-MiniLM-L6-v2", help="Hugging Face model repo")
+    parser.add_argument("--model", help="Model name recorded in manifests (default: the repo name)")
+    parser.add_argument("--onnx", help="Use this exported ONNX file instead of downloading")
+    parser.add_argument("--tokenizer", help="tokenizer.json to use with --onnx")
+    parser.add_argument("--out", default="models/all-MiniLM-L6-v2")
+    parser.add_argument("--max-length", type=int, default=256, help="Truncation length in tokens")
+    parser.add_argument("--check", action="store_true", help="Compare int8 with fp32 on questions.json")
+    parser.add_argument("--questions", default="questions.json")
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+import numpy as np
+
+from fusion import reciprocal_rank_fusion, weighted_fusion
+from metrics import span
+from vector_index import search_params
+
+
+def search_snapshot(snap, questions, q_embs, k, stage_seconds, nprobe=None, ef_search=None, bm25_k=0, filters=None,
+                    shard_client=None, shard_fallback="local", filter_exact_rows=20000):
+    """
+    FAISS top k, and with `bm25_k` BM25 top k, of every question.
+
+    With a ShardClient the shards are searched in parallel and their lists
+    merged; otherwise, or if the shards cannot answer for this snapshot
+    and `shard_fallback` is "local", `snap` is searched here. Both give
+    the same hits with a flat index. A metadata filter (RowFilter) is
+    searched here, among its rows only (see MetadataIndex.search).
+
+    Returns:
+        (D, I) as from faiss, and one (row ids, scores) BM25 pair per
+        question, best first (None without bm25_k)
+    """
+    token_lists = [question.lower().split() for question in questions] if bm25_k else None
+    if filters is not None:
+        with span(stage_seconds, "filtered_search"):
+            return snap.metadata.search(filters, q_embs, token_lists, k, bm25_k, nprobe, ef_search, filter_exact_rows)
+    if shard_client is not None:
+        with span(stage_seconds, "shard_search"):
+            hits = shard_client.search(snap.version, q_embs, token_lists, k, bm25_k, nprobe, ef_search)
+        if hits is not None:
+            return hits
+        if shard_fallback == "none":
+            raise RuntimeError(f"Shards cannot answer for snapshot {snap.version} (down: {shard_client.down()})")
+
+    with span(stage_seconds, "vector_search"):
+        D, I = snap.index.search(q_embs, k, params=search_params(snap.index, nprobe, ef_search))
+    bm25_hits = None
+    if bm25_k:
+        with span(stage_seconds, "bm25"):
+            bm25_hits = snap.bm25.top_k_batch(token_lists, bm25_k)
+    return D, I, bm25_hits
+
+
+def live_vector_hits(snap, D, I):
+    """
+    Level 1: the FAISS hits of each question that are still live chunks.
+
+    Returns:
+        One (chunk indices, cosine scores) pair per question, best first
+    """
+    results = []
+    for ids, scores in zip(I.tolist(), D.tolist()):
+        live = [(i, d) for i, d in zip(ids, scores) if i >= 0 and snap.chunks.is_live(i)]
+        results.append(([i for i, _ in live], [d for _, d in live]))
+    return results
+
+
+def fuse_hits(snap, q_embs, D, I, bm25_hits, final_k=8, fusion="embed_rerank", rrf_k=60, vector_weight=0.5):
+    """
+    Level 2: merge each question's vector and BM25 candidate lists.
+
+        embed_rerank  cosine similarity of every candidate in the union,
+                      from the stored chunk embeddings
+        rrf           reciprocal rank fusion of the two rankings
+        weighted      vector_weight * cosine + the rest * BM25, both
+                      min-max normalized per question
+
+    None of them calls the embedding API. The returned scores are always
+    cosine similarities, so the score guard means the same for every mode;
+    with rrf / weighted they are in fused order rather than descending.
+
+    Args:
+        snap: Snapshot the hits were searched in
+        q_embs: Unit-length question embeddings, shape (questions, dim)
+        D, I, bm25_hits: The question's hits, as from search_snapshot
+        final_k: Number of chunks to return after fusion
+        fusion: "embed_rerank", "rrf" or "weighted"
+        rrf_k: RRF damping constant
+        vector_weight: Weight of the cosine scores in weighted fusion
+
+    Returns:
+        One (chunk indices, cosine scores) pair per question, best first
+    """
+    results = []
+    for q_emb, vector_ids, vector_scores, (bm25_ids, bm25_scores) in zip(q_embs, I, D, bm25_hits):
+        live = [(i, d) for i, d in zip(vector_ids.tolist(), vector_scores.tolist()) if i >= 0 and snap.chunks.is_live(i)]
+        vector_ids = [i for i, _ in live]
+
+        if fusion == "embed_rerank":
+            # 3. Combine candidates (union of both methods)
+            combined_indices = list(set(vector_ids).union(bm25_ids.tolist()))
+
+            # 4. Rerank by cosine similarity (LEVEL 2)
+            # Candidate vectors were computed at ingest, so look them up by row.
+            # Stored and question vectors are unit length, so the dot product is
+            # the cosine score, on the same scale as the FAISS inner-product search
+            rerank_scores = np.dot(snap.embeddings[combined_indices], q_emb) if combined_indices else np.zeros(0)
+
+            ranked = sorted(
+                zip(combined_indices, rerank_scores.tolist()),
+                key=lambda x: x[1],
+                reverse=True
+            )[:final_k]
+            results.append(([idx for idx, score in ranked], [score for idx, score in ranked]))
+            continue
+
+        # 3. Fuse the two rankings with the scores already computed
+        if fusion == "rrf":
+            fused, _ = reciprocal_rank_fusion([vector_ids, bm25_ids.tolist()], k=rrf_k)
+        else:
+            fused, _ = weighted_fusion(
+                [(vector_ids, [d for _, d in live]), (bm25_ids.tolist(), bm25_scores.tolist())],
+                [vector_weight, 1.0 - vector_weight]
+            )
+        fused = fused[:final_k]
+        # Cosine of the chunks kept: from the FAISS search, or the stored
+        # embedding for chunks only BM25 found
+        cosine = dict(live)
+        missing = [i for i in fused if i not in cosine]
+        if missing:
+            cosine.update(zip(missing, np.dot(snap.embeddings[missing], q_emb).tolist()))
+        results.append((fused, [cosine[i] for i in fused]))
+    return results
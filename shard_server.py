@@ -0,0 +1,75 @@
+"""
+Serve one shard of the vectorstore for sharded retrieval.
+
+Each shard server memory-maps its slice of the current snapshot, a FAISS
+index and BM25 postings over the rows assigned to its shard, and answers
+searches from the API server's coordinator (SHARD_ADDRESSES). The API
+server writes the slices with every snapshot it publishes, so a shard
+reads nothing else: on another host, sync CURRENT and the shard's
+`snapshots/*/shards/<by>-<n>/<shard>/` directories (slices before
+CURRENT) into --root. It loads the new slice when CURRENT changes.
+
+    python shard_server.py --shards 4 --shard 0 --address 127.0.0.1:9100
+    python shard_server.py --shards 4 --local          # all 4 shards, ports 9100-9103
+    python shard_server.py --shards 4 --export         # add slices to the current snapshot
+
+--local and --export write the slices of the current snapshot if it was
+published without them.
+
+Coordinator and shards authenticate with SHARD_AUTHKEY, which has no
+default: set the same secret on every shard and on the API server. With
+--local and no SHARD_AUTHKEY a random key is generated for this
+deployment and printed next to SHARD_ADDRESSES.
+"""
+import argparse
+import logging
+import os
+import secrets
+
+from sharding import SHARD_MODES, ShardServer, export_slices, parse_address, start_local_shards
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def main(args):
+    authkey = os.getenv("SHARD_AUTHKEY", "")
+    if args.local or args.export:
+        version = export_slices(args.root, args.shards, args.by)
+        if args.export:
+            print(f"Snapshot {version}: slices for {args.shards} shards by {args.by}" if version else "No snapshot yet")
+            return
+    if args.local:
+        authkey = authkey or secrets.token_hex(16)
+        processes, addresses = start_local_shards(args.root, args.shards, args.by, base_port=args.base_port,
+                                                  authkey=authkey, poll_seconds=args.poll)
+        print(f"SHARD_ADDRESSES={','.join(addresses)}")
+        print(f"SHARD_AUTHKEY={authkey}")
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+        return
+
+    if args.shard is None or not args.address:
+        raise SystemExit("--shard and --address are required (or --local)")
+    if not authkey:
+        # Anyone who can connect could otherwise query the corpus
+        raise SystemExit("SHARD_AUTHKEY is not set; give every shard and the API server the same secret")
+    server = ShardServer(args.root, args.shard, args.shards, args.by, poll_seconds=args.poll)
+    server.serve_forever(parse_address(args.address), authkey.encode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default="vectorstore", help="Vectorstore directory")
+    parser.add_argument("--shards", type=int, required=True, help="Number of shards")
+    parser.add_argument("--shard", type=int, help="Shard served by this process")
+    parser.add_argument("--by", choices=SHARD_MODES, default="hash", help="Split rows by row hash or by document")
+    parser.add_argument("--address", help="host:port to listen on")
+    parser.add_argument("--poll", type=float, default=1.0, help="Seconds between checks for a new snapshot")
+    parser.add_argument("--local", action="store_true", help="Start every shard as a local process")
+    parser.add_argument("--base-port", type=int, default=9100, help="Port of shard 0 with --local")
+    parser.add_argument("--export", action="store_true", help="Write the current snapshot's slices and exit")
+    main(parser.parse_args())
@@ -0,0 +1,629 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import faiss
+import numpy as np
+
+from bm25_index import BM25Index
+from chunk_store import save_json
+from snapshot import current_version, load_snapshot, read_index_mmap
+from vector_index import build_index, describe, index_spec, needs_rebuild, search_params
+
+logger = logging.getLogger(__name__)
+
+# hash: rows spread evenly by a hash of the row id (stable across upserts)
+# document: every chunk of a document on one shard
+SHARD_MODES = ("hash", "document")
+
+
+def parse_address(address):
+    host, _, port = address.strip().rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def assign_shards(store, n_shards, by="hash"):
+    """
+    Shard of every row of a ChunkStore.
+
+    Returns:
+        int64 array, one shard number per row; -1 for removed rows
+    """
+    if by not in SHARD_MODES:
+        raise ValueError(f"Unknown shard mode {by!r}, expected one of {SHARD_MODES}")
+    rows = np.arange(len(store), dtype="uint64")
+    if by == "hash":
+        # Fibonacci hashing: consecutive rows (one page) land on different shards
+        shards = ((rows * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(33)) % np.uint64(n_shards)
+    else:
+        doc_shards = np.array([
+            int.from_bytes(hashlib.blake2b(doc["doc_id"].encode("utf-8"), digest_size=8).digest(), "little") % n_shards
+            for doc in store.docs
+        ] or [0], dtype="int64")
+        shards = doc_shards[np.maximum(np.asarray(store.doc), 0)]
+    shards = shards.astype("int64")
+    shards[np.asarray(store.doc) < 0] = -1
+    return shards
+
+
+class Shard:
+    """
+    One shard's slice of a snapshot: a FAISS index and BM25 postings over its rows.
+
+    Slices are built by the publisher (`write_slices`) and written into
+    the snapshot directory, so a shard server reads only its own slice
+    and never the full snapshot. The FAISS index has the snapshot's index
+    type, sized for the shard, and is keyed by the snapshot's row ids.
+    BM25 keeps the corpus-wide weights (see BM25Index.subset), so BM25
+    top-k lists merge into exactly the unsharded top k. So do the FAISS
+    lists of a flat index; IVF and HNSW shards are trained and linked
+    over their own rows, so their merged top k is approximate like an
+    unsharded search, but not necessarily the same hits.
+
+    Args:
+        rows: Snapshot rows of this shard, sorted
+        index: FAISS index over them
+        bm25: BM25Index.subset of the rows
+        info: Slice manifest (shard, shards, by, build_seconds, ...)
+        version: Snapshot version the slice belongs to
+    """
+
+    def __init__(self, rows, index, bm25, info, version=None):
+        self.rows = rows
+        self.index = index
+        self.bm25 = bm25
+        self.info = info
+        self.version = version
+
+    @classmethod
+    def build(cls, snap, shard, n_shards, by="hash", train_sample=100_000, base=None):
+        """
+        The slice of `snap` for one shard.
+
+        With `base`, the same shard's slice of an earlier snapshot with
+        the same row numbering, its index is updated (removed rows out,
+        new rows in) instead of rebuilt, unless its type no longer fits.
+        """
+        start = time.perf_counter()
+        rows = np.flatnonzero(assign_shards(snap.chunks, n_shards, by) == shard)
+        info = describe(snap.index)
+        spec = index_spec(info["type"], len(rows), snap.index.d, pq_m=info.get("pq_m", 0), hnsw_m=info.get("M", 32))
+        removed = np.setdiff1d(base.rows, rows) if base is not None else None
+        if base is not None and not needs_rebuild(base.index, spec, removing=len(removed) > 0):
+            # Copied through serialization: the base slice is memory-mapped
+            index = faiss.deserialize_index(faiss.serialize_index(base.index))
+            if len(removed):
+                index.remove_ids(removed.astype("int64"))
+            added = np.setdiff1d(rows, base.rows)
+            if len(added):
+                index.add_with_ids(np.asarray(snap.embeddings[added], dtype="float32"), added.astype("int64"))
+        else:
+            index = build_index(
+                snap.embeddings[rows],
+                rows,
+                spec,
+                train_sample=train_sample,
+                nprobe=info.get("nprobe", 16),
+                ef_search=info.get("ef_search", 64)
+            )
+        bm25 = snap.bm25.subset(rows)
+        return cls(rows, index, bm25, {
+            "shard": shard,
+            "shards": n_shards,
+            "by": by,
+            "rows": len(rows),
+            "index": describe(index),
+            "build_seconds": round(time.perf_counter() - start, 3)
+        })
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(path, "index.faiss"))
+        np.save(os.path.join(path, "rows.npy"), self.rows)
+        self.bm25.save(os.path.join(path, "bm25"))
+        files = {}
+        for directory, _, names in os.walk(path):
+            for name in names:
+                rel = os.path.relpath(os.path.join(directory, name), path)
+                if rel != "manifest.json":
+                    files[rel] = os.path.getsize(os.path.join(path, rel))
+        save_json(os.path.join(path, "manifest.json"), dict(self.info, files=files))
+
+    @classmethod
+    def load(cls, path, version=None):
+        """Load a slice written by `save`, memory-mapped; raises ValueError if it is incomplete."""
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            info = json.load(f)
+        for rel, size in info["files"].items():
+            file_path = os.path.join(path, rel)
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+                raise ValueError(f"Shard slice file missing or the wrong size: {file_path}")
+        return cls(
+            np.load(os.path.join(path, "rows.npy"), mmap_mode="r"),
+            read_index_mmap(os.path.join(path, "index.faiss")),
+            BM25Index.load(os.path.join(path, "bm25")),
+            info,
+            version
+        )
+
+    def search(self, q_embs, token_lists, k, bm25_k=0, nprobe=None, ef_search=None):
+        """
+        Returns:
+            (D, I) from FAISS, and one (row ids, scores) BM25 pair per
+            question (empty without bm25_k)
+        """
+        D, I = self.index.search(q_embs, k, params=search_params(self.index, nprobe, ef_search))
+        hits = []
+        if bm25_k:
+            for ids, scores in self.bm25.top_k_batch(token_lists, bm25_k):
+                hits.append((np.asarray(self.rows[ids]), scores))
+        return D, I, hits
+
+
+def slice_path(snapshot_path, shard, n_shards, by="hash"):
+    """Directory of one shard's slice inside a snapshot directory."""
+    return os.path.join(snapshot_path, "shards", f"{by}-{n_shards}", str(shard))
+
+
+def write_slices(path, snap, n_shards, by="hash", base_path=None, train_sample=100_000):
+    """
+    Write the slice of every shard of `snap` into its snapshot directory.
+
+    Slices are written next to each other under `shards/<by>-<n>.tmp` and
+    renamed into place together; existing slices are kept. With
+    `base_path`, the directory of an earlier snapshot with the same row
+    numbering, each shard index is updated from its slice there.
+    """
+    final = os.path.join(path, "shards", f"{by}-{n_shards}")
+    if os.path.isdir(final):
+        return
+    tmp = f"{final}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    for shard in range(n_shards):
+        base = None
+        if base_path is not None and os.path.isdir(slice_path(base_path, shard, n_shards, by)):
+            base = Shard.load(slice_path(base_path, shard, n_shards, by))
+        Shard.build(snap, shard, n_shards, by, train_sample=train_sample, base=base).save(os.path.join(tmp, str(shard)))
+    os.rename(tmp, final)
+
+
+def export_slices(root, n_shards, by="hash", train_sample=100_000):
+    """
+    Add the slices for `n_shards` to the current snapshot under `root`.
+
+    For snapshots published without them (see app's SHARD_ADDRESSES).
+
+    Returns:
+        The snapshot version, or None if there is no snapshot
+    """
+    snap = load_snapshot(root)
+    if snap is None:
+        return None
+    write_slices(os.path.join(root, "snapshots", snap.version), snap, n_shards, by, train_sample=train_sample)
+    return snap.version
+
+
+# ---------------- wire format ----------------
+# A message is one frame: the length of a JSON header, the header, then
+# the raw bytes of its arrays; nothing is unpickled. One frame per message
+# also keeps small requests from waiting on delayed TCP acknowledgements
+
+def send_message(conn, header, arrays=()):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    head = json.dumps(dict(header, arrays=[[a.dtype.str, list(a.shape)] for a in arrays])).encode("utf-8")
+    conn.send_bytes(b"".join([len(head).to_bytes(4, "little"), head] + [a.tobytes() for a in arrays]))
+
+
+def recv_message(conn):
+    frame = conn.recv_bytes()
+    size = int.from_bytes(frame[:4], "little")
+    header = json.loads(frame[4:4 + size])
+    arrays = []
+    offset = 4 + size
+    for dtype, shape in header.pop("arrays"):
+        a = np.frombuffer(frame, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        arrays.append(a)
+        offset += a.nbytes
+    return header, arrays
+
+
+# ---------------- shard server ----------------
+
+class ShardServer:
+    """
+    Serves one shard of the current snapshot under `root` to coordinators.
+
+    Only the shard's slice is read (see `write_slices`): `root` needs
+    CURRENT and `snapshots/<version>/shards/<by>-<n>/<shard>/`, which a
+    shard host without the publisher's filesystem can sync (slice first,
+    then CURRENT). A new slice is loaded when CURRENT names a new
+    snapshot (checked every `poll_seconds`, or when a coordinator asks);
+    the previous one keeps serving coordinators that have not switched
+    yet. A search for any other version is answered with {"ok": false}
+    and the shard's version, so the coordinator never merges row ids of
+    different snapshots.
+
+    Every connection is handled on its own thread and may send any number
+    of requests.
+    """
+
+    def __init__(self, root, shard, n_shards, by="hash", poll_seconds=1.0, keep=2):
+        if not 0 <= shard < n_shards:
+            raise ValueError(f"Shard {shard} out of range for {n_shards} shards")
+        self.root = root
+        self.shard_number = shard
+        self.n_shards = n_shards
+        self.by = by
+        self.poll_seconds = poll_seconds
+        self.keep = keep
+        self.slices = OrderedDict()  # version -> Shard, newest last
+        self.version = None
+        self.requests = 0
+        self._missing = None
+        self._lock = threading.Lock()
+
+    @property
+    def shard(self):
+        return self.slices.get(self.version) if self.version is not None else None
+
+    def load(self):
+        with self._lock:
+            version = current_version(self.root)
+            if version is None or version in self.slices:
+                return
+            path = slice_path(os.path.join(self.root, "snapshots", version), self.shard_number, self.n_shards, self.by)
+            if not os.path.isdir(path):
+                if version != self._missing:
+                    self._missing = version
+                    logger.error(f"Snapshot {version} has no slice {path} (publish with SHARD_ADDRESSES set, or "
+                                 f"run shard_server.py --export); still serving {self.version}")
+                return
+            start = time.perf_counter()
+            shard = Shard.load(path, version)
+            self.slices[version] = shard
+            while len(self.slices) > self.keep:
+                self.slices.popitem(last=False)
+            self.version = version
+            logger.info(f"Shard {self.shard_number}/{self.n_shards} of snapshot {version}: "
+                        f"{len(shard.rows)} rows, loaded in {time.perf_counter() - start:.2f}s")
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Failed to load shard of the current snapshot: {e}")
+
+    def status(self):
+        shard = self.shard
+        return {
+            "ok": shard is not None,
+            "version": self.version,
+            "versions": list(self.slices),
+            "shard": self.shard_number,
+            "shards": self.n_shards,
+            "by": self.by,
+            "rows": len(shard.rows) if shard is not None else 0,
+            "build_seconds": shard.info.get("build_seconds") if shard is not None else None,
+            "requests": self.requests,
+            "pid": os.getpid()
+        }
+
+    def handle(self, conn):
+        try:
+            while True:
+                header, arrays = recv_message(conn)
+                if header.get("op") == "status":
+                    send_message(conn, self.status())
+                    continue
+                if header.get("op") == "load":
+                    # A coordinator is ahead of this shard: check CURRENT now
+                    try:
+                        self.load()
+                    except Exception as e:
+                        logger.error(f"Failed to load shard of the current snapshot: {e}")
+                    send_message(conn, self.status())
+                    continue
+                if (header.get("shard"), header.get("shards")) != (self.shard_number, self.n_shards):
+                    send_message(conn, {"ok": False, "version": self.version,
+                                        "error": f"this is shard {self.shard_number} of {self.n_shards}"})
+                    continue
+                shard = self.slices.get(header.get("version"))
+                if shard is None:
+                    send_message(conn, {"ok": False, "version": self.version, "error": "snapshot version"})
+                    continue
+                start = time.perf_counter()
+                D, I, hits = shard.search(arrays[0], header.get("queries"), header["k"], header.get("bm25_k", 0),
+                                          header.get("nprobe"), header.get("ef_search"))
+                self.requests += 1
+                ids = np.concatenate([h[0] for h in hits]) if hits else np.zeros(0, dtype="int64")
+                scores = np.concatenate([h[1] for h in hits]) if hits else np.zeros(0, dtype="float32")
+                send_message(conn, {
+                    "ok": True,
+                    "version": shard.version,
+                    "by": self.by,
+                    "seconds": time.perf_counter() - start,
+                    "bm25_counts": [len(h[0]) for h in hits]
+                }, [D, I, ids.astype("int64"), scores.astype("float32")])
+        except EOFError:
+            pass
+        except Exception as e:
+            logger.error(f"Shard {self.shard_number} request failed: {e}")
+        finally:
+            conn.close()
+
+    def serve_forever(self, address, authkey):
+        if not authkey:
+            raise ValueError("A shard server needs an authkey")
+        self.load()
+        threading.Thread(target=self._watch, daemon=True).start()
+        with Listener(address, authkey=authkey) as listener:
+            logger.info(f"Shard {self.shard_number}/{self.n_shards} ({self.by}) listening on {address[0]}:{address[1]}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (AuthenticationError, OSError) as e:
+                    logger.warning(f"Rejected shard connection: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+# ---------------- coordinator ----------------
+
+def merge_vector_hits(parts, k):
+    """
+    Top k of per-shard FAISS results (the exact global top k for flat shards).
+
+    Args:
+        parts: (D, I) per shard, each (questions, k)
+
+    Returns:
+        (D, I) of shape (questions, k), best first; ties go to the lower
+        row id, padding is id -1
+    """
+    D = np.hstack([d for d, _ in parts])
+    I = np.hstack([i for _, i in parts])
+    D = np.where(I >= 0, D, -np.inf).astype("float32")
+    order = np.lexsort((I, -D), axis=1)[:, :k]
+    return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+
+def merge_bm25_hits(parts, k):
+    """
+    Exact top k of per-shard BM25 results.
+
+    Args:
+        parts: One list per shard of (row ids, scores) pairs, one pair per question
+
+    Returns:
+        One (row ids, scores) pair per question, best first
+    """
+    merged = []
+    for hits in zip(*parts):
+        ids = np.concatenate([h[0] for h in hits])
+        scores = np.concatenate([h[1] for h in hits])
+        order = np.lexsort((ids, -scores))[:k]
+        merged.append((ids[order], scores[order]))
+    return merged
+
+
+class ShardUnavailable(ConnectionError):
+    """A shard did not answer; `shard` is its number."""
+
+    def __init__(self, shard, message):
+        super().__init__(message)
+        self.shard = shard
+
+
+class ShardClient:
+    """
+    Scatter-gather search over shard servers.
+
+    A search is sent to every shard before any reply is read, so the
+    shards search in parallel; the per-shard lists are merged into the
+    global top k (see Shard for when that is exact). Connections are
+    pooled per shard and used by one search at a time, so the client is
+    safe to call from many threads.
+
+    A shard that fails to answer is marked down for `retry_seconds`:
+    searches return None at once instead of waiting `timeout` for it
+    again, and the first search after that tries it again; any reply
+    from the shard marks it up. Shards still
+    on an older snapshot are asked to load the current one and the
+    search is retried once.
+
+    Args:
+        addresses: "host:port" of every shard, in shard order
+        authkey: Shared secret of the shard servers
+        timeout: Seconds to wait for each shard's reply
+        retry_seconds: Seconds a failed shard is skipped
+    """
+
+    def __init__(self, addresses, authkey, timeout=5.0, retry_seconds=10.0):
+        if not authkey:
+            raise ValueError("ShardClient needs the shard servers' authkey")
+        self.addresses = [parse_address(a) for a in addresses]
+        self.authkey = authkey
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.pools = [queue.LifoQueue() for _ in self.addresses]
+        self.down_until = [0.0] * len(self.addresses)
+        self._lock = threading.Lock()
+        self.metrics = {
+            "searches": 0,
+            "version_mismatches": 0,
+            "errors": 0,
+            "skipped": 0
+        }
+
+    def _connection(self, shard):
+        try:
+            return self.pools[shard].get_nowait()
+        except queue.Empty:
+            return Client(self.addresses[shard], authkey=self.authkey)
+
+    def _count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+
+    def _exchange(self, shards, header, arrays=()):
+        """
+        Send one request to each shard, then collect the replies in order.
+
+        A shard that fails is marked down for `retry_seconds`; shards that
+        reply are marked up again.
+        """
+        conns = []
+        shard = None
+        try:
+            for shard in shards:
+                conns.append(self._connection(shard))
+                send_message(conns[-1], dict(header, shard=shard), arrays)
+            replies = []
+            for shard, conn in zip(shards, conns):
+                if not conn.poll(self.timeout):
+                    raise TimeoutError(f"no reply within {self.timeout}s")
+                replies.append(recv_message(conn))
+        except (OSError, EOFError, TimeoutError, AuthenticationError) as e:
+            # A connection may still have a reply in flight; never reuse it
+            for conn in conns:
+                conn.close()
+            self._mark_down([shard], time.monotonic() + self.retry_seconds)
+            raise ShardUnavailable(shard, f"shard {shard} at {self.addresses[shard]}: {e}") from e
+        for shard, conn in zip(shards, conns):
+            self.pools[shard].put(conn)
+        self._mark_down(shards, 0.0)
+        return replies
+
+    def _mark_down(self, shards, until):
+        with self._lock:
+            for shard in shards:
+                self.down_until[shard] = until
+
+    def down(self):
+        """Shards currently skipped after a failure."""
+        now = time.monotonic()
+        with self._lock:
+            return [shard for shard, until in enumerate(self.down_until) if until > now]
+
+    def search(self, version, q_embs, token_lists, k, bm25_k=0, nprobe=None, ef_search=None):
+        """
+        Search every shard of snapshot `version` and merge the results.
+
+        Returns:
+            (D, I, BM25 hits or None) like a search of the whole snapshot,
+            or None if a shard is down or serves another version (the
+            caller searches locally instead)
+        """
+        if self.down():
+            self._count("skipped")
+            return None
+        q_embs = np.ascontiguousarray(q_embs, dtype="float32")
+        header = {
+            "op": "search",
+            "version": version,
+            "shards": len(self.addresses),
+            "k": k,
+            "bm25_k": bm25_k,
+            "nprobe": nprobe,
+            "ef_search": ef_search,
+            "queries": token_lists if bm25_k else None
+        }
+        try:
+            replies = self._exchange(range(len(self.addresses)), header, [q_embs])
+            behind = [shard for shard, (h, _) in enumerate(replies) if not h["ok"] and (h.get("version") or "") < version]
+            if behind:
+                # Published a moment ago: have those shards check CURRENT now
+                self._exchange(behind, {"op": "load"})
+                replies = self._exchange(range(len(self.addresses)), header, [q_embs])
+        except ShardUnavailable as e:
+            logger.warning(f"Shard search failed, skipping shard {e.shard} for {self.retry_seconds}s: {e}")
+            self._count("errors")
+            return None
+
+        if not all(header["ok"] for header, _ in replies) or len({header["by"] for header, _ in replies}) > 1:
+            versions = [header.get("version") for header, _ in replies]
+            logger.info(f"Shards serve {versions} (errors: {[h.get('error') for h, _ in replies if not h['ok']]}), "
+                        f"not {version}")
+            self._count("version_mismatches")
+            return None
+        self._count("searches")
+
+        vector_parts = []
+        bm25_parts = []
+        for header, (D, I, ids, scores) in replies:
+            vector_parts.append((D, I))
+            bounds = np.cumsum([0] + header["bm25_counts"])
+            bm25_parts.append([(ids[a:b], scores[a:b]) for a, b in zip(bounds[:-1], bounds[1:])])
+        D, I = merge_vector_hits(vector_parts, k)
+        return D, I, merge_bm25_hits(bm25_parts, bm25_k) if bm25_k else None
+
+    def status(self):
+        """Status of every shard (None where unreachable)."""
+        out = []
+        for shard in range(len(self.addresses)):
+            try:
+                out.append(self._exchange([shard], {"op": "status"})[0][0])
+            except ConnectionError:
+                out.append(None)
+        return out
+
+    def stats(self):
+        down = self.down()
+        with self._lock:
+            return dict(self.metrics, shards=len(self.addresses), down=down)
+
+    def close(self):
+        for pool in self.pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+
+
+def start_local_shards(root, n_shards, by="hash", host="127.0.0.1", base_port=9100, authkey=None,
+                       poll_seconds=1.0):
+    """
+    Start one shard_server.py process per shard on this machine.
+
+    The shards get `authkey`, or SHARD_AUTHKEY from this environment.
+
+    Returns:
+        (processes, "host:port" addresses in shard order)
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shard_server.py")
+    env = dict(os.environ)
+    if authkey is not None:
+        env["SHARD_AUTHKEY"] = authkey.decode() if isinstance(authkey, bytes) else authkey
+    processes, addresses = [], []
+    for shard in range(n_shards):
+        address = f"{host}:{base_port + shard}"
+        processes.append(subprocess.Popen([
+            sys.executable, script, "--root", root, "--shard", str(shard), "--shards", str(n_shards),
+            "--by", by, "--address", address, "--poll", str(poll_seconds)
+        ], env=env))
+        addresses.append(address)
+    return processes, addresses
+
+
+def wait_for_shards(client, version, timeout=300.0):
+    """Block until every shard serves snapshot `version`; raises TimeoutError."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.status()
+        if all(s is not None and s["version"] == version for s in status):
+            return status
+        time.sleep(0.2)
+    raise TimeoutError(f"Shards did not load snapshot {version} within {timeout}s")
@@ -0,0 +1,394 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from functools import cached_property
+
+import faiss
+import numpy as np
+
+from bm25_index import BM25Index
+from chunk_store import ChunkStore, save_json
+from metadata_index import MetadataIndex
+
+logger = logging.getLogger(__name__)
+
+# 2: embeddings.f32, extended in place by later snapshots (1: embeddings.npy)
+FORMAT_VERSION = 2
+EMBEDDINGS_FILE = "embeddings.f32"
+
+
+class Snapshot:
+    """
+    One immutable generation of the searchable store.
+
+    Ingestion builds the next Snapshot from copies and publishes it by
+    swapping a single reference, so a reader that took the reference
+    keeps a consistent index, chunks, BM25 and embeddings.
+
+    On disk (see `write_snapshot`):
+
+        vectorstore/
+            CURRENT                 name of the live snapshot; versions only grow,
+                                    so it is the generation server workers poll
+            snapshots/000007/
+                manifest.json       embedding model, dims, chunk params, file checksums
+                index.faiss         FAISS index, ids are chunk rows
+                embeddings.f32      row-aligned unit-length chunk embeddings (raw
+                                    float32), hard-linked from the previous
+                                    snapshot and extended with the new rows
+                chunks/             ChunkStore columns
+                bm25/               BM25Index arrays
+                documents.json      page hashes and rows per document
+                shards/hash-4/0/    slice of shard 0 of 4, when published for
+                                    shard servers (see sharding.write_slices)
+
+    Everything is loaded from .npy, JSON and FAISS files; nothing is
+    unpickled.
+
+    Args:
+        index: FAISS index (ids are chunk rows)
+        chunks: ChunkStore
+        bm25: BM25Index over the same rows
+        embeddings: Row-aligned unit-length chunk embeddings
+        documents: doc_id -> {"source", "pages": {page: {"hash", "rows"}},
+                   "page_count", "outline": [{"title", "level", "page"}]}
+        manifest: Manifest it was written with or loaded from
+    """
+
+    def __init__(self, index, chunks, bm25, embeddings, documents, manifest=None):
+        self.index = index
+        self.chunks = chunks
+        self.bm25 = bm25
+        self.embeddings = embeddings
+        self.documents = documents
+        self.manifest = manifest or {}
+
+    @property
+    def version(self):
+        return self.manifest.get("version")
+
+    @cached_property
+    def metadata(self):
+        """Document/section/page lookups for chunk metadata and filtered search (built on first use)."""
+        return MetadataIndex(self)
+
+
+def file_sha256(path, start=0, length=None):
+    """sha256 of a file, or of `length` bytes of it from `start`."""
+    digest = hashlib.sha256()
+    remaining = float("inf") if length is None else length
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            block = f.read(int(min(1 << 20, remaining)))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def _files(path):
+    """Relative paths of every file under a snapshot directory, except the manifest."""
+    found = []
+    for directory, _, names in os.walk(path):
+        for name in names:
+            rel = os.path.relpath(os.path.join(directory, name), path)
+            if rel != "manifest.json":
+                found.append(rel)
+    return sorted(found)
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_index_mmap(path):
+    """
+    Read a FAISS index memory-mapped, falling back to a regular read.
+
+    IO_FLAG_MMAP_IFC (newer faiss) maps flat, IVF and HNSW codes in place,
+    so worker processes serving the same snapshot share one copy in the
+    page cache; plain IO_FLAG_MMAP copies flat codes into private memory.
+    The mapped index must not be modified (see ingestion.writable_index).
+    """
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError as e:
+        logger.warning(f"Memory-mapped read of {path} failed ({e}), loading into RAM")
+        return faiss.read_index(path)
+
+
+def _write_embeddings(path, embeddings, base=None):
+    """
+    Write the embeddings file of the snapshot directory `path`.
+
+    With `base`, `embeddings` are only the rows after base's: base's file
+    is hard-linked and the new rows are appended to it, so a publish
+    writes its new rows instead of the whole matrix. Readers of base (and
+    of older snapshots sharing the file) map only their own rows, which
+    appending leaves untouched. On filesystems without hard links (SMB
+    mounts such as Azure App Service /home) base's file is copied and the
+    rows appended to the copy. When base has no such file, or the file
+    has grown past base's rows (a publish crashed after appending), every
+    row is written to a new file instead.
+
+    Returns:
+        Segments of the file, [{"bytes", "sha256"}] in order, one per
+        publish that appended to it
+    """
+    target = os.path.join(path, EMBEDDINGS_FILE)
+    rows = np.ascontiguousarray(embeddings, dtype="float32")
+    segments = []
+    if base is not None:
+        entry = base.manifest.get("files", {}).get(EMBEDDINGS_FILE)
+        source = os.path.join(os.path.dirname(path), str(base.version), EMBEDDINGS_FILE)
+        if entry is not None and os.path.exists(source) and os.path.getsize(source) == entry["bytes"]:
+            try:
+                os.link(source, target)
+            except OSError as e:
+                logger.info(f"Cannot hard-link {source} ({e}), copying it")
+                shutil.copyfile(source, target)
+            segments = list(entry["segments"])
+        else:
+            rows = np.vstack([np.asarray(base.embeddings, dtype="float32").reshape(-1, rows.shape[1]), rows])
+    with open(target, "ab") as f:
+        f.write(rows.data)
+    if len(rows):
+        segments.append({"bytes": rows.nbytes, "sha256": hashlib.sha256(rows.data).hexdigest()})
+    return segments
+
+
+def _map_embeddings(path, rows, dim):
+    """The first `rows` rows of a snapshot's embeddings file, memory-mapped."""
+    if not rows:
+        return np.zeros((0, dim), dtype="float32")
+    # Plain ndarray view of the mapping: np.memmap slicing is much slower
+    return np.memmap(os.path.join(path, EMBEDDINGS_FILE), dtype="float32", mode="r", shape=(rows, dim)).view(np.ndarray)
+
+
+def load_documents(path):
+    """Document registry from JSON (page numbers come back as string keys)."""
+    with open(path, encoding="utf-8") as f:
+        docs = json.load(f)
+    for doc in docs.values():
+        doc["pages"] = {int(page_no): entry for page_no, entry in doc["pages"].items()}
+    return docs
+
+
+def current_version(root):
+    """Name of the live snapshot, or None if there is none."""
+    try:
+        with open(os.path.join(root, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def publish_lock(root):
+    """
+    Exclusive lock on publishing snapshots under `root`, across processes.
+
+    Server workers and ingest.py hold it from reading the current snapshot
+    until CURRENT names the new one, so two publishers never build on the
+    same base or write the same version.
+    """
+    with open(os.path.join(root, "PUBLISH.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def ingest_slot(root, slots, poll_seconds=0.2):
+    """
+    One of `slots` ingestion slots under `root`, shared by every process.
+
+    Caps the PDFs being parsed and embedded at once across all server
+    workers, not per worker: each slot is an exclusive lock on
+    `ingest_slots/<n>.lock`, and a caller waits until one is free. A
+    crashed process releases its slot with its file descriptors.
+    """
+    directory = os.path.join(root, "ingest_slots")
+    os.makedirs(directory, exist_ok=True)
+    while True:
+        for slot in range(max(1, slots)):
+            f = open(os.path.join(directory, f"{slot}.lock"), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        time.sleep(poll_seconds)
+
+
+def write_snapshot(root, snapshot, info, keep=3, base=None, extra=None):
+    """
+    Write a snapshot as the next version and make it current.
+
+    The snapshot is written completely into a temporary directory,
+    fsynced and renamed into place, and only then does CURRENT switch to
+    it (by rename), so a crash at any point leaves CURRENT naming a
+    complete snapshot. Snapshot files are never modified afterwards,
+    which keeps memory mappings of older snapshots valid.
+
+    Args:
+        root: Vectorstore directory
+        snapshot: Snapshot to write; its manifest is set on return
+        info: Manifest fields describing how it was built (embedding
+            model and dims, chunking parameters, index type)
+        keep: Number of most recent snapshots to keep on disk
+        base: The current snapshot, if `snapshot` extends its rows; then
+            `snapshot.embeddings` holds only the rows added after base's
+            and base's embeddings file is extended rather than copied.
+            On return `snapshot.embeddings` maps every row of the file
+        extra: Optional function(path, snapshot) that writes more files
+            into the snapshot directory before it is checksummed and
+            published, with every embedding row mapped (shard slices,
+            see sharding.write_slices)
+
+    Returns:
+        The manifest
+    """
+    snapshots = os.path.join(root, "snapshots")
+    os.makedirs(snapshots, exist_ok=True)
+    versions = [int(name) for name in os.listdir(snapshots) if name.isdigit()]
+    version = f"{max(versions, default=0) + 1:06d}"
+    tmp = os.path.join(snapshots, f"{version}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    start = time.perf_counter()
+    faiss.write_index(snapshot.index, os.path.join(tmp, "index.faiss"))
+    segments = _write_embeddings(tmp, snapshot.embeddings, base)
+    # The mapping stays valid when the directory is renamed
+    snapshot.embeddings = _map_embeddings(tmp, len(snapshot.chunks), info["embedding"]["dim"])
+    snapshot.chunks.save(os.path.join(tmp, "chunks"))
+    snapshot.bm25.save(os.path.join(tmp, "bm25"))
+    save_json(os.path.join(tmp, "documents.json"), snapshot.documents)
+    if extra is not None:
+        extra(tmp, snapshot)
+
+    files = {}
+    for rel in _files(tmp):
+        path = os.path.join(tmp, rel)
+        _fsync(path)
+        if rel == EMBEDDINGS_FILE:
+            # Shared with older snapshots: checksummed per appended segment,
+            # so a publish hashes only the rows it wrote
+            files[rel] = {"bytes": sum(s["bytes"] for s in segments), "segments": segments}
+        else:
+            files[rel] = {"bytes": os.path.getsize(path), "sha256": file_sha256(path)}
+    manifest = {
+        "format": FORMAT_VERSION,
+        "version": version,
+        "created_at": time.time(),
+        **info,
+        "rows": len(snapshot.chunks),
+        "vectors": int(snapshot.index.ntotal),
+        "files": files
+    }
+    save_json(os.path.join(tmp, "manifest.json"), manifest)
+    _fsync(os.path.join(tmp, "manifest.json"))
+
+    final = os.path.join(snapshots, version)
+    os.rename(tmp, final)
+    _fsync(snapshots)
+    with open(os.path.join(root, "CURRENT.tmp"), "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(root, "CURRENT.tmp"), os.path.join(root, "CURRENT"))
+    _fsync(root)
+    snapshot.manifest = manifest
+    logger.info(f"Wrote snapshot {version} in {time.perf_counter() - start:.2f}s")
+
+    # Older snapshots may still be mapped by readers; unlinked files stay
+    # readable until unmapped, so removing them is safe
+    for old in sorted(name for name in os.listdir(snapshots) if name.isdigit())[:-max(1, keep)]:
+        shutil.rmtree(os.path.join(snapshots, old), ignore_errors=True)
+    return manifest
+
+
+def verify_snapshot(path, manifest, checksums=False):
+    """Raise ValueError if a snapshot's files do not match its manifest."""
+    if manifest.get("format") not in (1, FORMAT_VERSION):
+        raise ValueError(f"Unsupported snapshot format {manifest.get('format')}")
+    for rel, expected in manifest["files"].items():
+        file_path = os.path.join(path, rel)
+        if not os.path.exists(file_path):
+            raise ValueError(f"Snapshot file missing: {rel}")
+        size = os.path.getsize(file_path)
+        if "segments" in expected:
+            # Later snapshots may have appended to it
+            if size < expected["bytes"]:
+                raise ValueError(f"Snapshot file is truncated: {rel}")
+            if checksums:
+                start = 0
+                for segment in expected["segments"]:
+                    if file_sha256(file_path, start, segment["bytes"]) != segment["sha256"]:
+                        raise ValueError(f"Snapshot file checksum mismatch: {rel}")
+                    start += segment["bytes"]
+            continue
+        if size != expected["bytes"]:
+            raise ValueError(f"Snapshot file has the wrong size: {rel}")
+        if checksums and file_sha256(file_path) != expected["sha256"]:
+            raise ValueError(f"Snapshot file checksum mismatch: {rel}")
+
+
+def load_snapshot(root, checksums=False):
+    """
+    Load the current snapshot, memory-mapping its arrays.
+
+    File sizes are always checked against the manifest; with `checksums`
+    every file is also hashed (slow for large stores).
+
+    Returns:
+        Snapshot, or None if the vectorstore has no snapshot yet
+    """
+    version = current_version(root)
+    if version is None:
+        return None
+    path = os.path.join(root, "snapshots", version)
+    with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    verify_snapshot(path, manifest, checksums=checksums)
+
+    snapshot = Snapshot(
+        index=read_index_mmap(os.path.join(path, "index.faiss")),
+        chunks=ChunkStore.load(os.path.join(path, "chunks")),
+        bm25=BM25Index.load(os.path.join(path, "bm25")),
+        embeddings=None,
+        documents=load_documents(os.path.join(path, "documents.json")),
+        manifest=manifest
+    )
+    rows = len(snapshot.chunks)
+    if EMBEDDINGS_FILE in manifest["files"]:
+        snapshot.embeddings = _map_embeddings(path, rows, manifest["embedding"]["dim"])
+    else:
+        snapshot.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+    if len(snapshot.embeddings) != rows or snapshot.bm25.n_docs != rows:
+        raise ValueError(f"Snapshot {version} is inconsistent: {rows} chunks, "
+                         f"{len(snapshot.embeddings)} embeddings, {snapshot.bm25.n_docs} BM25 rows")
+    if snapshot.index.d != manifest["embedding"]["dim"]:
+        raise ValueError(f"Snapshot {version} index has {snapshot.index.d} dims, manifest says {manifest['embedding']['dim']}")
+    return snapshot
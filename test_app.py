@@ -0,0 +1,237 @@
+"""
+API server tests: ingestion, /ask endpoints and caches, on the local
+embedding and chat stand-ins (local_models.py).
+
+    pytest test_app.py -v
+"""
+import json
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("AZURE_OPENAI_KEY", "offline")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "offline")
+os.environ.setdefault("EMBED_CACHE_SIZE", "0")
+os.environ.setdefault("ANSWER_CACHE_SIZE", "0")
+os.environ.setdefault("SNAPSHOT_POLL_SECONDS", "0")
+
+WORDS = ("pitot static altimeter airspeed vertical speed gyro compass heading attitude "
+         "pressure tube vent drain heater turn slip indicator").split()
+
+
+def page_text(seed, words=600, vocab=WORDS):
+    return " ".join(np.random.default_rng(seed).choice(vocab, words))
+
+
+def make_pdf(pages):
+    """A minimal PDF with one line of Helvetica text per page."""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for i, text in enumerate(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    return out
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """The app module with an empty vectorstore under tmp_path and local models."""
+    monkeypatch.chdir(tmp_path)
+    import app
+    import local_models
+
+    for name in ("embedder", "client", "embedding_cache", "answer_cache", "snapshot", "snapshot_error",
+                 "snapshot_generation", "startup_seconds", "PDF_WORKERS"):
+        monkeypatch.setattr(app, name, getattr(app, name))
+    monkeypatch.setattr(app.embedder, "client", app.embedder.client)
+    monkeypatch.setattr(app.embedder, "async_client", app.embedder.async_client)
+    os.makedirs(app.VECTOR_DIR, exist_ok=True)
+    local_models.install(app)
+    app.snapshot = app.snapshot_error = app.snapshot_generation = None
+    app.PDF_WORKERS = 1
+    return app
+
+
+def ingest(app, tmp_path, doc_id, pages):
+    path = tmp_path / f"{doc_id}.pdf"
+    path.write_bytes(make_pdf(pages))
+    return app.ingest_pdf(str(path), doc_id, doc_id, "upsert")
+
+
+@pytest.fixture
+def api(app, tmp_path):
+    """TestClient over a one-document corpus, one topic per page (startup handlers are not run)."""
+    ingest(app, tmp_path, "manual", [page_text(i, vocab=WORDS[i * 5:i * 5 + 5]) for i in range(4)])
+    return TestClient(app.app)
+
+
+def script_chat(app, monkeypatch, answer, piece=4):
+    """Make every LLM call answer `answer`, streamed `piece` characters at a time; returns the call log."""
+    calls = []
+
+    async def chunks():
+        for i in range(0, len(answer), piece):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=answer[i:i + piece]))])
+
+    async def create(model, messages, stream=False, **kwargs):
+        calls.append(messages[-1]["content"])
+        if stream:
+            return chunks()
+        usage = SimpleNamespace(prompt_tokens=100, completion_tokens=10)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))], usage=usage)
+
+    monkeypatch.setattr(app.client, "chat", SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return calls
+
+
+def sse_events(body):
+    """[(event, payload)] of a Server-Sent Events body."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+QUESTION = "What does the pitot tube heater do?"
+
+
+# ---------------- ingestion ----------------
+
+def test_upsert_embeds_only_changed_pages(app, tmp_path):
+    pages = [page_text(i) for i in range(5)]
+    first = ingest(app, tmp_path, "manual", pages)
+    assert first["pages_skipped"] == 0 and first["snapshot"] == "000001"
+    stored = app.snapshot.documents["manual"]["pages"]
+    rows_of_page_3 = stored[3]["rows"]
+
+    pages[2] = page_text(100)
+    second = ingest(app, tmp_path, "manual", pages)
+    assert second["pages_skipped"] == 4 and second["snapshot"] == "000002"
+    assert second["chunks_removed"] == len(rows_of_page_3) and second["chunks_added"] > 0
+    assert second["chunks"] == first["chunks"] - second["chunks_removed"] + second["chunks_added"]
+    # Unchanged pages keep their rows
+    assert app.snapshot.documents["manual"]["pages"][1] == stored[1]
+
+    # Nothing changed: no snapshot is written
+    third = ingest(app, tmp_path, "manual", pages)
+    assert "snapshot" not in third and third["pages_skipped"] == 5
+    assert app.snapshot.version == "000002"
+
+
+def test_compaction_once_tombstones_pass_the_ratio(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "COMPACT_TOMBSTONE_RATIO", 0.25)
+    manual = [page_text(i) for i in range(4)]
+    ingest(app, tmp_path, "manual", manual)
+    ingest(app, tmp_path, "other", [page_text(10 + i) for i in range(4)])
+
+    # Few removed rows stay as tombstones
+    manual[0] = page_text(20)
+    result = ingest(app, tmp_path, "manual", manual)
+    assert not result["compacted"]
+    assert len(app.snapshot.chunks) > app.snapshot.index.ntotal
+
+    manual[1:] = [page_text(21 + i) for i in range(3)]
+    result = ingest(app, tmp_path, "manual", manual)
+    snap = app.snapshot
+    assert result["compacted"]
+    assert len(snap.chunks) == snap.index.ntotal == snap.bm25.n_docs == len(snap.embeddings)
+    rows = sorted(r for doc in snap.documents.values() for entry in doc["pages"].values() for r in entry["rows"])
+    assert rows == list(range(len(snap.chunks)))
+    # Renumbered rows still line up with their text and embeddings
+    row = snap.documents["manual"]["pages"][2]["rows"][0]
+    np.testing.assert_allclose(snap.embeddings[row], app.get_embeddings([snap.chunks[row]])[0], atol=1e-6)
+
+
+# ---------------- streaming ----------------
+
+def test_stream_never_sends_the_refusal_as_tokens(app, api, monkeypatch):
+    script_chat(app, monkeypatch, app.REFUSAL, piece=3)
+    events = sse_events(api.post("/ask/stream", json={"question": QUESTION}).text)
+    assert [event for event, _ in events] == ["retrieval", "done"]
+    assert events[-1][1]["refused"] is True and events[-1][1]["answer"] == app.REFUSAL
+
+
+def test_stream_releases_text_held_back_as_a_possible_refusal(app, api, monkeypatch):
+    answer = "This is the pitot heater: it keeps the tube free of ice."
+    script_chat(app, monkeypatch, answer, piece=3)
+    events = sse_events(api.post("/ask/stream", json={"question": QUESTION}).text)
+    tokens = [payload["text"] for event, payload in events if event == "token"]
+    # "This i" could still become the refusal, so the first token waits for "is t"
+    assert not app.REFUSAL.startswith(tokens[0]) and "".join(tokens) == answer
+    assert events[-1] == ("done", {"answer": answer, "refused": False, "prompt_tokens": events[-1][1]["prompt_tokens"]})
+
+
+# ---------------- batch ----------------
+
+def test_batch_results_follow_input_order(app, api):
+    questions = [
+        QUESTION,
+        "How does the static altimeter read airspeed?",
+        QUESTION,
+        "Which football team won the 1998 world cup final?",
+        "Why does the gyro compass heading drift?"
+    ]
+    body = api.post("/ask/batch", json={"questions": questions}).json()
+    assert [r["question"] for r in body["results"]] == questions
+    assert body["results"][0] == body["results"][2]
+    assert len({r["answer"] for r in body["results"]}) == 4
+    assert body["results"][3]["answer"] == app.REFUSAL and body["refused"] == 1
+    for question, result in zip(questions, body["results"]):
+        single = api.post("/ask", json={"question": question}).json()
+        assert single["answer"] == result["answer"]
+        assert single.get("citations") == result.get("citations")
+
+
+# ---------------- answer cache ----------------
+
+def test_answer_cache_hit_and_invalidation_on_publish(app, api, tmp_path, monkeypatch):
+    from answer_cache import AnswerCache
+
+    monkeypatch.setattr(app, "answer_cache", AnswerCache(capacity=10))
+    calls = script_chat(app, monkeypatch, "The heater keeps the pitot tube free of ice.")
+    first = api.post("/ask", json={"question": QUESTION}).json()
+    second = api.post("/ask", json={"question": QUESTION + " "}).json()
+    assert len(calls) == 1 and "cached" not in first
+    assert second["cached"] is True and second["prompt_tokens"] == 0
+    assert second["answer"] == first["answer"] and second["citations"] == first["citations"]
+
+    # Any publish may change what the question would retrieve
+    ingest(app, tmp_path, "other", [page_text(50)])
+    third = api.post("/ask", json={"question": QUESTION}).json()
+    assert len(calls) == 2 and "cached" not in third
+    assert app.answer_cache.stats()["invalidations"] == 1
+
+    # Streaming shares the cache
+    events = sse_events(api.post("/ask/stream", json={"question": QUESTION}).text)
+    assert events[0][1]["cached"] is True and len(calls) == 2
+
+
+def test_requests_can_bypass_the_answer_cache(app, api, monkeypatch):
+    from answer_cache import AnswerCache
+
+    monkeypatch.setattr(app, "answer_cache", AnswerCache(capacity=10))
+    calls = script_chat(app, monkeypatch, "The heater keeps the pitot tube free of ice.")
+    api.post("/ask", json={"question": QUESTION})
+    body = api.post("/ask/batch", json={"questions": [QUESTION], "use_cache": False}).json()
+    assert "cached" not in body["results"][0] and len(calls) == 2
+    api.post("/ask", json={"question": QUESTION + "?", "use_cache": False})
+    assert len(calls) == 3 and app.answer_cache.stats()["entries"] == 1
@@ -0,0 +1,47 @@
+"""
+BM25 tests: scores against rank_bm25's BM25Okapi, and save/load.
+
+    pytest test_bm25.py -v
+"""
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25_index import BM25Index
+from conftest import random_texts
+
+
+def okapi_scores(texts, live, query):
+    """BM25Okapi scores over the live rows, placed at their row ids."""
+    okapi = BM25Okapi([texts[r].split() for r in live])
+    scores = np.zeros(len(texts))
+    scores[live] = okapi.get_scores(query)
+    return scores
+
+
+def test_bm25_matches_bm25okapi_after_add_and_remove(rng):
+    texts = random_texts(rng, 200)
+    bm25 = BM25Index()
+    bm25.add_documents([t.split() for t in texts[:150]])
+    bm25.add_documents([t.split() for t in texts[150:]])
+    removed = rng.choice(200, size=40, replace=False)
+    bm25.remove_documents(removed)
+    live = np.setdiff1d(np.arange(200), removed)
+
+    for query in (["w0"], ["w3", "w17", "w3"], ["w59", "nope", "w1"]):
+        np.testing.assert_allclose(bm25.get_scores(query), okapi_scores(texts, live, query), rtol=1e-4, atol=1e-5)
+
+    compacted = bm25.compact(live)
+    for query in (["w0"], ["w3", "w17"]):
+        np.testing.assert_allclose(compacted.get_scores(query), okapi_scores(texts, live, query)[live],
+                                   rtol=1e-4, atol=1e-5)
+
+
+def test_bm25_save_load(tmp_path, rng):
+    texts = random_texts(rng, 50)
+    bm25 = BM25Index()
+    bm25.add_documents([t.split() for t in texts])
+    bm25.remove_documents([3, 4])
+    bm25.save(str(tmp_path / "bm25"))
+    loaded = BM25Index.load(str(tmp_path / "bm25"))
+    np.testing.assert_allclose(loaded.get_scores(["w5", "w6"]), bm25.get_scores(["w5", "w6"]), rtol=1e-6)
+    assert loaded.live_docs == 48
@@ -0,0 +1,57 @@
+"""
+Embedding cache tests: LRU eviction and recovery from a stale index.
+
+    pytest test_embedding_cache.py -v
+"""
+import numpy as np
+
+from embedding_cache import EmbeddingCache, cache_key
+
+DIM = 8
+
+
+def vectors(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype("float32")
+
+
+def keys(*texts):
+    return [cache_key("test", text) for text in texts]
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), capacity=3, dtype="float32")
+    a, b, c, d = keys("a", "b", "c", "d")
+    va, vb, vc, vd = vectors(4)
+    cache.put_many([a, b, c], [va, vb, vc])
+    assert list(cache.get_many([a])) == [0]  # a is now the most recently used
+
+    cache.put_many([d], [vd])
+    found = cache.get_many([a, b, c, d])
+    assert sorted(found) == [0, 2, 3]
+    np.testing.assert_array_equal(found[0], va)
+    np.testing.assert_array_equal(found[3], vd)
+    assert cache.stats()["evictions"] == 1 and cache.stats()["entries"] == 3
+
+
+def test_row_reused_after_the_last_index_write_is_a_miss(tmp_path):
+    path = str(tmp_path)
+    cache = EmbeddingCache(path, capacity=3, dtype="float32", flush_every=1000, flush_interval=3600)
+    a, b, c, d = keys("a", "b", "c", "d")
+    va, vb, vc, vd = vectors(4)
+    cache.put_many([a, b, c], [va, vb, vc])
+    cache.flush()
+
+    # a is evicted and its row rewritten with d, then the process dies
+    # before index.npz is written again: the index still maps a to that row
+    cache.put_many([d], [vd])
+    cache.vectors.flush()
+    cache.row_keys.flush()
+
+    reloaded = EmbeddingCache(path, capacity=3, dtype="float32")
+    found = reloaded.get_many([a, b, c])
+    assert sorted(found) == [1, 2]
+    np.testing.assert_array_equal(found[1], vb)
+    assert reloaded.stats()["entries"] == 2
+    # The freed row is handed out again
+    reloaded.put_many([a], [va])
+    np.testing.assert_array_equal(reloaded.get_many([a])[0], va)
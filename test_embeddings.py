@@ -0,0 +1,114 @@
+"""
+EmbeddingClient tests: retry-after handling, batch bisection and input order.
+
+    pytest test_embeddings.py -v
+"""
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import numpy as np
+import openai
+import pytest
+
+import embeddings
+from embeddings import EmbeddingClient
+
+
+def vector(text):
+    return [float(len(text)), float(sum(map(ord, text)))]
+
+
+def error(cls, status, headers=None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "http://embeddings"))
+    return cls(f"HTTP {status}", response=response, body=None)
+
+
+class FakeEmbeddings:
+    """`client.embeddings` that raises the queued errors first, then embeds."""
+
+    def __init__(self, errors=(), max_inputs=None):
+        self.errors = list(errors)
+        self.max_inputs = max_inputs
+        self.batches = []
+
+    def _create(self, input):
+        self.batches.append(list(input))
+        if self.errors:
+            raise self.errors.pop(0)
+        if self.max_inputs is not None and len(input) > self.max_inputs:
+            raise error(openai.BadRequestError, 400)
+        data = [SimpleNamespace(index=i, embedding=vector(t)) for i, t in enumerate(input)]
+        return SimpleNamespace(data=data[::-1])
+
+    def create(self, model, input):
+        return self._create(input)
+
+
+class AsyncFakeEmbeddings(FakeEmbeddings):
+    async def create(self, model, input):
+        return self._create(input)
+
+
+class FakeClient:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def with_options(self, **kwargs):
+        return self
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Delays the client slept for, without sleeping."""
+    slept = []
+
+    async def async_sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(embeddings.time, "sleep", slept.append)
+    monkeypatch.setattr(embeddings.asyncio, "sleep", async_sleep)
+    return slept
+
+
+@pytest.mark.parametrize("headers, hinted", [({"retry-after-ms": "1500"}, 1.5), ({"retry-after": "4"}, 4.0)])
+def test_retry_waits_at_least_the_retry_after_hint(sleeps, headers, hinted):
+    fake = FakeEmbeddings([error(openai.RateLimitError, 429, headers), error(openai.InternalServerError, 503)])
+    client = EmbeddingClient(FakeClient(fake), "test", backoff_base=0.01, max_retries=3)
+    out = client.embed(["one", "two"])
+    np.testing.assert_array_equal(out, [vector("one"), vector("two")])
+    assert len(sleeps) == 2 and sleeps[0] >= hinted and sleeps[1] <= 0.02
+    assert client.last_run["retries"] == 2 and client.throughput()["requests"] == 3
+
+
+def test_gives_up_after_max_retries(sleeps):
+    fake = FakeEmbeddings([error(openai.RateLimitError, 429)] * 3)
+    client = EmbeddingClient(FakeClient(fake), "test", max_retries=2)
+    with pytest.raises(openai.RateLimitError):
+        client.embed(["one"])
+    assert len(sleeps) == 2
+
+
+def test_rejected_batch_is_bisected_in_order(sleeps):
+    texts = [f"text {i}" * (i + 1) for i in range(5)]
+    fake = FakeEmbeddings(max_inputs=2)
+    client = EmbeddingClient(FakeClient(fake), "test", max_batch_items=5)
+    np.testing.assert_array_equal(client.embed(texts), [vector(t) for t in texts])
+    assert [len(b) for b in fake.batches] == [5, 2, 3, 1, 2]
+    assert not sleeps
+
+
+def test_single_bad_input_is_raised():
+    client = EmbeddingClient(FakeClient(FakeEmbeddings(max_inputs=0)), "test")
+    with pytest.raises(openai.BadRequestError):
+        client.embed(["bad", "worse"])
+
+
+def test_async_client_retries_and_bisects(sleeps):
+    fake = AsyncFakeEmbeddings([error(openai.RateLimitError, 429, {"retry-after": "2"})], max_inputs=2)
+    client = EmbeddingClient(FakeClient(FakeEmbeddings()), "test", max_batch_items=4,
+                             async_client=FakeClient(fake))
+    texts = ["a", "bb", "ccc", "dddd"]
+    out = asyncio.run(client.aembed(texts))
+    np.testing.assert_array_equal(out, [vector(t) for t in texts])
+    assert sleeps[0] >= 2.0 and [len(b) for b in fake.batches] == [4, 4, 2, 2]
@@ -0,0 +1,42 @@
+"""
+Metadata filter tests: row selection and the exact vs selector search paths.
+
+    pytest test_filters.py -v
+"""
+import numpy as np
+import pytest
+
+from conftest import DIM, assert_same_hits, random_texts
+from metadata_index import MetadataIndex, make_filter
+from vector_index import normalize
+
+
+@pytest.mark.parametrize("filters", [
+    make_filter(doc_ids=["doc-1.pdf"]),
+    make_filter(doc_ids=["doc-0.pdf", "doc-2.pdf"], page_from=2, page_to=5),
+    make_filter(sections=["chapter 2"]),
+    make_filter(page_to=3)
+])
+def test_filter_exact_and_selector_paths_agree_on_flat(rng, snap, filters):
+    metadata = MetadataIndex(snap)
+    q_embs = normalize(rng.standard_normal((4, DIM)))
+    queries = [t.split() for t in random_texts(rng, 4)]
+    rows = metadata.rows(filters)
+    assert len(rows)
+
+    D_exact, I_exact, bm25_exact = metadata.search(filters, q_embs, queries, 8, bm25_k=8, exact_rows=len(rows))
+    D_sel, I_sel, bm25_sel = metadata.search(filters, q_embs, queries, 8, bm25_k=8, exact_rows=0)
+    np.testing.assert_array_equal(I_exact, I_sel)
+    np.testing.assert_allclose(D_exact, D_sel, rtol=1e-5)
+    assert set(I_exact[I_exact >= 0].tolist()) <= set(rows.tolist())
+    for hits, expected in zip(bm25_sel, bm25_exact):
+        assert_same_hits(hits, expected)
+        assert set(hits[0].tolist()) <= set(rows.tolist())
+
+
+def test_filter_rows(snap):
+    metadata = MetadataIndex(snap)
+    rows = metadata.rows(make_filter(doc_ids=["doc-1.pdf"], sections=["chapter 2"]))
+    pages = np.asarray(snap.chunks.page)[rows]
+    assert len(rows) == 3 * 4 and pages.min() == 4 and pages.max() == 6
+    assert all(snap.chunks.meta(r)["doc_id"] == "doc-1.pdf" for r in rows)
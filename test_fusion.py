@@ -0,0 +1,49 @@
+"""
+Fusion tests: reciprocal rank and weighted score fusion.
+
+    pytest test_fusion.py -v
+"""
+import numpy as np
+import pytest
+
+from fusion import min_max, reciprocal_rank_fusion, weighted_fusion
+
+
+def test_rrf_scores_are_summed_reciprocal_ranks():
+    ids, scores = reciprocal_rank_fusion([[1, 2, 3], [3, 4, 1]], k=60)
+    expected = {1: 1 / 61 + 1 / 63, 2: 1 / 62, 3: 1 / 63 + 1 / 61, 4: 1 / 62}
+    assert set(ids) == {1, 2, 3, 4}
+    assert scores == pytest.approx([expected[i] for i in ids])
+    assert scores == sorted(scores, reverse=True)
+    # Ties keep first-seen order: 1 before 3, 2 before 4
+    assert ids == [1, 3, 2, 4]
+
+
+def test_rrf_favours_ids_found_by_both_lists():
+    ids, _ = reciprocal_rank_fusion([[10, 11, 12, 13], [13, 20, 21, 22]], k=60)
+    assert ids[0] == 13
+
+
+def test_rrf_ignores_score_scale():
+    assert reciprocal_rank_fusion([[5, 6]])[0] == reciprocal_rank_fusion([[5, 6], []])[0] == [5, 6]
+
+
+def test_min_max():
+    np.testing.assert_allclose(min_max([2.0, 4.0, 3.0]), [0.0, 1.0, 0.5])
+    np.testing.assert_allclose(min_max([7.0, 7.0]), [1.0, 1.0])
+    assert len(min_max([])) == 0
+
+
+def test_weighted_fusion_normalizes_each_list():
+    vector = ([1, 2, 3], [0.9, 0.8, 0.7])
+    bm25 = ([3, 4], [25.0, 5.0])
+    ids, scores = weighted_fusion([vector, bm25], [0.5, 0.5])
+    expected = {1: 0.5, 2: 0.25, 3: 0.5, 4: 0.0}
+    assert dict(zip(ids, scores)) == pytest.approx(expected)
+    assert ids[:2] == [1, 3]
+
+
+@pytest.mark.parametrize("weights, best", [([1.0, 0.0], 1), ([0.0, 1.0], 3), ([0.2, 0.8], 3)])
+def test_weighted_fusion_follows_the_weights(weights, best):
+    ids, _ = weighted_fusion([([1, 2, 3], [0.9, 0.8, 0.7]), ([3, 2], [12.0, 1.0])], weights)
+    assert ids[0] == best
@@ -0,0 +1,99 @@
+"""
+MicroBatcher tests: coalescing, deduplication, failures and cancellation.
+
+    pytest test_micro_batcher.py -v
+"""
+import asyncio
+
+import pytest
+
+from micro_batcher import MicroBatcher
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def test_concurrent_items_share_one_batch_per_group():
+    calls = []
+
+    async def run_batch(group, items):
+        calls.append((group, items))
+        return [f"{group}:{item}" for item in items]
+
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch=8, max_wait=0.01)
+        results = await asyncio.gather(
+            batcher.submit("a", 1), batcher.submit("a", 2), batcher.submit("a", 1), batcher.submit("b", 1)
+        )
+        return results, batcher.stats()
+
+    results, stats = run(main())
+    assert results == ["a:1", "a:2", "a:1", "b:1"]
+    assert sorted(calls) == [("a", [1, 2]), ("b", [1])]
+    assert stats["deduplicated"] == 1 and stats["batches"] == 2
+
+
+def test_full_batch_runs_without_waiting():
+    async def run_batch(group, items):
+        return items
+
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch=2, max_wait=60)
+        return await asyncio.gather(batcher.submit("g", 1), batcher.submit("g", 2)), batcher.stats()
+
+    results, stats = run(main())
+    assert results == [1, 2] and stats["full_batches"] == 1
+
+
+def test_cancelled_caller_leaves_the_shared_result_to_others():
+    release = None
+
+    async def run_batch(group, items):
+        await release.wait()
+        return items
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        batcher = MicroBatcher(run_batch, max_batch=8, max_wait=0)
+        first = asyncio.create_task(batcher.submit("g", "q"))
+        second = asyncio.create_task(batcher.submit("g", "q"))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert run(main()) == "q"
+
+
+def test_cancelled_batch_fails_every_caller():
+    async def run_batch(group, items):
+        await asyncio.Event().wait()
+
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch=8, max_wait=0)
+        callers = [asyncio.create_task(batcher.submit("g", item)) for item in (1, 2)]
+        await asyncio.sleep(0.01)
+        batches = [t for t in asyncio.all_tasks() if t.get_coro().__qualname__ == "MicroBatcher._run"]
+        assert len(batches) == 1
+        batches[0].cancel()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        return results, batcher.futures
+
+    results, futures = run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert futures == {}
+
+
+def test_failed_batch_raises_in_every_caller():
+    async def run_batch(group, items):
+        raise ValueError("backend down")
+
+    async def main():
+        batcher = MicroBatcher(run_batch, max_batch=8, max_wait=0)
+        return await asyncio.gather(batcher.submit("g", 1), batcher.submit("g", 2), return_exceptions=True)
+
+    assert [str(r) for r in run(main())] == ["backend down", "backend down"]
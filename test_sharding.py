@@ -0,0 +1,136 @@
+"""
+Sharding tests: merged shard searches, shard servers and slices.
+
+    pytest test_sharding.py -v
+"""
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from conftest import DIM, INFO, assert_same_hits, free_port, make_snapshot, random_texts
+from sharding import (ShardClient, ShardServer, Shard, merge_bm25_hits, merge_vector_hits, wait_for_shards,
+                      write_slices)
+from snapshot import Snapshot, write_snapshot
+from vector_index import build_index, normalize
+
+AUTHKEY = b"test-shards"
+
+
+# ---------------- sharding ----------------
+
+@pytest.mark.parametrize("n_shards, by", [(1, "hash"), (3, "hash"), (4, "document")])
+def test_shard_merge_matches_unsharded_flat_search(rng, snap, n_shards, by):
+    q_embs = normalize(rng.standard_normal((5, DIM)))
+    queries = [t.split() for t in random_texts(rng, 5)]
+    k = 10
+
+    shards = [Shard.build(snap, shard, n_shards, by) for shard in range(n_shards)]
+    assert sorted(np.concatenate([s.rows for s in shards]).tolist()) == list(range(len(snap.chunks)))
+    parts = [shard.search(q_embs, queries, k, bm25_k=k) for shard in shards]
+    D, I = merge_vector_hits([(d, i) for d, i, _ in parts], k)
+    bm25_hits = merge_bm25_hits([hits for _, _, hits in parts], k)
+
+    expected_D, expected_I = snap.index.search(q_embs, k)
+    np.testing.assert_array_equal(I, expected_I)
+    np.testing.assert_allclose(D, expected_D, rtol=1e-5)
+    for hits, expected in zip(bm25_hits, snap.bm25.top_k_batch(queries, k)):
+        assert_same_hits(hits, expected)
+
+
+def serve(root, n_shards, ports=None):
+    """Serve every shard of `root` from threads (snapshot polling off); returns their addresses."""
+    ports = ports or [free_port() for _ in range(n_shards)]
+    for shard, port in enumerate(ports):
+        server = ShardServer(root, shard, n_shards, "hash", poll_seconds=60)
+        threading.Thread(target=server.serve_forever, args=(("127.0.0.1", port), AUTHKEY), daemon=True).start()
+    return [f"127.0.0.1:{port}" for port in ports]
+
+
+def write_sliced(root, snap, n_shards=2):
+    write_snapshot(root, snap, INFO, extra=lambda path, s: write_slices(path, s, n_shards, "hash"))
+
+
+def test_shard_servers_serve_their_slices(tmp_path, rng, snap):
+    root = str(tmp_path)
+    write_sliced(root, snap)
+    client = ShardClient(serve(root, 2), AUTHKEY, timeout=5)
+    try:
+        wait_for_shards(client, snap.version, timeout=10)
+        q_embs = normalize(rng.standard_normal((3, DIM)))
+        queries = [t.split() for t in random_texts(rng, 3)]
+        D, I, bm25_hits = client.search(snap.version, q_embs, queries, 8, bm25_k=8)
+        np.testing.assert_array_equal(I, snap.index.search(q_embs, 8)[1])
+        for hits, expected in zip(bm25_hits, snap.bm25.top_k_batch(queries, 8)):
+            assert_same_hits(hits, expected)
+        # Another version is never merged
+        assert client.search("999999", q_embs, queries, 8) is None
+        assert client.stats()["version_mismatches"] == 1
+    finally:
+        client.close()
+
+
+def test_shard_client_skips_a_failed_shard(rng):
+    client = ShardClient([f"127.0.0.1:{free_port()}"], AUTHKEY, timeout=1, retry_seconds=60)
+    q_embs = normalize(rng.standard_normal((1, DIM)))
+    assert client.search("000001", q_embs, None, 5) is None
+    assert client.stats()["down"] == [0]
+    start = time.perf_counter()
+    assert client.search("000001", q_embs, None, 5) is None
+    assert time.perf_counter() - start < 0.1
+    assert client.stats()["errors"] == 1 and client.stats()["skipped"] == 1
+
+
+def test_shard_is_marked_up_once_it_replies(tmp_path, rng, snap):
+    root = str(tmp_path)
+    write_sliced(root, snap)
+    ports = [free_port(), free_port()]
+    client = ShardClient([f"127.0.0.1:{port}" for port in ports], AUTHKEY, timeout=1, retry_seconds=60)
+    try:
+        q_embs = normalize(rng.standard_normal((1, DIM)))
+        assert client.search(snap.version, q_embs, None, 5) is None
+        assert client.stats()["down"] == [0]
+        serve(root, 2, ports)
+        wait_for_shards(client, snap.version, timeout=10)
+        assert client.stats()["down"] == []
+        assert client.search(snap.version, q_embs, None, 5) is not None
+    finally:
+        client.close()
+
+
+def test_shards_behind_are_asked_to_load_the_new_snapshot(tmp_path, rng, snap):
+    root = str(tmp_path)
+    write_sliced(root, snap)
+    client = ShardClient(serve(root, 2), AUTHKEY, timeout=5)
+    try:
+        wait_for_shards(client, snap.version, timeout=10)
+        write_sliced(root, make_snapshot(rng))
+        q_embs = normalize(rng.standard_normal((2, DIM)))
+        assert client.search("000002", q_embs, None, 5) is not None
+        assert [s["version"] for s in client.status()] == ["000002", "000002"]
+        assert client.stats()["searches"] == 1 and client.stats()["version_mismatches"] == 0
+    finally:
+        client.close()
+
+
+def test_slices_updated_from_base_match_rebuilt_slices(rng, snap):
+    base = [Shard.build(snap, shard, 2, "hash") for shard in range(2)]
+    chunks = snap.chunks.copy()
+    chunks.remove([1, 5, 6])
+    texts = random_texts(rng, 4)
+    chunks.add(texts, [7] * 4, "doc-0.pdf", "doc-0.pdf")
+    embeddings = np.vstack([snap.embeddings, normalize(rng.standard_normal((4, DIM)))])
+    live = chunks.live_rows()
+    bm25 = snap.bm25.copy()
+    bm25.remove_documents([1, 5, 6])
+    bm25.add_documents([t.split() for t in texts])
+    index = build_index(embeddings[live], live, "Flat")
+    next_snap = Snapshot(index, chunks, bm25, embeddings, snap.documents)
+
+    q_embs = normalize(rng.standard_normal((4, DIM)))
+    for shard in range(2):
+        updated = Shard.build(next_snap, shard, 2, "hash", base=base[shard])
+        rebuilt = Shard.build(next_snap, shard, 2, "hash")
+        np.testing.assert_array_equal(updated.rows, rebuilt.rows)
+        np.testing.assert_array_equal(updated.search(q_embs, None, 6)[1], rebuilt.search(q_embs, None, 6)[1])
@@ -0,0 +1,87 @@
+"""
+Snapshot tests: write, load, pruning and manifest checks.
+
+    pytest test_snapshot.py -v
+"""
+import errno
+import os
+
+import numpy as np
+import pytest
+
+from conftest import DIM, INFO, make_snapshot, random_texts
+from snapshot import Snapshot, current_version, load_snapshot, write_snapshot
+from vector_index import build_index, normalize
+
+
+def extend(root, rng, n=3, keep=3):
+    """Write a snapshot with `n` more chunks on top of the current one; returns it, embeddings as written."""
+    base = load_snapshot(root)
+    chunks = base.chunks.copy()
+    texts = random_texts(rng, n)
+    chunks.add(texts, [1] * n, "extra.pdf", "extra.pdf")
+    new = normalize(rng.standard_normal((n, DIM)))
+    all_embeddings = np.vstack([np.asarray(base.embeddings), new])
+    bm25 = base.bm25.copy()
+    bm25.add_documents([t.split() for t in texts])
+    index = build_index(all_embeddings, np.arange(len(chunks)), "Flat")
+    written = Snapshot(index, chunks, bm25, new, dict(base.documents))
+    write_snapshot(root, written, INFO, keep=keep, base=base)
+    written.embeddings = all_embeddings
+    return written
+
+
+def test_snapshot_round_trip_and_pruning(tmp_path, rng):
+    root = str(tmp_path)
+    snap = make_snapshot(rng)
+    manifest = write_snapshot(root, snap, INFO, keep=2)
+    assert manifest["version"] == "000001" and current_version(root) == "000001"
+
+    # Later snapshots extend the embeddings file of the one before
+    for _ in range(3):
+        written = extend(root, rng, keep=2)
+    chunks, bm25, index = written.chunks, written.bm25, written.index
+
+    assert sorted(os.listdir(os.path.join(root, "snapshots"))) == ["000003", "000004"]
+    assert current_version(root) == "000004"
+    loaded = load_snapshot(root, checksums=True)
+    assert loaded.version == "000004"
+    assert len(loaded.chunks) == len(chunks) and loaded.index.ntotal == len(chunks)
+    assert [loaded.chunks[r] for r in range(len(chunks))] == [chunks[r] for r in range(len(chunks))]
+    np.testing.assert_array_equal(loaded.embeddings, written.embeddings)
+    np.testing.assert_allclose(loaded.bm25.get_scores(["w1", "w2"]), bm25.get_scores(["w1", "w2"]), rtol=1e-6)
+    assert loaded.documents.keys() == snap.documents.keys()
+    assert loaded.documents["doc-0.pdf"]["pages"][1]["rows"] == snap.documents["doc-0.pdf"]["pages"][1]["rows"]
+    q = normalize(rng.standard_normal((2, DIM)))
+    np.testing.assert_array_equal(loaded.index.search(q, 5)[1], index.search(q, 5)[1])
+
+
+def test_truncated_snapshot_file_is_refused(tmp_path, snap):
+    root = str(tmp_path)
+    write_snapshot(root, snap, INFO)
+    path = os.path.join(root, "snapshots", "000001", "chunks")
+    victim = os.path.join(path, sorted(os.listdir(path))[0])
+    with open(victim, "r+b") as f:
+        f.truncate(os.path.getsize(victim) - 1)
+    with pytest.raises(ValueError):
+        load_snapshot(root)
+
+
+def test_embeddings_are_copied_where_hard_links_fail(tmp_path, rng, monkeypatch):
+    root = str(tmp_path)
+    snap = make_snapshot(rng)
+    write_snapshot(root, snap, INFO)
+    first = os.path.join(root, "snapshots", "000001", "embeddings.f32")
+    size = os.path.getsize(first)
+
+    def no_links(source, target):
+        raise OSError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(os, "link", no_links)
+    written = extend(root, rng)
+    second = os.path.join(root, "snapshots", "000002", "embeddings.f32")
+    assert os.stat(second).st_ino != os.stat(first).st_ino
+    assert os.path.getsize(first) == size
+    loaded = load_snapshot(root, checksums=True)
+    np.testing.assert_array_equal(loaded.embeddings, written.embeddings)
+    assert len(loaded.manifest["files"]["embeddings.f32"]["segments"]) == 2
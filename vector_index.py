@@ -0,0 +1,162 @@
+import logging
+import math
+
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "ivf", "ivfpq", "hnsw")
+
+# k-means wants ~39 training points per centroid; PQ has 256 centroids per sub-quantizer
+MIN_POINTS_PER_CENTROID = 39
+PQ_CENTROIDS = 256
+
+
+def normalize(vectors):
+    """Unit-length float32 rows, so inner product is cosine similarity (zero rows stay zero)."""
+    vectors = np.array(vectors, dtype="float32", ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def auto_nlist(n_vectors):
+    """IVF list count for a corpus: ~4·sqrt(n), capped so every list can be trained."""
+    return min(int(4 * math.sqrt(n_vectors)), n_vectors // MIN_POINTS_PER_CENTROID)
+
+
+def auto_pq_m(dim):
+    """PQ sub-quantizers: 16 dims each (96 bytes per 1536-dim vector), or the nearest divisor of dim."""
+    m = max(1, dim // 16)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def index_spec(kind, n_vectors, dim, nlist=0, pq_m=0, hnsw_m=32):
+    """
+    faiss.index_factory description for an index type and corpus size.
+
+    IVF types need enough vectors to train their centroids; below that
+    IVF-PQ falls back to IVF-Flat and IVF-Flat to Flat.
+
+    Args:
+        kind: One of INDEX_TYPES
+        n_vectors: Number of vectors the index will hold
+        dim: Vector dimension
+        nlist: IVF lists (0 = auto_nlist)
+        pq_m: PQ sub-quantizers for ivfpq (0 = auto_pq_m)
+        hnsw_m: HNSW neighbours per node
+    """
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {kind!r}, expected one of {INDEX_TYPES}")
+    if kind == "hnsw":
+        return f"HNSW{hnsw_m}"
+    if kind == "flat":
+        return "Flat"
+
+    nlist = nlist or auto_nlist(n_vectors)
+    if nlist < 2 or n_vectors < nlist * MIN_POINTS_PER_CENTROID:
+        return "Flat"
+    if kind == "ivfpq" and n_vectors >= PQ_CENTROIDS * MIN_POINTS_PER_CENTROID:
+        return f"IVF{nlist},PQ{pq_m or auto_pq_m(dim)}"
+    return f"IVF{nlist},Flat"
+
+
+def describe(index):
+    """Index type and parameters of a built index, as reported by /health."""
+    if index is None:
+        return None
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    metric = "cosine" if index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+    if isinstance(inner, faiss.IndexHNSW):
+        return {"type": "hnsw", "metric": metric, "M": inner.hnsw.nb_neighbors(1), "ef_search": inner.hnsw.efSearch}
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return {"type": "ivfpq", "metric": metric, "nlist": inner.nlist, "pq_m": inner.pq.M, "nprobe": inner.nprobe}
+    if isinstance(inner, faiss.IndexIVF):
+        return {"type": "ivf", "metric": metric, "nlist": inner.nlist, "nprobe": inner.nprobe}
+    return {"type": "flat", "metric": metric}
+
+
+def build_index(vectors, ids, spec, train_sample=100_000, nprobe=16, ef_construction=80, ef_search=64):
+    """
+    Build an inner-product IndexIDMap2 over `spec`, training on a random sample if needed.
+
+    Vectors are expected to be normalized, so search scores are cosine
+    similarities (higher is better).
+
+    Args:
+        vectors: Unit-length float32 array (n, dim)
+        ids: int64 ids, one per vector (chunk rows)
+        spec: faiss.index_factory description, e.g. from index_spec
+        train_sample: Maximum number of vectors used for training
+        nprobe: Default IVF lists probed per query
+        ef_construction: HNSW build-time candidate list size
+        ef_search: Default HNSW search-time candidate list size
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    index = faiss.index_factory(vectors.shape[1], f"IDMap2,{spec}", faiss.METRIC_INNER_PRODUCT)
+    inner = faiss.downcast_index(index.index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efConstruction = ef_construction
+        inner.hnsw.efSearch = ef_search
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+
+    if not index.is_trained:
+        sample = vectors
+        if len(vectors) > train_sample:
+            rows = np.random.default_rng(0).choice(len(vectors), train_sample, replace=False)
+            sample = vectors[np.sort(rows)]
+        logger.info(f"Training {spec} on {len(sample)} of {len(vectors)} vectors")
+        index.train(sample)
+
+    if len(vectors):
+        index.add_with_ids(vectors, np.asarray(ids, dtype="int64"))
+    return index
+
+
+def needs_rebuild(index, spec, removing=False):
+    """
+    Whether an existing index must be rebuilt rather than updated in place.
+
+    True when it is not a cosine index keyed by id, when its type no
+    longer matches the configured spec (including IVF list counts that
+    the corpus has outgrown), or when rows must be removed from HNSW,
+    which cannot delete vectors.
+    """
+    if not isinstance(index, faiss.IndexIDMap) or index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return True
+    current = describe(index)
+    target = spec.split(",")[0]
+    if current["type"] == "hnsw":
+        return removing or not target.startswith("HNSW")
+    if current["type"] == "flat":
+        return target != "Flat"
+    if not target.startswith("IVF"):
+        return True
+    wanted_nlist = int(target[3:])
+    wanted_pq = "PQ" in spec
+    # Retrain once the auto list count has at least doubled
+    return (current["type"] == "ivfpq") != wanted_pq or wanted_nlist >= 2 * current["nlist"]
+
+
+def search_params(index, nprobe=None, ef_search=None, sel=None):
+    """
+    Per-query search parameters for `index.search(..., params=...)`, or None.
+
+    `sel` (a faiss.IDSelector over ids) limits the search to those ids;
+    the caller keeps it alive until the search returns.
+    """
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVF) and (nprobe or sel is not None):
+        params = faiss.SearchParametersIVF(nprobe=min(nprobe or inner.nprobe, inner.nlist))
+    elif isinstance(inner, faiss.IndexHNSW) and (ef_search or sel is not None):
+        params = faiss.SearchParametersHNSW(efSearch=ef_search or inner.hnsw.efSearch)
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    return params